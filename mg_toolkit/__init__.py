@@ -14,10 +14,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from mg_toolkit.bulk_download import bulk_download
-from mg_toolkit.metadata import original_metadata
-from mg_toolkit.search import sequence_search
+import importlib
+import sys
+import types
 
-__all__ = ["original_metadata", "sequence_search", "bulk_download"]
+__all__ = [
+    "original_metadata",
+    "sequence_search",
+    "bulk_download",
+    "verify",
+    "merge",
+    "iter_analyses",
+    "iter_downloads",
+    "iter_sample_metadata",
+    "iter_search_hits",
+]
 
 __version__ = "0.10.4"
+
+# The tools are imported on first use, so the command line doesn't pay for
+# pandas and requests unless the tool needs them.
+_tools = {
+    "bulk_download": "mg_toolkit.bulk_download",
+    "original_metadata": "mg_toolkit.metadata",
+    "sequence_search": "mg_toolkit.search",
+    "verify": "mg_toolkit.verify",
+    "merge": "mg_toolkit.merge",
+    "iter_analyses": "mg_toolkit.api",
+    "iter_downloads": "mg_toolkit.api",
+    "iter_sample_metadata": "mg_toolkit.api",
+    "iter_search_hits": "mg_toolkit.api",
+}
+
+
+def __getattr__(name):
+    if name in _tools:
+        return getattr(importlib.import_module(_tools[name]), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # importing mg_toolkit.<tool> sets the attribute to the module, the
+        # function of the same name is kept instead
+        if isinstance(value, types.ModuleType) and _tools.get(name) == value.__name__:
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_tools))
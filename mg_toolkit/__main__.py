@@ -14,10 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+import logging
 import os
 import sys
-import logging
-import argparse
 import textwrap
 
 import mg_toolkit
@@ -31,7 +31,22 @@ def is_file(filename):
         return filename
 
 
-def main():
+def shard(value):
+    try:
+        index, count = (int(n) for n in value.split("/"))
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        msg = "{0} is not a valid shard, use i/N with 1 <= i <= N".format(value)
+        raise argparse.ArgumentTypeError(msg)
+    return index, count
+
+
+def _env_list(name):
+    return [value for value in os.environ.get(name, "").split(",") if value]
+
+
+def build_parser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description=textwrap.dedent(
@@ -50,6 +65,91 @@ def main():
     parser.add_argument(
         "-d", "--debug", action="store_true", help="print debugging information"
     )
+    parser.add_argument(
+        "--server",
+        metavar="URL",
+        default=os.environ.get("MG_TOOLKIT_SERVER"),
+        help=(
+            "run the command on a mg-toolkit serve process, "
+            "e.g. http://127.0.0.1:8765 (default: $MG_TOOLKIT_SERVER)"
+        ),
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help=(
+            "append a json line per HTTP request to FILE with the url, status, "
+            "bytes, retries, queueing delay and latency"
+        ),
+    )
+    parser.add_argument(
+        "--api-base",
+        metavar="URL",
+        action="append",
+        help=(
+            "base URL equivalent to the MGnify API, e.g. a mirror or a caching "
+            "proxy, can be repeated: the requests go to the fastest one that is "
+            "up (default: $MG_TOOLKIT_API_BASES, comma separated)"
+        ),
+    )
+    parser.add_argument(
+        "--ena-base",
+        metavar="URL",
+        action="append",
+        help=(
+            "base URL equivalent to ENA, can be repeated "
+            "(default: $MG_TOOLKIT_ENA_BASES, comma separated)"
+        ),
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        metavar="SECONDS",
+        type=float,
+        default=10,
+        help="timeout to connect to the APIs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        metavar="SECONDS",
+        type=float,
+        default=180,
+        help=(
+            "timeout waiting for data from the APIs, see --search-timeout for "
+            "the HMMER searches (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help=(
+            "send a duplicate of the metadata requests slower than the 95th "
+            "percentile, the first response is used"
+        ),
+    )
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument(
+        "--record",
+        metavar="DIR",
+        default=os.environ.get("MG_TOOLKIT_RECORD"),
+        help=(
+            "store every HTTP request and its response in DIR "
+            "(default: $MG_TOOLKIT_RECORD)"
+        ),
+    )
+    recording.add_argument(
+        "--replay",
+        metavar="DIR",
+        default=os.environ.get("MG_TOOLKIT_REPLAY"),
+        help=(
+            "answer the HTTP requests from the recordings in DIR, without network "
+            "(default: $MG_TOOLKIT_REPLAY)"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="sample the stacks of all the threads and write a summary to FILE",
+    )
 
     subparsers = parser.add_subparsers(dest="tool")
 
@@ -63,6 +163,25 @@ def main():
         nargs="+",
         help="Provide study accession, e.g. PRJEB1787 or ERP001736.",
     )
+    original_metadata_parser.add_argument(
+        "-f",
+        "--format",
+        choices=["csv", "parquet", "feather"],
+        default="csv",
+        help=(
+            "Output file format, parquet and feather store numeric columns "
+            "typed and require pyarrow (default: %(default)s)."
+        ),
+    )
+    original_metadata_parser.add_argument(
+        "-u",
+        "--update",
+        action="store_true",
+        help=(
+            "Update an existing <accession> output file, only the new runs and "
+            "the runs updated in ENA since the last update are fetched."
+        ),
+    )
 
     sequence_search_parser = subparsers.add_parser(
         "sequence_search", help="Search non-redundant protein database using HMMER"
@@ -71,7 +190,7 @@ def main():
     sequence_search_parser.add_argument(
         "-seq",
         "--sequence",
-        required=True,
+        required=False,
         type=is_file,
         nargs="+",
         help="Provide path to fasta file.",
@@ -80,7 +199,21 @@ def main():
         "-out",
         "--output",
         required=False,
-        help="Output csv results file (default: <query_id>_sequence_search.csv",
+        help=(
+            "Output results file, the rows are written as each query finishes "
+            "(default: <job_uuid>_sequence_search.<format>)."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "-f",
+        "--format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help=(
+            "Output file format. Parquet results are streamed to "
+            "<output>.partial.csv and converted at the end, it requires pyarrow "
+            "(default: %(default)s)."
+        ),
     )
     sequence_search_parser.add_argument(
         "-db",
@@ -94,6 +227,120 @@ def main():
         default="full",
         help="Choose peptide database (default: %(default)s).",
     )
+    sequence_search_parser.add_argument(
+        "--shard",
+        type=shard,
+        help=(
+            "Only search the i-th of N equal parts of the fasta files, e.g. 2/10. "
+            "The records are read through a <fasta>.mgidx index, built on first use."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--ids",
+        type=is_file,
+        help=(
+            "File with the query ids to search, one per line. The records are "
+            "read through a <fasta>.mgidx index, built on first use."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--checkpoint",
+        help=(
+            "Journal file of the completed and failed queries. Running again "
+            "with the same journal skips the completed queries, retries the "
+            "failed ones and appends to the same output."
+        ),
+    )
+    sequence_search_mode = sequence_search_parser.add_mutually_exclusive_group()
+    sequence_search_mode.add_argument(
+        "--submit-only",
+        action="store_true",
+        help=(
+            "Submit the searches without waiting for them, the job uuids are "
+            "stored in the --checkpoint journal."
+        ),
+    )
+    sequence_search_mode.add_argument(
+        "--fetch-only",
+        action="store_true",
+        help=(
+            "Collect the results of the jobs submitted with --submit-only, "
+            "reads the jobs from the --checkpoint journal (no --sequence needed)."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=5,
+        help=(
+            "Seconds between the first checks of a running job, it doubles up "
+            "to 2 minutes (default: %(default)s)."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--search-timeout",
+        type=float,
+        help=(
+            "Seconds to wait for the result of a search that isn't submitted "
+            "as a job (default: no limit)."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--poll-timeout",
+        type=float,
+        help="Seconds to wait for a job before giving up (default: no limit).",
+    )
+    sequence_search_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of queries to search and enrich concurrently "
+            "(default: %(default)s)."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--max-searches",
+        type=int,
+        help=(
+            "Maximum number of HMMER searches running at the same time "
+            "(default: the number of workers)."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--enrichment-workers",
+        type=int,
+        default=4,
+        help=(
+            "Number of concurrent MGnify requests used to fetch the metadata "
+            "of the hits of each query (default: %(default)s)."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--cache-dir",
+        help=(
+            "Directory to cache the HMMER search results in, searches with the "
+            "same sequence, database and thresholds are reused from it, "
+            "except by --submit-only and --fetch-only "
+            "(default: no persistent cache)."
+        ),
+    )
+    sequence_search_parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=24 * 7,
+        help="Hours a cached search result is valid for (default: %(default)s).",
+    )
+    sequence_search_parser.add_argument(
+        "--cache-max-size",
+        type=float,
+        default=1024,
+        help=(
+            "Maximum size of the cache in MB, the least recently used results "
+            "are removed first (default: %(default)s)."
+        ),
+    )
 
     sequence_search_subparser = sequence_search_parser.add_subparsers(dest="threshold")
 
@@ -280,7 +527,209 @@ def main():
         ),
     )
 
-    args = parser.parse_args()
+    bulk_download_parser.add_argument(
+        "--stall-throughput",
+        type=int,
+        metavar="BYTES",
+        help="\n".join(
+            [
+                "Abort and retry a download receiving less than BYTES per second",
+                "for --stall-seconds. DEFAULT: 10240",
+            ]
+        ),
+    )
+    bulk_download_parser.add_argument(
+        "--stall-seconds",
+        type=float,
+        help="See --stall-throughput. DEFAULT: 60",
+    )
+    bulk_download_parser.add_argument(
+        "--priority",
+        required=False,
+        choices=["api", "group", "size"],
+        help="\n".join(
+            [
+                "Order of the downloads:",
+                " - api: as the API lists them, while listing the study",
+                " - group: by --group-order, among the files listed so far",
+                " - size: smallest first, among the files listed so far",
+                "DEFAULT: api, or group with --group-order",
+            ]
+        ),
+    )
+    bulk_download_parser.add_argument(
+        "--group-order",
+        required=False,
+        metavar="GROUPS",
+        help="\n".join(
+            [
+                "Comma separated result groups to download first, in order,",
+                "a group matches the first entry it starts with.",
+                "DEFAULT: statistics,taxonomic_analysis,functional_analysis,",
+                "pathways_and_systems,non-coding_rnas",
+            ]
+        ),
+    )
+    bulk_download_parser.add_argument(
+        "--events",
+        required=False,
+        choices=["ndjson"],
+        help="\n".join(
+            [
+                "Write a json line to stdout per analysis found and per file",
+                "queued, completed (with its path, size and sha256),",
+                "skipped or failed, so the files can be processed as they land.",
+            ]
+        ),
+    )
+
+    verify_parser = subparsers.add_parser(
+        "verify",
+        help="Check the files downloaded by bulk_download.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    verify_parser.add_argument(
+        "-a",
+        "--accession",
+        required=True,
+        help="Study accession given to bulk_download.",
+    )
+    verify_parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default=os.getcwd(),
+        help="Output directory given to bulk_download.\nDEFAULT: CWD",
+    )
+    verify_parser.add_argument(
+        "-g",
+        "--result_group",
+        required=False,
+        help="Only check the files of the result group, e.g. statistics.",
+    )
+    verify_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        required=False,
+        help="Processes hashing the files.\nDEFAULT: number of CPUs",
+    )
+    verify_parser.add_argument(
+        "-r",
+        "--report",
+        required=False,
+        help="\n".join(
+            [
+                "Report with the status, size and checksum of every file.",
+                "DEFAULT: <output_path>/<accession>/<accession>_verify.tsv",
+            ]
+        ),
+    )
+    verify_parser.add_argument(
+        "-m",
+        "--manifest",
+        required=False,
+        help=(
+            "Write the metadata rows of the missing, truncated and corrupt\n"
+            "files to this file, to download them again."
+        ),
+    )
+
+    merge_parser = subparsers.add_parser(
+        "merge",
+        help="Merge the taxonomic and functional tables downloaded by bulk_download.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    merge_parser.add_argument(
+        "-a",
+        "--accession",
+        required=True,
+        help="Study accession given to bulk_download.",
+    )
+    merge_parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default=os.getcwd(),
+        help="Output directory given to bulk_download.\nDEFAULT: CWD",
+    )
+    merge_parser.add_argument(
+        "-g",
+        "--result_group",
+        required=False,
+        help=(
+            "Only merge the tables of the result group.\n"
+            "DEFAULT: taxonomic_analysis_* and functional_analysis"
+        ),
+    )
+    merge_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        required=False,
+        help="Processes parsing the tables.\nDEFAULT: number of CPUs",
+    )
+    merge_parser.add_argument(
+        "-m",
+        "--merged_path",
+        required=False,
+        help="Directory of the merged tables.\nDEFAULT: <output_path>/<accession>/merged",
+    )
+    merge_parser.add_argument(
+        "-f",
+        "--format",
+        choices=["mtx", "parquet"],
+        default="mtx",
+        help=(
+            "mtx: Matrix Market file of features x analyses,\n"
+            "parquet: (feature, analysis, count) table, needs pyarrow.\n"
+            "DEFAULT: mtx"
+        ),
+    )
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run the tools from a long lived process, with warm connections and caches.",
+    )
+    serve_parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port to listen on, on 127.0.0.1 (default: %(default)s).",
+    )
+    serve_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=10000,
+        help=(
+            "Number of sample, run and biome responses kept in memory "
+            "(default: %(default)s)."
+        ),
+    )
+    serve_parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=3600,
+        help=(
+            "Seconds the sample, run and biome responses are kept, so the "
+            "updates of ENA and MGnify are seen (default: %(default)s)."
+        ),
+    )
+
+    parser.tool_parsers = subparsers.choices
+    return parser
+
+
+def run(argv=None, tools=None):
+    """Parse the command line arguments and run the tool, one of tools if
+    given.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if tools is not None and args.tool not in tools:
+        parser.error(
+            "{0} can't be run here, use one of {1}".format(args.tool, ", ".join(tools))
+        )
 
     if args.debug:
         log_level = logging.DEBUG
@@ -288,7 +737,67 @@ def main():
         log_level = logging.WARN
 
     logging.basicConfig(format="%(levelname)s: %(message)s", level=log_level)
+    logging.getLogger().setLevel(log_level)
+
+    if args.tool == "sequence_search":
+        sequence_search_parser = parser.tool_parsers["sequence_search"]
+        if not args.sequence and not args.fetch_only:
+            sequence_search_parser.error("the following arguments are required: -seq")
+        from mg_toolkit.search import check_job_options
+
+        try:
+            check_job_options(vars(args))
+        except ValueError as e:
+            sequence_search_parser.error(str(e))
 
+    if args.tool == "bulk_download" and args.priority == "size" and args.group_order:
+        parser.tool_parsers["bulk_download"].error(
+            "--group-order can't be used with --priority size"
+        )
+
+    if args.record and args.replay:
+        parser.error("--record and --replay can't be used together")
+    if args.replay and not os.path.isdir(args.replay):
+        parser.error("{0} is not a directory".format(args.replay))
+    if args.tool is None:
+        parser.print_usage()
+        sys.exit(1)
+
+    from mg_toolkit import transport
+
+    # the settings of a server are kept across its jobs
+    settings = transport.save_settings()
+    transport.configure_timeouts(args.connect_timeout, args.read_timeout)
+    api_bases = args.api_base or _env_list("MG_TOOLKIT_API_BASES")
+    ena_bases = args.ena_base or _env_list("MG_TOOLKIT_ENA_BASES")
+    if api_bases or ena_bases:
+        from mg_toolkit.constants import API_BASE, ENA_BASE
+
+        transport.configure_endpoints({API_BASE: api_bases, ENA_BASE: ena_bases})
+    if args.hedge:
+        transport.enable_hedging()
+    if args.replay:
+        transport.enable_replay(args.replay)
+    elif args.record:
+        transport.enable_record(args.record)
+    if args.trace:
+        transport.enable_trace(args.trace)
+    profiler = None
+    if args.profile:
+        from mg_toolkit.profiling import SamplingProfiler
+
+        profiler = SamplingProfiler()
+        profiler.start()
+    try:
+        return _run_tool(parser, args)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.profile)
+        transport.restore_settings(settings)
+
+
+def _run_tool(parser, args):
     # TODO: use click or re-organize this
     if args.tool == "original_metadata":
         return mg_toolkit.original_metadata(args)
@@ -296,10 +805,30 @@ def main():
         return mg_toolkit.sequence_search(args)
     elif args.tool == "bulk_download":
         return mg_toolkit.bulk_download(args)
+    elif args.tool == "verify":
+        return mg_toolkit.verify(args)
+    elif args.tool == "merge":
+        return mg_toolkit.merge(args)
+    elif args.tool == "serve":
+        from mg_toolkit.server import serve
+
+        return serve(args, run)
     else:
         parser.print_usage()
         sys.exit(1)
 
 
+def main():
+    argv = sys.argv[1:]
+    server = argparse.ArgumentParser(add_help=False)
+    server.add_argument("--server", default=os.environ.get("MG_TOOLKIT_SERVER"))
+    known, tool_argv = server.parse_known_args(argv)
+    if known.server and "serve" not in tool_argv:
+        from mg_toolkit.server import forward
+
+        sys.exit(forward(known.server, tool_argv))
+    return run(tool_argv)
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Python API of the toolkit.
+
+The iterators fetch the API pages as they are consumed, so the results can
+be filtered and streamed without keeping them in memory or writing files.
+
+>>> from mg_toolkit.api import iter_analyses, iter_downloads
+>>> for analysis in iter_analyses("MGYS00002478", pipeline="4.1"):
+...     for download in iter_downloads(analysis):
+...         print(download.alias, download.url)
+"""
+
+import logging
+from collections import namedtuple
+
+from .constants import MG_ANALYSES_BASE_URL, MG_ANALYSES_DOWNLOADS_URL, MG_SEQ_URL
+from .decoding import response_json
+from .exceptions import FailToGetException
+from .transport import get_session
+
+logger = logging.getLogger(__name__)
+
+HEADERS = {"Accept": "application/json"}
+
+Analysis = namedtuple(
+    "Analysis",
+    [
+        "accession",
+        "study",
+        "sample",
+        "run",
+        "experiment_type",
+        "pipeline_version",
+        "attributes",
+    ],
+)
+
+Download = namedtuple(
+    "Download",
+    [
+        "analysis",
+        "alias",
+        "group_type",
+        "description",
+        "file_format",
+        "url",
+        "pipeline_version",
+        "checksum",
+        "checksum_algorithm",
+    ],
+)
+
+SampleMetadata = namedtuple(
+    "SampleMetadata", ["run", "sample", "read_depth", "metadata"]
+)
+
+SearchHit = namedtuple("SearchHit", ["query_id", "subject_id", "accession", "fields"])
+
+
+def iter_analyses(study, pipeline=None):
+    """Yield the analyses of the MGnify study, optionally of a pipeline version."""
+    params = {"study_accession": study}
+    if pipeline:
+        params["pipeline_version"] = pipeline
+    for analysis in _iter_pages(MG_ANALYSES_BASE_URL, params=params):
+        attributes = analysis.get("attributes") or {}
+        relationships = analysis.get("relationships") or {}
+        yield Analysis(
+            accession=analysis["id"],
+            study=_related_id(relationships, "study"),
+            sample=_related_id(relationships, "sample"),
+            run=_related_id(relationships, "run"),
+            experiment_type=attributes.get("experiment-type"),
+            pipeline_version=attributes.get("pipeline-version"),
+            attributes=attributes,
+        )
+
+
+def iter_downloads(analysis):
+    """Yield the download entries of an analysis, or of an analysis accession."""
+    accession = getattr(analysis, "accession", analysis)
+    url = MG_ANALYSES_DOWNLOADS_URL.format(accession=accession)
+    for download in _iter_pages(url):
+        attributes = download.get("attributes") or {}
+        checksum = attributes.get("file-checksum") or {}
+        yield Download(
+            analysis=accession,
+            alias=attributes.get("alias"),
+            group_type=attributes.get("group-type"),
+            description=(attributes.get("description") or {}).get("label"),
+            file_format=(attributes.get("file-format") or {}).get("name"),
+            url=(download.get("links") or {}).get("self"),
+            pipeline_version=_related_id(
+                download.get("relationships") or {}, "pipeline"
+            ),
+            checksum=checksum.get("checksum") or None,
+            checksum_algorithm=checksum.get("checksum-algorithm") or None,
+        )
+
+
+def iter_sample_metadata(study):
+    """Yield the ENA sample metadata of each run of the study.
+    The runs are listed first, the sample of each run is fetched as the
+    iterator reaches it.
+    """
+    from .metadata import OriginalMetadata
+
+    for run, metadata in OriginalMetadata(study).iter_metadata():
+        sample = metadata.pop("Sample")
+        read_depth = metadata.pop("Read depth")
+        yield SampleMetadata(run, sample, read_depth, metadata)
+
+
+def iter_search_hits(sequence, query_id="query", database="full", **kwargs):
+    """Search the sequence against the MGnify protein database and yield a
+    hit per (subject, sample or run accession), the fields hold the HMMER
+    scores and the sample metadata.
+    The keyword arguments are the SequenceSearch thresholds,
+    e.g. seq_evalue_threshold.
+    """
+    from .search import SequenceSearch
+
+    search = SequenceSearch(sequence, query_id, database, **kwargs)
+    response = search.analyse_sequence()
+    if not response:
+        raise FailToGetException(MG_SEQ_URL, None, "The HMMER search failed")
+    results = response.get("results")
+    if not results:
+        return
+    for (subject_id, accession), fields in search.fetch_results(results).items():
+        yield SearchHit(query_id, subject_id, accession, fields)
+
+
+def _iter_pages(url, params=None):
+    """Yield the data items of every page of a MGnify API list endpoint."""
+    session = get_session()
+    while url:
+        logger.debug("Requesting url %s" % url)
+        response = session.get(url, params=params, headers=HEADERS)
+        if not response.ok:
+            raise FailToGetException(url, response.status_code)
+        page = response_json(response)
+        for item in page.get("data", []):
+            yield item
+        # the next link already has the query parameters
+        url = (page.get("links") or {}).get("next")
+        params = None
+
+
+def _related_id(relationships, name):
+    data = (relationships.get(name) or {}).get("data") or {}
+    return data.get("id")
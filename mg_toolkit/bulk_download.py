@@ -15,21 +15,68 @@
 # limitations under the License.
 
 import csv
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import os
 import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import PriorityQueue
 
-from requests import HTTPError, Session
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from requests import HTTPError, codes
+from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import Timeout
 from tqdm import tqdm
 
 from .constants import API_BASE, MG_ANALYSES_BASE_URL, MG_ANALYSES_DOWNLOADS_URL
-from .exceptions import FailToGetException
+from .decoding import AnalysesPage, DownloadsPage, response_json
+from .exceptions import DownloadCancelled, DownloadStalled, FailToGetException
+from .transport import get_session, queued
 
 logger = logging.getLogger(__name__)
 
+# a download is aborted when its throughput, in bytes per second, stays
+# under the floor for STALL_SECONDS
+STALL_THROUGHPUT = 10 * 1024
+STALL_SECONDS = 60
+DOWNLOAD_ATTEMPTS = 3
+CHUNK_SIZE = 64 * 1024
+
+METADATA_COLUMNS = [
+    "analysis_id",
+    "name",
+    "group_type",
+    "description",
+    "download_url",
+    "pipeline_version",
+    "experiment_type",
+    # TODO: enable when released for the pipeline
+    # "checksum",
+    # "checksum_algorithm",
+]
+PRIORITIES = ("api", "group", "size")
+# --priority group: the summaries first, the sequence files last. A group
+# matches the first entry it starts with, the groups not listed come after.
+DEFAULT_GROUP_ORDER = [
+    "statistics",
+    "taxonomic_analysis",
+    "functional_analysis",
+    "pathways_and_systems",
+    "non-coding_rnas",
+]
+# concurrent HEAD requests getting the file sizes for --priority size
+SIZE_REQUESTS = 8
+
+# metadata rows kept in memory before a sorted batch is spilled to disk
+METADATA_BATCH_SIZE = 10000
+
 
 def bulk_download(args):
     """List of program arguments."""
@@ -40,12 +87,137 @@ def bulk_download(args):
     output_path = args.output_path
     version = args.pipeline
     result_group = args.result_group
+    events = getattr(args, "events", None)
+    group_order = getattr(args, "group_order", None)
 
-    program = BulkDownloader(project_id, output_path, version, result_group)
+    program = BulkDownloader(
+        project_id,
+        output_path,
+        version,
+        result_group,
+        events=events,
+        stall_throughput=getattr(args, "stall_throughput", None),
+        stall_seconds=getattr(args, "stall_seconds", None),
+        priority=getattr(args, "priority", None),
+        group_order=group_order.split(",") if group_order else None,
+    )
     program.run()
     logging.info("Program finished.")
 
 
+def group_folder_name(group_type):
+    """Folder of the files of a download group type, e.g. statistics"""
+    return group_type.lower().replace(" ", "_")
+
+
+class EventStream:
+    """
+    Writes the progress of the download as json lines, one per event,
+    e.g. {"event": "completed", "analysis": "MGYA00001", "path": ...}
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        line = json.dumps(dict(event=event, **fields))
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+class ThroughputMonitor:
+    """Raises DownloadStalled if less than floor bytes per second are
+    received over a window of seconds.
+    """
+
+    def __init__(self, floor, seconds):
+        self.floor = floor
+        self.seconds = seconds
+        self._start = time.monotonic()
+        self._received = 0
+
+    def update(self, received):
+        self._received += received
+        elapsed = time.monotonic() - self._start
+        if elapsed < self.seconds:
+            return
+        throughput = self._received / elapsed
+        if throughput < self.floor:
+            raise DownloadStalled(
+                "%.0f bytes/s over the last %.0fs" % (throughput, elapsed)
+            )
+        self._start += elapsed
+        self._received = 0
+
+
+class MetadataWriter:
+    """
+    Collects the rows of the metadata file and writes them, sorted and
+    merged with the rows of a previous run. The file is replaced each time
+    batch_size rows are collected and when closed, so an interrupted run
+    loses at most a batch.
+    """
+
+    def __init__(self, filename, batch_size=METADATA_BATCH_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self._rows = []
+        self._written = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, rows):
+        self._rows.extend(
+            ["" if value is None else str(value) for value in row] for row in rows
+        )
+        if len(self._rows) >= self.batch_size:
+            self._write()
+
+    def _previous_rows(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as f:
+            rows = (
+                row
+                for row in csv.reader(f, delimiter="\t")
+                if row and row != METADATA_COLUMNS
+            )
+            if not self._written:
+                # the file of a previous run may not be sorted
+                rows = sorted(rows)
+            yield from rows
+
+    def _write(self):
+        """Merge the collected rows into the file, the rows already in the
+        file aren't repeated.
+        """
+        rows = sorted(self._rows)
+        self._rows = []
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        with open(self.filename + ".tmp", "w") as metada_fd:
+            writer = csv.writer(metada_fd, delimiter="\t")
+            writer.writerow(METADATA_COLUMNS)
+            previous = None
+            for row in heapq.merge(rows, self._previous_rows()):
+                if row != previous:
+                    writer.writerow(row)
+                previous = row
+        os.replace(self.filename + ".tmp", self.filename)
+        self._written = True
+
+    def close(self):
+        """Write the rows collected since the last batch."""
+        if self._rows:
+            self._write()
+        self._written = False
+
+
 class BulkDownloader:
     """
     Helper tool allowing to download result data for the specified project
@@ -62,23 +234,58 @@ class BulkDownloader:
         "Processed reads with pCDS",
     }
 
-    def __init__(self, project_id, output_path, version, result_group):
+    def __init__(
+        self,
+        project_id,
+        output_path,
+        version,
+        result_group,
+        events=None,
+        stall_throughput=None,
+        stall_seconds=None,
+        priority=None,
+        group_order=None,
+    ):
         self.project_id = project_id
         self.output_path = output_path
         self.version = version
         self.result_group = result_group
+        self.events = EventStream() if events == "ndjson" else None
+        self.stall_throughput = (
+            STALL_THROUGHPUT if stall_throughput is None else stall_throughput
+        )
+        self.stall_seconds = stall_seconds or STALL_SECONDS
+        self.priority = priority or ("group" if group_order else "api")
+        if self.priority not in PRIORITIES:
+            raise ValueError("Unsupported priority: %s" % self.priority)
+        if self.priority == "size" and group_order:
+            raise ValueError("The group order can't be used with the size priority")
+        self.group_order = group_order or DEFAULT_GROUP_ORDER
+        # files waiting for download_queued, unless priority is api, as
+        # (priority, listing order, event)
+        self.queue = PriorityQueue()
+        self.queued_paths = set()
+        self._order = itertools.count()
+        self._cancel = threading.Event()
+        self._sizes = None
+        self._downloads = None
+        self._downloader = None
         self._init_program()
         self.headers = {
             "Accept": "application/json",
         }
         # http session
-        retry_strategy = Retry(
-            total=3, status_forcelist=[500, 502, 503, 504], backoff_factor=1
+        self.http = get_session()
+        self.metadata = MetadataWriter(
+            os.path.join(
+                self.output_path,
+                self.project_id,
+                "{}_metadata.tsv".format(self.project_id),
+            )
         )
-        retry_adapter = HTTPAdapter(max_retries=retry_strategy)
-        http = Session()
-        http.mount(MG_ANALYSES_BASE_URL, retry_adapter)
-        self.http = http
+        # fetches the next downloads page while the files are downloaded,
+        # set by run
+        self._prefetch = None
 
     def _init_program(self):
 
@@ -106,13 +313,17 @@ class BulkDownloader:
         logging.info("Output directory: %s" % self.output_path)
         logging.debug("Python version: " + platform.python_version())
 
+    def emit(self, event, **fields):
+        if self.events is not None:
+            self.events.emit(event, study=self.project_id, **fields)
+
     def download_resource_by_url(self, url, output_file_name):
         """
         Kicks off a download and stores the file at the given path.
 
         :param url: Resource location.
         :param output_file_name: Path of the output file.
-        :return:
+        :return: The size and sha256 of the file.
         """
         output_file_name_tmp = output_file_name + ".tmp"
 
@@ -120,17 +331,32 @@ class BulkDownloader:
         logging.debug(url)
         logging.debug("Saving file in:\n" + output_file_name_tmp)
 
-        try:
-            with self.http.get(url) as response:
-                response.raise_for_status()
-                with open(output_file_name_tmp, "wb") as f:
-                    f.write(response.content)
-        except HTTPError as http_error:
-            logging.error(http_error)
-            raise
-        except IOError as io_error:
-            logging.error(io_error)
-            raise
+        if os.path.exists(output_file_name_tmp):
+            # left by an interrupted run
+            os.remove(output_file_name_tmp)
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                size, checksum = self._download(url, output_file_name_tmp)
+                break
+            except HTTPError as http_error:
+                logging.error(http_error)
+                raise
+            except (
+                DownloadStalled,
+                RequestsConnectionError,
+                ChunkedEncodingError,
+                Timeout,
+            ) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    logging.error(e)
+                    raise
+                logger.warning(
+                    "Download of %s interrupted (%s), retrying %s/%s"
+                    % (url, e, attempt + 1, DOWNLOAD_ATTEMPTS)
+                )
+            except IOError as io_error:
+                logging.error(io_error)
+                raise
         logging.debug("Download finished.")
         # move to final destination
         try:
@@ -139,6 +365,51 @@ class BulkDownloader:
             logger.error("File %s exists. Over-writing." % output_file_name)
             os.remove(output_file_name)
             os.rename(output_file_name_tmp, output_file_name)
+        return size, checksum
+
+    def _download(self, url, filename):
+        """Stream the url to the file, resuming the data already in the file
+        when the server supports ranges. Returns the size and sha256.
+        """
+        checksum = hashlib.sha256()
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        headers = {"Range": "bytes=%s-" % size} if size else {}
+
+        with self.http.get(url, stream=True, headers=headers) as response:
+            if response.status_code == codes.requested_range_not_satisfiable:
+                os.remove(filename)
+                return self._download(url, filename)
+            response.raise_for_status()
+            if response.status_code == codes.partial_content:
+                with open(filename, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        checksum.update(chunk)
+                mode = "ab"
+            else:
+                size = 0
+                mode = "wb"
+            monitor = ThroughputMonitor(self.stall_throughput, self.stall_seconds)
+            with open(filename, mode) as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if self._cancel.is_set():
+                        raise DownloadCancelled(url)
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    size += len(chunk)
+                    monitor.update(len(chunk))
+        return size, checksum.hexdigest()
+
+    @classmethod
+    def not_applicable(cls, experiment_type, description_label, pipeline_version):
+        """Files listed by the API that aren't downloaded."""
+        # TODO: Remove the following if case if EMG-742 is resolved
+        if (
+            experiment_type == "amplicon"
+            and description_label in cls.non_amplicon_file_labels
+        ):
+            return True
+        # TODO: Remove the following if case if EMG-741 is resolved
+        return description_label == "Phylogenetic tree" and pipeline_version == "2.0"
 
     def download_file(
         self,
@@ -151,23 +422,28 @@ class BulkDownloader:
         download_url,
         dest_dir,
         project_id,
+        analysis_id=None,
+        size=None,
     ):
         """Download file from MGnify API.
         If the file exists it won't downloaded again but there is no
-        integrity check.
+        integrity check. Unless the priority is api the file is queued, and
+        downloaded by download_queued, see start_downloads.
         """
-        subdir_folder_name = download_group_type_key.lower().replace(" ", "_")
+        subdir_folder_name = group_folder_name(download_group_type_key)
+        event = {
+            "analysis": analysis_id,
+            "alias": file_name,
+            "group_type": download_group_type_key,
+            "description": description_label,
+            "url": download_url,
+        }
 
-        # TODO: Remove the following if case if EMG-742 is resolved
-        if (
-            experiment_type == "amplicon"
-            and description_label in self.non_amplicon_file_labels
-        ):
-            return
-            # TODO: Remove the following if case if EMG-741 is resolved
-        elif description_label == "Phylogenetic tree" and pipeline_version == "2.0":
+        if self.not_applicable(experiment_type, description_label, pipeline_version):
+            self.emit("skipped", reason="not_applicable", **event)
             return
         if result_group and result_group != subdir_folder_name:
+            self.emit("skipped", reason="result_group", **event)
             return
 
         sub_dir = Path(
@@ -179,15 +455,108 @@ class BulkDownloader:
         sub_dir.mkdir(parents=True, exist_ok=True)
 
         output_file_name = os.path.join(str(sub_dir), file_name)
+        event["path"] = output_file_name
 
-        if os.path.exists(output_file_name):
+        if os.path.exists(output_file_name) or output_file_name in self.queued_paths:
             logger.debug("File %s exists. Skipping." % output_file_name)
+            self.emit("skipped", reason="exists", **event)
             return
+        self.emit("queued", **event)
+        if self.priority == "api":
+            self._fetch(event)
+            return
+        self.queued_paths.add(output_file_name)
+        order = next(self._order)
+        if self.priority == "size" and size is None:
+            self._sizes.submit(queued(self._queue_sized), event, order)
+        else:
+            self._queue(event, size, order)
+
+    def _queue(self, event, size, order):
+        if self.priority == "size":
+            # unknown sizes last
+            key = float("inf") if size is None else int(size)
+        else:
+            key = self.group_rank(event["group_type"])
+        self.queue.put((key, order, event))
+
+    def _queue_sized(self, event, order):
+        if not self._cancel.is_set():
+            self._queue(event, self._file_size(event["url"]), order)
+
+    def _fetch(self, event):
         try:
-            self.download_resource_by_url(download_url, output_file_name)
+            size, checksum = self.download_resource_by_url(event["url"], event["path"])
         except (IOError, HTTPError) as e:
             logger.error("File download file error. Skipping.")
             logger.error(e)
+            self.emit("failed", error=str(e), **event)
+            return
+        self.emit(
+            "completed",
+            size=size,
+            checksum=checksum,
+            checksum_algorithm="sha256",
+            **event,
+        )
+
+    def group_rank(self, group_type):
+        """Position of the group in the group order"""
+        folder = group_folder_name(group_type)
+        for rank, group in enumerate(self.group_order):
+            if folder.startswith(group):
+                return rank
+        return len(self.group_order)
+
+    def _file_size(self, url):
+        try:
+            response = self.http.head(url, headers=self.headers, allow_redirects=True)
+            return int(response.headers["Content-Length"])
+        except (IOError, HTTPError, KeyError, TypeError, ValueError) as e:
+            logger.debug("No size for %s: %s" % (url, e))
+            return None
+
+    def download_queued(self):
+        """Download the queued files, by group order or smallest first,
+        until the listing is finished. The files keep the order of the API
+        within a group or a size.
+        """
+        with tqdm() as progress_bar:
+            while not self._cancel.is_set():
+                _, _, event = self.queue.get()
+                if event is None:
+                    break
+                self._fetch(event)
+                progress_bar.update(1)
+
+    def start_downloads(self):
+        """Download the queued files in a thread while the study is listed,
+        unless the priority is api.
+        """
+        if self.priority == "api":
+            return
+        self._cancel.clear()
+        self._sizes = ThreadPoolExecutor(max_workers=SIZE_REQUESTS)
+        self._downloads = ThreadPoolExecutor(max_workers=1)
+        self._downloader = self._downloads.submit(self.download_queued)
+
+    def finish_downloads(self, cancel=False):
+        """Wait for the queued files once the study is listed. If cancel, the
+        current download is interrupted and the other files are left.
+        """
+        if cancel:
+            self._cancel.set()
+        if self._downloads is None:
+            return
+        downloads, self._downloads = self._downloads, None
+        self._sizes.shutdown(wait=not cancel)
+        # after the queued files
+        self.queue.put((float("inf"), next(self._order), None))
+        downloads.shutdown(wait=not cancel)
+        self.queue = PriorityQueue()
+        self.queued_paths = set()
+        if not cancel:
+            self._downloader.result()
 
     def run(self):
         """Get a project using MGnify RESTful API."""
@@ -214,7 +583,7 @@ class BulkDownloader:
             logger.error(f"Error: {response.status_code}")
             return
 
-        response_data = response.json()
+        response_data = response_json(response, AnalysesPage)
 
         num_results = response_data["meta"]["pagination"]["count"]
 
@@ -223,22 +592,30 @@ class BulkDownloader:
         num_results_processed = 0
         total_results_processed = 0
 
-        with tqdm(total=num_results) as progress_bar:
-
-            while total_results_processed < num_results:
-
-                num_results_processed = self.process_page(response_data, progress_bar)
-                total_results_processed += num_results_processed
-
-                # navigate to the next link
-                next_url = response_data["links"]["next"]
-
-                if next_url is not None:
-                    logging.debug("Requesting url %s" % next_url)
-                    next_response = self.http.get(next_url, headers=self.headers)
-                    if not next_response.ok:
-                        raise FailToGetException(next_url, response.status_code)
-                    response_data = next_response.json()
+        self._prefetch = ThreadPoolExecutor(max_workers=1)
+        with self.metadata, self._prefetch, tqdm(total=num_results) as progress_bar:
+            self.start_downloads()
+            try:
+                while total_results_processed < num_results:
+
+                    num_results_processed = self.process_page(
+                        response_data, progress_bar
+                    )
+                    total_results_processed += num_results_processed
+
+                    # navigate to the next link
+                    next_url = response_data["links"]["next"]
+
+                    if next_url is not None:
+                        logging.debug("Requesting url %s" % next_url)
+                        next_response = self.http.get(next_url, headers=self.headers)
+                        if not next_response.ok:
+                            raise FailToGetException(next_url, response.status_code)
+                        response_data = response_json(next_response, AnalysesPage)
+                self.finish_downloads()
+            except BaseException:
+                self.finish_downloads(cancel=True)
+                raise
 
         if total_results_processed == 0:
             logging.warning(
@@ -256,26 +633,44 @@ class BulkDownloader:
                 + " results!"
             )
         logging.info("Process " + str(total_results_processed) + " results.")
-        print("\n Download complete!")
+        if self.events is not None:
+            self.emit("finished", analyses=total_results_processed)
+        else:
+            print("\n Download complete!")
 
     def _process_download_page(self, analysis, download_response):
         """Process all the pages from the downloads section.
-        This will follow the next link.
+        This will follow the next link, the next page is requested while the
+        files of the current one are downloaded.
         """
         analysis_job_id = analysis["id"]
         analysis_attr = analysis["attributes"]
         experiment_type = analysis_attr["experiment-type"]
         pipeline_version = analysis_attr["pipeline-version"]
 
-        if not download_response.ok:
-            logger.error(
-                "Error getting the accession download files. Accession %s"
-                % analysis_job_id
-            )
-            logger.error("Skipping...")
-        else:
-            response_json = download_response.json()
-            downloads = response_json.get("data", [])
+        while download_response is not None:
+            if not download_response.ok:
+                logger.error(
+                    "Error getting the accession download files. Accession %s"
+                    % analysis_job_id
+                )
+                logger.error("Skipping...")
+                self.emit(
+                    "failed",
+                    analysis=analysis_job_id,
+                    error="HTTP %s listing the downloads"
+                    % download_response.status_code,
+                )
+                return
+            downloads_page = response_json(download_response, DownloadsPage)
+            next_page_url = downloads_page.get("links", {}).get("next")
+            next_page = None
+            if next_page_url:
+                next_page = self._prefetch.submit(
+                    queued(self.http.get), next_page_url, headers=self.headers
+                )
+
+            downloads = downloads_page.get("data", [])
             for download in downloads:
                 download_attr = download["attributes"]
                 alias = download_attr["alias"]
@@ -292,17 +687,13 @@ class BulkDownloader:
                     download_url=download_url,
                     project_id=self.project_id,
                     dest_dir=self.output_path,
+                    analysis_id=analysis_job_id,
+                    size=download_attr.get("file-size"),
                 )
             # store the metadata for the analysis
-            self.store_metadata(analysis, response_json)
+            self.store_metadata(analysis, downloads_page)
 
-            next_page_url = response_json.get("links", {}).get("next")
-            if next_page_url:
-                next_page_respose = self.http.get(
-                    next_page_url,
-                    headers=self.headers,
-                )
-                self._process_download_page(analysis, next_page_respose)
+            download_response = next_page.result() if next_page else None
 
     def process_page(self, response_data, progress_bar):
         """Process an analysis returned page"""
@@ -311,6 +702,12 @@ class BulkDownloader:
         for analysis in tqdm(analyses):
 
             analysis_job_id = analysis["id"]
+            self.emit(
+                "analysis",
+                analysis=analysis_job_id,
+                experiment_type=analysis["attributes"].get("experiment-type"),
+                pipeline_version=analysis["attributes"].get("pipeline-version"),
+            )
 
             download_response = self.http.get(
                 MG_ANALYSES_DOWNLOADS_URL.format(**{"accession": analysis_job_id}),
@@ -326,62 +723,40 @@ class BulkDownloader:
 
     def store_metadata(self, analysis, response_json):
         """
-        Store the API response json in a tsv file called <analysis>_metadata.tsv
+        Add the downloads of the API response json to the <project>_metadata.tsv
+        file, written sorted by MetadataWriter.
         This file can be used to make it easier to interpret the downloaded files.
         """
-        metadata_file_name = "{}_metadata.tsv".format(self.project_id)
-
-        directory = os.path.join(self.output_path, self.project_id)
-        os.makedirs(directory, exist_ok=True)
-        output_file = os.path.join(directory, metadata_file_name)
-        mode = "a" if os.path.exists(output_file) else "w"
         experyment_type = analysis.get("attributes").get("experiment-type")
 
-        col_names = [
-            "analysis_id",
-            "name",
-            "group_type",
-            "description",
-            "download_url",
-            "pipeline_version",
-            "experiment_type",
-            # TODO: enable when released for the pipeline
-            # "checksum",
-            # "checksum_algorithm",
-        ]
-
-        with open(output_file, mode) as metada_fd:
-            writer = csv.writer(metada_fd, delimiter="\t")
-            if mode == "w":
-                writer.writerow(col_names)
-            rows = []
-            for entry in response_json.get("data", []):
-                download_attr = entry.get("attributes")
-                alias = download_attr.get("alias")
-                group_type = download_attr.get("group-type")
-                desc_label = download_attr.get("description").get("label")
-                download_url = entry.get("links").get("self")
-                pipeline_version = (
-                    entry.get("relationships").get("pipeline").get("data").get("id")
-                )
+        rows = []
+        for entry in response_json.get("data", []):
+            download_attr = entry.get("attributes")
+            alias = download_attr.get("alias")
+            group_type = download_attr.get("group-type")
+            desc_label = download_attr.get("description").get("label")
+            download_url = entry.get("links").get("self")
+            pipeline_version = (
+                entry.get("relationships").get("pipeline").get("data").get("id")
+            )
 
-                # TODO: enable when released for the pipeline
-                # checksum = download_attr.get("file-checksum").get("checksum")
-                # checksum_algorithm = download_attr.get("file-checksum").get(
-                #     "checksum-algorithm"
-                # )
-
-                rows.append(
-                    [
-                        analysis["id"],
-                        alias,
-                        group_type,
-                        desc_label,
-                        download_url,
-                        pipeline_version,
-                        experyment_type,
-                        # checksum,
-                        # checksum_algorithm,
-                    ]
-                )
-            writer.writerows(sorted(rows))
+            # TODO: enable when released for the pipeline
+            # checksum = download_attr.get("file-checksum").get("checksum")
+            # checksum_algorithm = download_attr.get("file-checksum").get(
+            #     "checksum-algorithm"
+            # )
+
+            rows.append(
+                [
+                    analysis["id"],
+                    alias,
+                    group_type,
+                    desc_label,
+                    download_url,
+                    pipeline_version,
+                    experyment_type,
+                    # checksum,
+                    # checksum_algorithm,
+                ]
+            )
+        self.metadata.add(rows)
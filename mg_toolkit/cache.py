@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def normalise_sequence(sequence):
+    """Upper case sequence without whitespace or the trailing stop codon."""
+    return "".join(sequence.split()).upper().rstrip("*")
+
+
+class SearchCache:
+    """
+    On disk cache of the HMMER search responses.
+
+    Responses are stored gzipped, one file per search, keyed by the hash of
+    the normalised sequence and the search parameters (seqdb and
+    thresholds). Entries older than ttl seconds are ignored. Once the
+    cache grows over max_size bytes the least recently used entries are
+    removed.
+    """
+
+    def __init__(self, cache_dir, ttl=None, max_size=None):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # key -> [lock, number of searches holding or waiting for it]
+        self._key_locks = dict()
+        self._key_locks_lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def key(data):
+        """Cache key of the search POST data."""
+        params = {k: v for k, v in data.items() if k != "seq"}
+        params["seq"] = normalise_sequence(data["seq"])
+        return hashlib.sha256(
+            json.dumps(params, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    @contextmanager
+    def lock(self, key):
+        """Lock the key, so the same search doesn't run twice at once."""
+        with self._key_locks_lock:
+            entry = self._key_locks.get(key)
+            if entry is None:
+                entry = self._key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._key_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json.gz")
+
+    def get(self, key):
+        """Get the cached response, None if missing or expired."""
+        path = self._path(key)
+        try:
+            mtime = os.path.getmtime(path)
+            if self.ttl is not None and time.time() - mtime > self.ttl:
+                logger.debug("Cached search %s expired" % key)
+                return None
+            with gzip.open(path, "rt") as f:
+                response = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # keep track of the last use for the eviction
+        os.utime(path, (time.time(), mtime))
+        logger.debug("Cached search %s" % key)
+        return response
+
+    def set(self, key, response):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        path_tmp = "{}.{}.tmp".format(path, threading.get_ident())
+        with gzip.open(path_tmp, "wt") as f:
+            json.dump(response, f)
+        size = os.path.getsize(path_tmp)
+        with self._lock:
+            try:
+                # replaces an expired entry
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(path_tmp, path)
+            self._size += size
+            if self.max_size is not None and self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json.gz"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_atime, stat.st_size
+
+    def _evict(self):
+        """Remove the least recently used entries, down to 90% of max_size."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        target = self.max_size * 0.9
+        for path, _, size in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+        logger.debug("Search cache evicted down to %s bytes" % self._size)
@@ -16,18 +16,27 @@
 
 MG_SEQ_URL = "https://www.ebi.ac.uk/metagenomics/sequence-search/search/phmmer"
 
+MG_SEQ_RESULTS_URL = (
+    "https://www.ebi.ac.uk/metagenomics/sequence-search/results/{uuid}/score"
+)
+
 API_BASE = "https://www.ebi.ac.uk/metagenomics/api/latest"
 
 MG_SAMPLE_URL = API_BASE + "/samples/{accession}"
 
+MG_SAMPLES_URL = API_BASE + "/samples"
+MG_SAMPLES_ACCESSION_FILTER = "accession"
+
 MG_RUN_URL = API_BASE + "/runs/{accession}"
 
 MG_ANALYSES_BASE_URL = API_BASE + "/analyses"
 
 MG_ANALYSES_DOWNLOADS_URL = API_BASE + "/analyses/{accession}/downloads"
 
-ENA_SEARCH_API_URL = "https://www.ebi.ac.uk/ena/portal/api/search"
-ENA_XML_VIEW_URL = "https://www.ebi.ac.uk/ena/browser/api/xml"
+ENA_BASE = "https://www.ebi.ac.uk/ena"
+
+ENA_SEARCH_API_URL = ENA_BASE + "/portal/api/search"
+ENA_XML_VIEW_URL = ENA_BASE + "/browser/api/xml"
 
 EBI_URL_PREFIX = "https://www.ebi.ac.uk/"
 REQUESTS_RETRIES = 3
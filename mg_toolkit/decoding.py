@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON decoding of the API responses.
+
+msgspec or orjson are used when they are installed, the standard library
+otherwise. With msgspec a response can be decoded with a schema, a
+TypedDict of the keys the tools read: the rest of the document is skipped
+without building python objects. Documents that don't match the schema are
+decoded in full.
+"""
+
+import json
+import logging
+from typing import Any, List, TypedDict
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+# MGnify analyses list, the attributes hold large analysis summaries
+AnalysisAttributes = TypedDict(
+    "AnalysisAttributes",
+    {"accession": Any, "experiment-type": Any, "pipeline-version": Any},
+    total=False,
+)
+Analysis = TypedDict(
+    "Analysis",
+    {"id": Any, "attributes": AnalysisAttributes, "relationships": Any},
+    total=False,
+)
+AnalysesPage = TypedDict(
+    "AnalysesPage", {"data": List[Analysis], "links": Any, "meta": Any}, total=False
+)
+
+# MGnify downloads list of an analysis
+DownloadRelationships = TypedDict(
+    "DownloadRelationships", {"pipeline": Any}, total=False
+)
+Download = TypedDict(
+    "Download",
+    {"attributes": Any, "links": Any, "relationships": DownloadRelationships},
+    total=False,
+)
+DownloadsPage = TypedDict(
+    "DownloadsPage", {"data": List[Download], "links": Any, "meta": Any}, total=False
+)
+
+# MGnify sample or run (with the sample included)
+SampleAttributes = TypedDict("SampleAttributes", {"sample-metadata": Any}, total=False)
+SampleRelationships = TypedDict("SampleRelationships", {"biome": Any}, total=False)
+Sample = TypedDict(
+    "Sample",
+    {
+        "id": Any,
+        "attributes": SampleAttributes,
+        "relationships": SampleRelationships,
+    },
+    total=False,
+)
+SampleResponse = TypedDict(
+    "SampleResponse", {"data": Sample, "included": List[Sample]}, total=False
+)
+SamplesPage = TypedDict(
+    "SamplesPage", {"data": List[Sample], "links": Any, "meta": Any}, total=False
+)
+
+# HMMER search, the hits hold the alignments of every domain
+Hit = TypedDict(
+    "Hit",
+    {
+        "name": Any,
+        "kg": Any,
+        "taxid": Any,
+        "desc": Any,
+        "pvalue": Any,
+        "species": Any,
+        "score": Any,
+        "evalue": Any,
+        "nreported": Any,
+        "uniprot_link": Any,
+        "mgnify": Any,
+    },
+    total=False,
+)
+SearchResults = TypedDict(
+    "SearchResults", {"uuid": Any, "hits": List[Hit]}, total=False
+)
+SearchResponse = TypedDict(
+    "SearchResponse", {"status": Any, "results": SearchResults}, total=False
+)
+
+_decoders = dict()
+
+
+def loads(content):
+    """Decode a complete JSON document, from bytes or str."""
+    if orjson is not None:
+        return orjson.loads(content)
+    if msgspec is not None:
+        try:
+            return msgspec.json.decode(content)
+        except msgspec.DecodeError as e:
+            raise _decode_error(e, content)
+    return json.loads(content)
+
+
+def decode(content, schema=None):
+    """Decode the keys of the schema from a JSON document.
+    Without msgspec, or without schema, the whole document is decoded.
+    Raises json.JSONDecodeError if the document isn't valid.
+    """
+    if schema is None or msgspec is None:
+        return loads(content)
+    decoder = _decoders.get(schema)
+    if decoder is None:
+        decoder = _decoders[schema] = msgspec.json.Decoder(schema)
+    try:
+        return decoder.decode(content)
+    except msgspec.ValidationError as e:
+        logger.debug("Response doesn't match %s: %s" % (schema.__name__, e))
+        return loads(content)
+    except msgspec.DecodeError as e:
+        raise _decode_error(e, content)
+
+
+def response_json(response, schema=None):
+    """Decode the body of a requests response, see decode."""
+    return decode(response.content, schema)
+
+
+def _decode_error(error, content):
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", "replace")
+    return json.JSONDecodeError(str(error), content, 0)
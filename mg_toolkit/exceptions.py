@@ -18,14 +18,19 @@
 class FailToGetException(Exception):
     """Fail to get an url exception"""
 
-    def __init__(self, url, status_code, message, *arg, **kwargs):
+    def __init__(self, url, status_code, message=None, *arg, **kwargs):
         self.url = url
         self.status_code = status_code
-        message = "Failed to get URL: %s. HTTP Status Code: %s" % (
+        self.message = message or "Failed to get URL: %s. HTTP Status Code: %s" % (
             self.url,
             self.status_code,
         )
-        super().__init__(message)
+        super().__init__(self.message)
 
-    def __str__(self):
-        print(self.message)
+
+class DownloadStalled(IOError):
+    """The throughput of a download stayed under the floor"""
+
+
+class DownloadCancelled(IOError):
+    """The run was interrupted during the download"""
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import logging
+import mmap
+import os
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b"\x1f\x8b"
+# not .fai, the index isn't in the samtools format
+INDEX_SUFFIX = ".mgidx"
+
+
+def open_fasta(file_path):
+    """Open a fasta file for reading as text.
+    gzip and bgzip compressed files are detected from the magic number.
+    """
+    with open(file_path, "rb") as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(file_path, "rt")
+    return open(file_path, "r")
+
+
+def iter_fasta(file_path):
+    """
+    Read a fasta file one record at a time.
+    Yields (query_id, sequence) tuples, the query_id is the header line
+    without the ">". Lines before the first header are skipped.
+    """
+    query_id = None
+    chunks = []
+    with open_fasta(file_path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.startswith(">"):
+                if query_id is not None:
+                    yield query_id, "".join(chunks)
+                query_id = line[1:].strip()
+                chunks = []
+            elif query_id is None:
+                if line.strip():
+                    logger.warning(
+                        "Skipping line %s of %s, it's before the first header"
+                        % (line_number, file_path)
+                    )
+            else:
+                chunks.append(line.strip())
+    if query_id is not None:
+        yield query_id, "".join(chunks)
+
+
+class FastaIndex:
+    """
+    Byte offset index of a fasta file, in the columns of the samtools .fai.
+
+    Each record has the name (the query_id, the whole header line as read
+    by iter_fasta), the sequence length, the offset of the first base, the
+    bases per line and the bytes per line. Records with uneven line lengths
+    get 0 bases per line and the bytes spanned by the sequence as bytes per
+    line. samtools doesn't accept either, so the index is kept in
+    <fasta>.mgidx and a samtools index isn't used.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, file_path):
+        """Index the fasta file with a single sequential scan."""
+        entries = []
+        record = None
+        offset = 0
+
+        def _close(record, end):
+            name, length, start, line_lengths = record
+            line_bases = line_lengths[0][0] if line_lengths else 0
+            line_width = line_lengths[0][1] if line_lengths else 0
+            # all lines but the last one must have the same length
+            if any(lengths != line_lengths[0] for lengths in line_lengths[:-1]) or (
+                line_lengths and line_lengths[-1][0] > line_bases
+            ):
+                line_bases, line_width = 0, end - start
+            return name, length, start, line_bases, line_width
+
+        with open(file_path, "rb") as f:
+            if f.read(2) == GZIP_MAGIC:
+                raise ValueError(
+                    "%s is compressed, only plain fasta files can be indexed"
+                    % file_path
+                )
+            f.seek(0)
+            for line in f:
+                if line.startswith(b">"):
+                    if record is not None:
+                        entries.append(_close(record, offset))
+                    name = line[1:].decode("utf-8").strip()
+                    record = [name, 0, offset + len(line), []]
+                elif record is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    record[1] += bases
+                    record[3].append((bases, len(line)))
+                offset += len(line)
+        if record is not None:
+            entries.append(_close(record, offset))
+        return cls(entries)
+
+    @classmethod
+    def load(cls, index_path):
+        entries = []
+        with open(index_path, "r") as f:
+            for line in f:
+                name, length, offset, line_bases, line_width = line.rstrip("\n").rsplit(
+                    "\t", 4
+                )
+                entries.append(
+                    (name, int(length), int(offset), int(line_bases), int(line_width))
+                )
+        return cls(entries)
+
+    def write(self, index_path):
+        index_path_tmp = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(index_path_tmp, "w") as f:
+            for entry in self.entries:
+                f.write("\t".join(str(field) for field in entry) + "\n")
+        os.replace(index_path_tmp, index_path)
+
+    @classmethod
+    def for_file(cls, file_path):
+        """Load the <fasta>.mgidx index, building it if missing or outdated."""
+        index_path = file_path + INDEX_SUFFIX
+        if os.path.exists(index_path) and os.path.getmtime(
+            index_path
+        ) >= os.path.getmtime(file_path):
+            return cls.load(index_path)
+        logger.info("Indexing %s" % file_path)
+        index = cls.build(file_path)
+        index.write(index_path)
+        return index
+
+    def select(self, shard=None, ids=None):
+        """Entries of the shard (index, count), index starts at 1, and/or with
+        the query_id, or its first word, in ids.
+        """
+        entries = self.entries
+        if ids is not None:
+            entries = [e for e in entries if e[0] in ids or _first_word(e[0]) in ids]
+        if shard is not None:
+            index, count = shard
+            entries = entries[
+                (index - 1) * len(entries) // count : index * len(entries) // count
+            ]
+        return entries
+
+
+def _first_word(name):
+    """First word of the header, empty for a bare >"""
+    words = name.split(maxsplit=1)
+    return words[0] if words else ""
+
+
+def _span(length, line_bases, line_width):
+    """Bytes between the first and the last base of a record."""
+    if not line_bases:
+        return line_width
+    full_lines, rest = divmod(length, line_bases)
+    return full_lines * line_width + rest
+
+
+def iter_indexed_fasta(file_path, shard=None, ids=None):
+    """
+    Read the records of a shard, or with the given ids, from a fasta file
+    using its byte offset index and a memory map. Only the selected
+    records are read.
+    """
+    entries = FastaIndex.for_file(file_path).select(shard=shard, ids=ids)
+    if not entries:
+        return
+    with open(file_path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        for name, length, offset, line_bases, line_width in entries:
+            raw = mm[offset : offset + _span(length, line_bases, line_width)]
+            yield name, raw.replace(b"\n", b"").replace(b"\r", b"").decode("utf-8")
+
+
+def read_ids(file_path):
+    """Query ids to search, one per line."""
+    with open(file_path, "r") as f:
+        return {line.strip() for line in f if line.strip()}
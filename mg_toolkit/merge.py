@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Study wide matrices of the per analysis taxonomic and functional tables.
+
+The tables of the same download type (group type and description, e.g. the
+SSU OTU tables) are merged into one sparse matrix of features by analyses.
+Only the known count tables are merged, see TABLE_PARSERS. The files are
+parsed in a process pool, each one is read once and only the counts are
+kept, as (feature, analysis, count) triplets.
+"""
+
+import csv
+import gzip
+import logging
+import os
+import re
+import zlib
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .verify import expected_files
+
+logger = logging.getLogger(__name__)
+
+MERGE_GROUPS = ("taxonomic_analysis", "functional_analysis")
+OUTPUT_FORMATS = ("mtx", "parquet")
+
+# the tables merged, by words of the download description and file
+# extensions, the other files are left out
+TABLE_PARSERS = (
+    ("otus, counts and taxonomic assignments", (".tsv", ".tsv.gz"), "otu"),
+    ("krona", (".txt", ".txt.gz"), "krona"),
+    ("taxonomic assignments", (".txt", ".txt.gz"), "krona"),
+    ("go slim", (".csv", ".csv.gz"), "go"),
+    ("go annotation", (".csv", ".csv.gz"), "go"),
+    ("interpro", (".tsv",), "interpro"),
+    ("pfam", (".tsv",), "pfam"),
+    ("kegg ortholog", (".tsv",), "kegg"),
+)
+
+# accession of the features of the summary tables
+ACCESSIONS = {
+    "interpro": re.compile(r"^IPR\d{6}$"),
+    "pfam": re.compile(r"^PF\d{5}$"),
+    "kegg": re.compile(r"^K\d{5}$"),
+}
+# columns of the summary tables, accession, count and description, in any
+# order. Longer rows are from a matches file.
+SUMMARY_COLUMNS = 4
+
+
+def table_parser(description, name):
+    """Name of the parser of the download, None if it isn't merged."""
+    description = description.lower()
+    name = name.lower()
+    for words, extensions, parser in TABLE_PARSERS:
+        if words in description and name.endswith(extensions):
+            return parser
+    return None
+
+
+def merge(args):
+    """Merge the tables of a study downloaded by bulk_download."""
+    project_id = args.accession
+    output_path = args.output_path or os.getcwd()
+    output_format = getattr(args, "format", None) or "mtx"
+    metadata_file = os.path.join(
+        output_path, project_id, "{}_metadata.tsv".format(project_id)
+    )
+    if not os.path.exists(metadata_file):
+        logger.error("%s not found, run bulk_download first" % metadata_file)
+        return 1
+    merged_dir = args.merged_path or os.path.join(output_path, project_id, "merged")
+    os.makedirs(merged_dir, exist_ok=True)
+
+    with open(metadata_file) as f:
+        rows = list(csv.DictReader(f, delimiter="\t"))
+    tables = list(
+        table_files(rows, output_path, project_id, result_group=args.result_group)
+    )
+    logger.info("%s tables to merge" % len(tables))
+
+    matrices = OrderedDict()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = executor.map(
+            read_counts,
+            [table["path"] for table in tables],
+            [table["parser"] for table in tables],
+            chunksize=4,
+        )
+        for table, counts in zip(tables, results):
+            if counts is None:
+                failed += 1
+                continue
+            key = (table["group_type"], table["description"])
+            matrix = matrices.get(key)
+            if matrix is None:
+                matrix = matrices[key] = SparseCounts()
+            matrix.add(table["analysis_id"], *counts)
+
+    for (group_type, description), matrix in matrices.items():
+        name = slugify(group_type + " " + description)
+        matrix.write(os.path.join(merged_dir, name), output_format=output_format)
+        print(
+            "{}: {} features x {} analyses, {} counts".format(
+                name, len(matrix.features), len(matrix.analyses), matrix.nnz
+            )
+        )
+    if failed:
+        logger.warning(
+            "%s tables couldn't be read, check them with the verify command" % failed
+        )
+    return 0
+
+
+def table_files(rows, output_path, project_id, result_group=None):
+    """The downloaded tables of the groups to merge, from the rows of the
+    metadata file. Tables that weren't downloaded are left out.
+    """
+    skipped = Counter()
+    for entry in expected_files(rows, output_path, project_id):
+        if result_group:
+            if entry["group"] != result_group:
+                continue
+        elif not entry["group"].startswith(MERGE_GROUPS):
+            continue
+        row = entry["row"]
+        parser = table_parser(row["description"], row["name"])
+        if parser is None:
+            skipped[row["description"]] += 1
+            continue
+        if not os.path.exists(entry["path"]):
+            logger.warning("%s is missing, skipping it" % entry["path"])
+            continue
+        yield {
+            "path": entry["path"],
+            "parser": parser,
+            "analysis_id": row["analysis_id"],
+            "group_type": row["group_type"],
+            "description": row["description"],
+        }
+    for description, count in skipped.items():
+        logger.warning("Not merging the %s files of %s" % (count, description))
+
+
+def read_counts(path, parser):
+    """Read the counts of a table with the parser, see TABLE_PARSERS.
+    Returns (counts, descriptions) dicts keyed by feature, or None if the
+    file can't be read.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    delimiter = "," if parser == "go" else "\t"
+    counts = dict()
+    descriptions = dict()
+    try:
+        with opener(path, "rt", newline="") as f:
+            rows = (
+                row
+                for row in csv.reader(f, delimiter=delimiter)
+                if row and not row[0].startswith("#")
+            )
+            if parser in ACCESSIONS:
+                parsed = _summary_rows(rows, ACCESSIONS[parser])
+            else:
+                parsed = _PARSERS[parser](rows)
+            for feature, count, description in parsed:
+                counts[feature] = counts.get(feature, 0) + count
+                if feature not in descriptions:
+                    descriptions[feature] = description
+    except (OSError, EOFError, UnicodeDecodeError, csv.Error, zlib.error) as e:
+        logger.warning("Can't read %s, skipping it: %s" % (path, e))
+        return None
+    except (ValueError, IndexError) as e:
+        logger.warning("%s isn't a %s table, skipping it: %s" % (path, parser, e))
+        return None
+    return counts, descriptions
+
+
+def _otu_rows(rows):
+    """#OTU ID, count, taxonomy[, taxid]"""
+    for row in rows:
+        yield row[2], float(row[1]), ""
+
+
+def _krona_rows(rows):
+    """count, then the lineage one rank per column"""
+    for row in rows:
+        lineage = [rank for rank in row[1:] if rank]
+        yield ";".join(lineage), float(row[0]), ""
+
+
+def _go_rows(rows):
+    """GO term, description, category, count"""
+    for row in rows:
+        yield row[0], float(row[3]), "; ".join(row[1:3])
+
+
+def _summary_rows(rows, accession):
+    """accession, count and description columns, in any order"""
+    for row in rows:
+        if len(row) > SUMMARY_COLUMNS:
+            raise ValueError("{} columns".format(len(row)))
+        features = [value for value in row if accession.match(value)]
+        if not features:
+            # header
+            continue
+        counts = [value for value in row if value.isdigit()]
+        others = [value for value in row if value not in features + counts]
+        yield features[0], float(counts[0]), "; ".join(others)
+
+
+_PARSERS = {"otu": _otu_rows, "krona": _krona_rows, "go": _go_rows}
+
+
+class SparseCounts:
+    """Matrix of counts of features by analyses, kept as coordinates."""
+
+    def __init__(self):
+        self.features = dict()
+        self.descriptions = []
+        self.analyses = dict()
+        self._rows = array("q")
+        self._columns = array("q")
+        self._values = array("d")
+
+    @property
+    def nnz(self):
+        return len(self._values)
+
+    def add(self, analysis_id, counts, descriptions):
+        column = self.analyses.setdefault(analysis_id, len(self.analyses))
+        for feature, count in counts.items():
+            row = self.features.get(feature)
+            if row is None:
+                row = self.features[feature] = len(self.features)
+                self.descriptions.append(descriptions.get(feature, ""))
+            self._rows.append(row)
+            self._columns.append(column)
+            self._values.append(count)
+
+    def coordinates(self):
+        """Rows, columns and values sorted by column then row, the counts
+        of an analysis in several tables are summed.
+        """
+        rows = np.frombuffer(self._rows, dtype=np.int64)
+        columns = np.frombuffer(self._columns, dtype=np.int64)
+        values = np.frombuffer(self._values, dtype=np.float64)
+        if not len(values):
+            return rows, columns, values
+        order = np.lexsort((rows, columns))
+        rows, columns, values = rows[order], columns[order], values[order]
+        starts = np.flatnonzero(
+            np.r_[True, (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])]
+        )
+        return rows[starts], columns[starts], np.add.reduceat(values, starts)
+
+    def write(self, prefix, output_format="mtx"):
+        """Write <prefix>.mtx (Matrix Market) or <prefix>.parquet (feature,
+        analysis, count), with <prefix>.features.tsv and
+        <prefix>.analyses.tsv.
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unsupported output format: %s" % output_format)
+        rows, columns, values = self.coordinates()
+        features = list(self.features)
+        analyses = list(self.analyses)
+
+        if output_format == "parquet":
+            from pandas import Categorical, DataFrame
+
+            df = DataFrame(
+                {
+                    "feature": Categorical.from_codes(rows, features),
+                    "analysis": Categorical.from_codes(columns, analyses),
+                    "count": values,
+                }
+            )
+            _write_atomic(prefix + ".parquet", df.to_parquet)
+        else:
+
+            def _write_mtx(filename):
+                with open(filename, "w") as f:
+                    f.write("%%MatrixMarket matrix coordinate real general\n")
+                    f.write(
+                        "{} {} {}\n".format(len(features), len(analyses), len(values))
+                    )
+                    np.savetxt(
+                        f,
+                        np.column_stack((rows + 1, columns + 1, values)),
+                        fmt=("%d", "%d", "%.15g"),
+                    )
+
+            _write_atomic(prefix + ".mtx", _write_mtx)
+
+        def _write_features(filename):
+            with open(filename, "w", newline="") as f:
+                writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+                writer.writerow(["feature", "description"])
+                writer.writerows(zip(features, self.descriptions))
+
+        def _write_analyses(filename):
+            with open(filename, "w") as f:
+                f.write("analysis_id\n")
+                f.writelines(analysis + "\n" for analysis in analyses)
+
+        _write_atomic(prefix + ".features.tsv", _write_features)
+        _write_atomic(prefix + ".analyses.tsv", _write_analyses)
+
+
+def slugify(text):
+    return re.sub(r"[^0-9a-z]+", "_", text.lower()).strip("_")
+
+
+def _write_atomic(filename, write):
+    write(filename + ".tmp")
+    os.replace(filename + ".tmp", filename)
@@ -14,22 +14,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
+import os
 import xml.etree.ElementTree as ET
+from collections.abc import Mapping
 
 import requests
-from pandas import DataFrame
-from requests import Session
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
-
-from .constants import (
-    EBI_URL_PREFIX,
-    ENA_SEARCH_API_URL,
-    ENA_XML_VIEW_URL,
-    REQUESTS_RETRIES,
+from pandas import (
+    DataFrame,
+    Index,
+    Series,
+    notna,
+    read_csv,
+    read_feather,
+    read_parquet,
+    to_numeric,
 )
 
+from .constants import ENA_SEARCH_API_URL, ENA_XML_VIEW_URL
+from .decoding import response_json
+from .transport import get_session
+
 try:
     from json.decoder import JSONDecodeError
 except ImportError:
@@ -38,16 +44,77 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+OUTPUT_FORMATS = ("csv", "parquet", "feather")
+
 
 def original_metadata(args):
     """
     Process given accessions
     """
+    output_format = getattr(args, "format", None) or "csv"
+    if output_format != "csv":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            logger.error(
+                "The %s format requires pyarrow, "
+                "install it with: pip install mg-toolkit[parquet]" % output_format
+            )
+            return 1
 
     for accession in args.accession:
         logger.debug("Accession %s" % accession)
         om = OriginalMetadata(accession)
-        om.save_to_csv(om.fetch_metadata())
+        if getattr(args, "update", False):
+            om.update(output_format=output_format)
+        else:
+            om.save(om.iter_metadata(), output_format=output_format)
+
+
+class MetadataTable:
+    """
+    Column oriented table of sample metadata, filled one run at a time.
+
+    Every column only keeps the cells that are set, which keeps wide and
+    sparse sets of sample attributes small until the table is written.
+    """
+
+    def __init__(self):
+        self.index = []
+        self.columns = dict()
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, run, record):
+        row = len(self.index)
+        self.index.append(run)
+        for key, value in record.items():
+            self.columns.setdefault(key, {})[row] = value
+
+    def to_frame(self, typed=False):
+        """Build the DataFrame, columns are sorted by name.
+        If typed is set the columns where every value parses as a number are
+        converted to numeric dtypes.
+        """
+        data = dict()
+        for key in sorted(self.columns):
+            cells = self.columns[key]
+            values = Series([cells.get(row) for row in range(len(self.index))])
+            if typed:
+                values = _to_numeric(values)
+            data[key] = values
+        df = DataFrame(data)
+        df.index = Index(self.index, name="Run")
+        return df
+
+
+def _to_numeric(values):
+    """Convert the series to a numeric one, if all the non-null values parse."""
+    numeric = to_numeric(values, errors="coerce")
+    if numeric.notna().sum() != values.notna().sum():
+        return values
+    return numeric
 
 
 class OriginalMetadata:
@@ -61,13 +128,7 @@ class OriginalMetadata:
     def __init__(self, accession, *args, **kwargs):
         self.accession = accession
 
-        self.session = Session()
-        retries = Retry(
-            total=REQUESTS_RETRIES,
-            backoff_factor=0.1,
-            status_forcelist=[500, 502, 503, 504],
-        )
-        self.session.mount(EBI_URL_PREFIX, HTTPAdapter(max_retries=retries))
+        self.session = get_session()
 
     def get_metadata(self, sample_accession):
         """Get the sample metadata from ENA API."""
@@ -107,6 +168,13 @@ class OriginalMetadata:
 
     def fetch_metadata(self):
         """Get metadata from ENA API."""
+        return dict(self.iter_metadata())
+
+    def fetch_runs(self):
+        """Get the runs of the study from the ENA portal API.
+        Returns a dict of run accession -> sample accession, read depth and
+        last updated date, or None if the listing failed.
+        """
         response = self.session.get(
             ENA_SEARCH_API_URL,
             params={
@@ -123,6 +191,7 @@ class OriginalMetadata:
                         "secondary_sample_accession",
                         "sample_accession",
                         "depth",
+                        "last_updated",
                     ]
                 ),
                 "format": "json",
@@ -143,7 +212,7 @@ class OriginalMetadata:
             return
 
         try:
-            response_data = response.json()
+            response_data = response_json(response)
         except JSONDecodeError:
             logger.error(
                 "Error decoding ENA sample_metadata response for accession: "
@@ -151,34 +220,137 @@ class OriginalMetadata:
             )
             return
 
-        _accessions = {
+        return {
             r["run_accession"]: {
                 "sample_accession": r["secondary_sample_accession"],
                 "read_depth": r["depth"],
+                "last_updated": r.get("last_updated"),
             }
             for r in response_data
         }
 
-        meta_csv = dict()
-        _sample = None
-        _meta = None
+    def iter_metadata(self, runs=None):
+        """Yield the metadata of each run as (run accession, metadata) pairs.
+        Runs defaults to the full ENA listing of the study.
+        """
+        if runs is None:
+            runs = self.fetch_runs() or {}
+
+        for run, sample in runs.items():
+            _meta = self.get_metadata(sample["sample_accession"]) or {}
+            _meta["Sample"] = sample["sample_accession"]
+            _meta["Read depth"] = sample["read_depth"]
+            yield run, _meta
+
+    def update(self, filename=None, output_format="csv"):
+        """Refresh an existing output file.
+        Only the runs that are new, or whose ENA last updated date changed
+        since the previous update, are fetched again. Runs no longer listed
+        in ENA are dropped. The last updated dates are kept in a
+        <filename>.state.json file next to the output, runs of an output
+        without that file are considered up to date.
+        """
+        if filename is None:
+            filename = "{}.{}".format(self.accession, output_format)
+        if not os.path.exists(filename):
+            logger.info("%s doesn't exist, fetching all the runs" % filename)
+            existing, state = {}, {}
+        else:
+            existing = read_table(filename, output_format)
+            state = _read_state(filename)
+
+        runs = self.fetch_runs()
+        if runs is None:
+            logger.error("Failed to list the runs for %s" % self.accession)
+            return
 
-        for run, sample in _accessions.items():
-            if sample != _sample:
-                _meta = self.get_metadata(sample["sample_accession"])
-            meta_csv[run] = _meta
-            meta_csv[run]["Sample"] = sample["sample_accession"]
-            meta_csv[run]["Read depth"] = sample["read_depth"]
-            _sample = sample["sample_accession"]
+        affected = {
+            run: sample
+            for run, sample in runs.items()
+            if run not in existing
+            or (run in state and state[run] != sample["last_updated"])
+        }
+        logger.info(
+            "%s: %s runs listed, %s new or updated"
+            % (self.accession, len(runs), len(affected))
+        )
 
-        return meta_csv
+        fetched = dict(self.iter_metadata(affected))
+        self.save(
+            ((run, fetched.get(run) or existing[run]) for run in runs),
+            filename=filename,
+            output_format=output_format,
+        )
+        _write_state(
+            filename, {run: sample["last_updated"] for run, sample in runs.items()}
+        )
 
     def save_to_csv(self, meta_csv, filename=None):
         """Store the CSV in a file"""
-        df = DataFrame(meta_csv).T
-        df.index.name = "Run"
+        self.save(meta_csv, filename=filename, output_format="csv")
+
+    def save(self, records, filename=None, output_format="csv"):
+        """Store the metadata in a csv, parquet or feather file.
+        Records can be a dict of run -> metadata or an iterable of
+        (run, metadata) pairs. The table is built column by column as the
+        records arrive. Parquet and feather files get numeric columns
+        where the values parse.
+        The file is replaced atomically.
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unsupported output format: %s" % output_format)
+        if isinstance(records, Mapping):
+            records = records.items()
+
+        table = MetadataTable()
+        for run, record in records:
+            table.append(run, record)
+
         if filename is None:
-            filename = "{}.csv".format(self.accession)
-        # Sort the columns
-        df = df.reindex(sorted(df.columns), axis=1)
-        df.to_csv(filename)
+            filename = "{}.{}".format(self.accession, output_format)
+
+        df = table.to_frame(typed=output_format != "csv")
+        filename_tmp = filename + ".tmp"
+        if output_format == "parquet":
+            df.to_parquet(filename_tmp)
+        elif output_format == "feather":
+            # feather doesn't store the index
+            df.reset_index().to_feather(filename_tmp)
+        else:
+            df.to_csv(filename_tmp)
+        os.replace(filename_tmp, filename)
+
+
+def read_table(filename, output_format="csv"):
+    """Read an original_metadata output file back into a dict of
+    run -> metadata, the missing cells are left out.
+    """
+    if output_format == "parquet":
+        df = read_parquet(filename)
+    elif output_format == "feather":
+        df = read_feather(filename).set_index("Run")
+    else:
+        df = read_csv(filename, dtype=str, keep_default_na=False, index_col="Run")
+    return {
+        run: {key: value for key, value in row.items() if notna(value)}
+        for run, row in zip(df.index, df.to_dict("records"))
+    }
+
+
+def _state_file(filename):
+    return filename + ".state.json"
+
+
+def _read_state(filename):
+    try:
+        with open(_state_file(filename)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_state(filename, state):
+    state_file = _state_file(filename)
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_file + ".tmp", state_file)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Profiling of a tool run.
+
+cProfile only sees the main thread, while the tools do most of their work
+in thread pools, so the run is profiled by sampling the stacks of all the
+threads at a fixed interval. The summary lists the functions where the
+samples were taken (self) and the ones on the stack (total).
+"""
+
+import sys
+import threading
+import time
+from collections import Counter
+
+# seconds between two samples
+SAMPLE_INTERVAL = 0.005
+
+SUMMARY_LIMIT = 40
+
+
+class SamplingProfiler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.own = Counter()
+        self.total = Counter()
+        self.threads = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self.elapsed = 0
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self._started
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        names = dict()
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == threading.get_ident():
+                    continue
+                self.sample(frame, names.get(ident, str(ident)))
+
+    def sample(self, frame, thread_name):
+        self.samples += 1
+        self.threads[thread_name] += 1
+        self.own[_label(frame)] += 1
+        seen = set()
+        while frame is not None:
+            label = _label(frame)
+            if label not in seen:
+                # recursive calls only count once per sample
+                seen.add(label)
+                self.total[label] += 1
+            frame = frame.f_back
+
+    def summary(self, limit=SUMMARY_LIMIT):
+        lines = [
+            "{} samples every {:g}ms over {:.3f}s".format(
+                self.samples, self.interval * 1000, self.elapsed
+            ),
+            "",
+            "samples per thread",
+        ]
+        for name, count in self.threads.most_common():
+            lines.append("{:>8}  {}".format(count, name))
+        for title, counter in (("self", self.own), ("total", self.total)):
+            lines += ["", "{:>8}  {:>6}  function ({})".format("samples", "%", title)]
+            for label, count in counter.most_common(limit):
+                lines.append(
+                    "{:>8}  {:>6.1%}  {}".format(
+                        count, count / max(self.samples, 1), label
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            f.write(self.summary())
+
+
+def _label(frame):
+    code = frame.f_code
+    return "{}:{}({})".format(code.co_filename, code.co_firstlineno, code.co_name)
@@ -16,30 +16,57 @@
 
 import html
 import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
 import requests
 from pandas import DataFrame
 
-from .constants import MG_RUN_URL, MG_SAMPLE_URL, MG_SEQ_URL
+from .cache import SearchCache
+from .constants import (
+    MG_RUN_URL,
+    MG_SAMPLE_URL,
+    MG_SAMPLES_ACCESSION_FILTER,
+    MG_SAMPLES_URL,
+    MG_SEQ_RESULTS_URL,
+    MG_SEQ_URL,
+)
+from .decoding import SampleResponse, SamplesPage, SearchResponse, response_json
+from .fasta import iter_fasta, iter_indexed_fasta, read_ids
+from .transport import ToolkitAdapter, get_session, queued
+from .writers import Checkpoint, ResultWriter, csv_to_parquet, parquet_to_csv
 
 logger = logging.getLogger(__name__)
 
+SAMPLE_ACCESSION_PREFIXES = ("ERS", "SRS", "DRS", "SAMEA", "SAMN", "SAMD")
+RUN_ACCESSION_PREFIXES = ("ERR", "SRR", "DRR")
+
+# columns set by results_to_df, metadata keys with these names are dropped
+RESERVED_COLUMNS = ("query_id", "accession", "subject_id", "name")
+
+# maximum number of samples requested at once from the samples list
+BULK_REQUEST_SIZE = 50
+
 
 def parse_fasta_file(file_path):
     """
     Parse fasta file
     """
-    sequences = {}
-    query_id = None
-    with open(file_path, "r") as f:
-        for line in f:
-            if line.startswith(">"):
-                query_id = line[1:].strip()
-                sequences[query_id] = ""
-            else:
-                sequences[query_id] += line.strip()
-    return sequences
+    return dict(iter_fasta(file_path))
+
+
+def check_job_options(args):
+    """The submitted jobs are kept in the checkpoint."""
+    if (args.get("submit_only") or args.get("fetch_only")) and not args.get(
+        "checkpoint"
+    ):
+        raise ValueError("--submit-only and --fetch-only require a --checkpoint")
 
 
 def sequence_search(args):
@@ -47,55 +74,266 @@ def sequence_search(args):
     Process given fasta file
     """
     args = vars(args)
-    out_df = DataFrame()
-    for s in args.pop("sequence"):
-        sequences = parse_fasta_file(s)
-        for sequence_data in sequences.items():
-            query_id = sequence_data[0]
-            sequence = sequence_data[1]
-            print("Proccessing: {}".format(query_id))
-            # Search MgnifyDB
-            seq = SequenceSearch(
-                sequence,
-                query_id,
-                database=args.pop("database", "full"),
-                seq_evalue_threshold=args.pop("seq_evalue_threshold", None),
-                hit_evalue_threshold=args.pop("hit_evalue_threshold", None),
-                report_seq_evalue_threshold=args.pop(
-                    "report_seq_evalue_threshold", None
-                ),
-                report_hit_evalue_threshold=args.pop(
-                    "report_hit_evalue_threshold", None
-                ),
-                seq_bitscore_threshold=args.pop("seq_bitscore_threshold", None),
-                hit_bitscore_threshold=args.pop("hit_bitscore_threshold", None),
-                report_seq_bitscore_threshold=args.pop(
-                    "report_seq_bitscore_threshold", None
-                ),
-                report_hit_bitscore_threshold=args.pop(
-                    "report_hit_bitscore_threshold", None
+    check_job_options(args)
+    search_kwargs = dict(
+        database=args.pop("database", "full"),
+        seq_evalue_threshold=args.pop("seq_evalue_threshold", None),
+        hit_evalue_threshold=args.pop("hit_evalue_threshold", None),
+        report_seq_evalue_threshold=args.pop("report_seq_evalue_threshold", None),
+        report_hit_evalue_threshold=args.pop("report_hit_evalue_threshold", None),
+        seq_bitscore_threshold=args.pop("seq_bitscore_threshold", None),
+        hit_bitscore_threshold=args.pop("hit_bitscore_threshold", None),
+        report_seq_bitscore_threshold=args.pop("report_seq_bitscore_threshold", None),
+        report_hit_bitscore_threshold=args.pop("report_hit_bitscore_threshold", None),
+        enrichment_workers=args.pop("enrichment_workers", None),
+        search_timeout=args.pop("search_timeout", None),
+        # sample metadata and connections shared by all the queries
+        metadata_cache=MetadataCache(),
+    )
+    search_kwargs["session"] = get_session()
+
+    # the cache also makes the duplicated sequences of the run search once
+    cache_dir = args.pop("cache_dir", None)
+    tmp_cache_dir = None
+    if not cache_dir:
+        cache_dir = tmp_cache_dir = tempfile.mkdtemp(prefix="mg_toolkit_search_")
+    cache_ttl = args.pop("cache_ttl", None)
+    cache_max_size = args.pop("cache_max_size", None)
+    search_kwargs["search_cache"] = SearchCache(
+        cache_dir,
+        ttl=cache_ttl * 3600 if cache_ttl else None,
+        max_size=cache_max_size * 1024 * 1024 if cache_max_size else None,
+    )
+    try:
+        return _sequence_search(args, search_kwargs)
+    finally:
+        if tmp_cache_dir:
+            shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+
+
+def _sequence_search(args, search_kwargs):
+    workers = args.pop("workers", None) or 1
+    max_searches = args.pop("max_searches", None) or workers
+    # cap the number of searches running against MG_SEQ_URL at the same time
+    search_slots = threading.BoundedSemaphore(max_searches)
+
+    poll_interval = args.pop("poll_interval", None) or 5
+    poll_timeout = args.pop("poll_timeout", None)
+
+    def _process(seq, response):
+        """Enrich the search response, returns (status, uuid, df, error)"""
+        if not response:
+            return "failed", None, None, "No response from HMMER"
+        # Only process results when the request returned data
+        results = response.get("results")
+        if not results:
+            return "no_results", None, None, None
+        job_uuid = results["uuid"]
+        logger.debug("Job %s" % job_uuid)
+        csv_rows = seq.fetch_results(results)
+        if not csv_rows:
+            return "no_results", job_uuid, None, None
+        return "done", job_uuid, seq.results_to_df(csv_rows, job_uuid), None
+
+    def _search(query):
+        query_id, sequence = query
+        print("Proccessing: {}".format(query_id))
+        # Search MgnifyDB
+        seq = SequenceSearch(sequence, query_id, **search_kwargs)
+        try:
+            with search_slots:
+                response = seq.analyse_sequence()
+            return (query_id,) + _process(seq, response)
+        except (requests.RequestException, ValueError) as e:
+            return query_id, "failed", None, None, str(e)
+
+    def _submit(query):
+        query_id, sequence = query
+        print("Submitting: {}".format(query_id))
+        seq = SequenceSearch(sequence, query_id, **search_kwargs)
+        try:
+            with search_slots:
+                job_uuid = seq.submit_search()
+        except (requests.RequestException, ValueError) as e:
+            return query_id, "failed", None, None, str(e)
+        logger.debug("Job %s submitted" % job_uuid)
+        return query_id, "submitted", job_uuid, None, None
+
+    def _fetch(job):
+        query_id, job_uuid = job
+        print("Fetching: {}".format(query_id))
+        seq = SequenceSearch(None, query_id, **search_kwargs)
+        try:
+            response = seq.poll_search(
+                job_uuid, interval=poll_interval, timeout=poll_timeout
+            )
+            return (query_id,) + _process(seq, response)
+        except (requests.RequestException, ValueError) as e:
+            # keep the job, so a later fetch can try again
+            return query_id, "submitted", job_uuid, None, str(e)
+
+    output_format = args.pop("format", None) or "csv"
+    output_file = args["output"]
+    writer = None
+    checkpoint = None
+    completed = set()
+    failed = 0
+    written = 0
+    if args.get("checkpoint"):
+        checkpoint = Checkpoint(args["checkpoint"])
+        completed = checkpoint.completed()
+        output_file = output_file or checkpoint.output
+        if completed:
+            logger.info(
+                "Resuming, %s queries completed, %s to retry"
+                % (len(completed), len(checkpoint.failed()))
+            )
+
+    def _open_writer(uuid):
+        nonlocal output_file
+        if not output_file:
+            output_file = "{}_sequence_search.{}".format(uuid, output_format)
+        partial_file = output_file
+        if output_format == "parquet":
+            partial_file = output_file + ".partial.csv"
+            if (
+                checkpoint is not None
+                and not os.path.exists(partial_file)
+                and os.path.exists(output_file)
+            ):
+                # carry on from the results of the previous run
+                parquet_to_csv(output_file, partial_file)
+        if checkpoint is not None:
+            checkpoint.set_output(output_file)
+        return ResultWriter(
+            partial_file,
+            # rows of queries not in the journal are from an interrupted run
+            keep_query_ids=completed if checkpoint is not None else None,
+        )
+
+    submit_only = args.pop("submit_only", False)
+    fetch_only = args.pop("fetch_only", False)
+
+    if output_file and checkpoint is not None and checkpoint.output and not submit_only:
+        writer = _open_writer(None)
+
+    if fetch_only:
+        task = _fetch
+        queries = sorted(checkpoint.submitted().items())
+        logger.info("Fetching the results of %s jobs" % len(queries))
+    else:
+        shard = args.pop("shard", None)
+        ids = args.pop("ids", None)
+        if shard or ids:
+            ids = read_ids(ids) if ids else None
+            records = (
+                query
+                for s in args.pop("sequence")
+                for query in iter_indexed_fasta(s, shard=shard, ids=ids)
+            )
+        else:
+            records = (query for s in args.pop("sequence") for query in iter_fasta(s))
+        if submit_only:
+            task = _submit
+            skip = completed | set(checkpoint.submitted())
+        else:
+            task = _search
+            skip = completed
+        queries = (query for query in records if query[0] not in skip)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # the completed queries wait behind a slow one, keep more of them
+            # in flight than workers so the workers stay busy
+            for query_id, status, uuid, df, error in _imap(
+                executor, task, queries, window=2 * workers
+            ):
+                if status == "failed":
+                    failed += 1
+                    logger.error("Search failed for %s: %s" % (query_id, error))
+                elif status == "submitted":
+                    if error:
+                        failed += 1
+                        logger.error(
+                            "Fetching the results of %s failed: %s" % (query_id, error)
+                        )
+                    if checkpoint.queries.get(query_id, {}).get("uuid") == uuid:
+                        # already in the journal
+                        continue
+                elif status == "no_results":
+                    logger.warning("No results to report for %s" % query_id)
+                else:
+                    if writer is None:
+                        writer = _open_writer(uuid)
+                    writer.write(df)
+                    written += 1
+                if checkpoint is not None:
+                    checkpoint.record(query_id, status, uuid=uuid, error=error)
+    finally:
+        if writer is not None:
+            writer.close()
+        if checkpoint is not None:
+            checkpoint.close()
+
+    if failed:
+        logger.warning(
+            "%s queries failed%s"
+            % (
+                failed,
+                (
+                    ", run again with the same --checkpoint to retry them"
+                    if checkpoint is not None
+                    else ""
                 ),
             )
-            response = seq.analyse_sequence()
-            if not response:
-                logger.warning("No results to report for %s" % query_id)
-                return
-            # Only process results when the request returned data
-            results = response.get("results")
-            if results:
-                job_uuid = results["uuid"]
-                logger.debug("Job %s" % job_uuid)
-                out_df = pd.concat(
-                    [out_df, seq.results_to_df(seq.fetch_results(results), job_uuid)]
-                )
-            else:
-                logger.warning("No results to report for %s" % query_id)
-
-    output_file = job_uuid + "_sequence_search.csv"
-    if args["output"]:
-        output_file = args["output"]
-
-    out_df.to_csv(output_file, index=False)
+        )
+    if submit_only:
+        logger.info("Jobs recorded in %s" % checkpoint.filename)
+    elif writer is None:
+        logger.warning("No results to report")
+    elif output_format == "parquet":
+        if written or not os.path.exists(output_file):
+            csv_to_parquet(writer.filename, output_file)
+        if checkpoint is None:
+            # otherwise kept to append the results of the next run
+            os.remove(writer.filename)
+
+
+def get_accession_type(accession):
+    """Guess if the accession is a "sample" or a "run" from its prefix.
+    Returns None for unknown prefixes.
+    """
+    if accession.startswith(SAMPLE_ACCESSION_PREFIXES):
+        return "sample"
+    if accession.startswith(RUN_ACCESSION_PREFIXES):
+        return "run"
+    return None
+
+
+class MetadataCache(dict):
+    """Accession -> sample metadata, shared by the searches of a run."""
+
+    # set to False if the samples list endpoint ignores the accession filter
+    bulk_samples = True
+
+
+def _imap(executor, fn, iterable, window):
+    """Map fn over iterable with the executor, yielding the results in the
+    order of the iterable, so the output doesn't depend on the number of
+    workers. At most window calls are running or waiting to be yielded at
+    any time, the iterable is consumed lazily.
+    """
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(queued(fn), item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
 
 
 class SequenceSearch(object):
@@ -127,8 +365,20 @@ class SequenceSearch(object):
         self.report_hit_bitscore_threshold = kwargs.pop(
             "report_hit_bitscore_threshold", None
         )
+        # accession -> sample metadata, can be shared by several searches
+        metadata_cache = kwargs.pop("metadata_cache", None)
+        if metadata_cache is None:
+            metadata_cache = MetadataCache()
+        self.metadata_cache = metadata_cache
+        self.enrichment_workers = kwargs.pop("enrichment_workers", None) or 4
+        self.session = kwargs.pop("session", None) or get_session()
+        self.search_cache = kwargs.pop("search_cache", None)
+        # the HMMER search blocks until it's finished, so --read-timeout
+        # doesn't apply to it
+        self.search_timeout = kwargs.pop("search_timeout", None)
 
-    def analyse_sequence(self):
+    def search_data(self):
+        """POST data of the HMMER search."""
         data = {
             "seqdb": self.database,
             "seq": self.sequence,
@@ -149,16 +399,93 @@ class SequenceSearch(object):
             data["T"] = self.report_seq_bitscore_threshold
         if self.report_hit_bitscore_threshold is not None:
             data["domT"] = self.report_hit_bitscore_threshold
+        return data
+
+    def analyse_sequence(self):
+        data = self.search_data()
+        if self.search_cache is None:
+            return self.post_search(data)
 
+        key = self.search_cache.key(data)
+        # identical searches wait for each other and reuse the response
+        with self.search_cache.lock(key):
+            response = self.search_cache.get(key)
+            if response is None:
+                response = self.post_search(data)
+                if response:
+                    self.search_cache.set(key, response)
+        return response
+
+    def submit_search(self):
+        """
+        Submit the search without waiting for the results.
+        Returns the job uuid, the results are collected with poll_search.
+        """
+        data = self.search_data()
         headers = {
             "Accept": "application/json",
             "Content-Type": "application/x-www-form-urlencoded",
         }
         logger.debug("POST: %r" % data)
-        request_data = requests.post(MG_SEQ_URL, data=data, headers=headers)
+        r = self.session.post(
+            MG_SEQ_URL, data=data, headers=headers, allow_redirects=False
+        )
+        if r.is_redirect:
+            # redirected to the results page of the job
+            match = re.search(r"/results/([^/?#]+)", r.headers["Location"])
+            if match:
+                return match.group(1)
+        elif r.ok:
+            # the search already finished
+            return response_json(r, SearchResponse)["results"]["uuid"]
+        r.raise_for_status()
+        raise ValueError("No job uuid in the HMMER response")
+
+    def fetch_search(self, uuid):
+        """Get the results of a submitted search, None while it's running."""
+        r = self.session.get(
+            MG_SEQ_RESULTS_URL.format(uuid=uuid),
+            headers={"Accept": "application/json"},
+        )
+        if r.status_code == requests.codes.accepted:
+            return None
+        r.raise_for_status()
+        response = response_json(r, SearchResponse)
+        if response.get("status") in ("PEND", "RUN"):
+            return None
+        return response
+
+    def poll_search(self, uuid, interval=5, timeout=None, max_interval=120):
+        """
+        Wait for the results of a submitted search.
+        The interval between checks doubles up to max_interval seconds.
+        """
+        start = time.monotonic()
+        while True:
+            response = self.fetch_search(uuid)
+            if response is not None:
+                return response
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise requests.Timeout("Job %s is still running" % uuid)
+            logger.debug("Job %s running, next check in %ss" % (uuid, interval))
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    def post_search(self, data):
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+        logger.debug("POST: %r" % data)
+        request_data = self.session.post(
+            MG_SEQ_URL,
+            data=data,
+            headers=headers,
+            timeout=(ToolkitAdapter.timeout[0], self.search_timeout),
+        )
         # Check if data was returned
         if request_data:
-            return request_data.json()
+            return response_json(request_data, SearchResponse)
         else:
             return False
 
@@ -168,16 +495,48 @@ class SequenceSearch(object):
         headers = {
             "Accept": "application/json",
         }
-        r = requests.get(
+        accession_type = get_accession_type(accession)
+        if accession_type == "run":
+            r = self.session.get(
+                MG_RUN_URL.format(**{"accession": accession}),
+                headers=headers,
+                params={"include": "sample"},
+            )
+            return response_json(r, SampleResponse)
+        r = self.session.get(
             MG_SAMPLE_URL.format(**{"accession": accession}), headers=headers
         )
-        if r.status_code != requests.codes.ok:
-            r = requests.get(
+        if accession_type is None and r.status_code != requests.codes.ok:
+            r = self.session.get(
                 MG_RUN_URL.format(**{"accession": accession}),
                 headers=headers,
                 params={"include": "sample"},
             )
-        return r.json()
+        return response_json(r, SampleResponse)
+
+    def make_bulk_request(self, accessions):
+        """
+        Get several samples with one request to the MGnify samples list.
+        Returns a dict of accession -> request, in the same format as
+        make_request. Accessions missing from the dict should be requested
+        one by one.
+        """
+        r = self.session.get(
+            MG_SAMPLES_URL,
+            headers={"Accept": "application/json"},
+            params={
+                MG_SAMPLES_ACCESSION_FILTER: ",".join(accessions),
+                "page_size": len(accessions),
+            },
+        )
+        if r.status_code != requests.codes.ok:
+            return {}
+        wanted = set(accessions)
+        return {
+            sample["id"]: {"data": sample}
+            for sample in response_json(r, SamplesPage).get("data", [])
+            if sample.get("id") in wanted
+        }
 
     def get_sample_metadata(self, accession, request):
         _meta = {}
@@ -234,61 +593,95 @@ class SequenceSearch(object):
 
     def fetch_results(self, results):
         """
-        Complete the HMMER hits with MGnify metadata from the API
-        TODO: This could be parallelized for better performance
+        Complete the HMMER hits with MGnify metadata from the API.
+        The distinct accessions of all the hits are resolved once,
+        concurrently, and then copied to every hit row.
+        Returns a dict of (subject_id, accession) -> row.
         """
-        csv_rows = dict()
+        hits = []
         for hit in results.get("hits", []):
+            mgnify = hit.get("mgnify") or {}
+            accessions = [res[0] for res in mgnify.get("samples") or []]
+            accessions += [res[0] for res in mgnify.get("runs") or []]
+            hits.append((hit, accessions))
+
+        metadata = self.resolve_accessions(
+            {accession for _, accessions in hits for accession in accessions}
+        )
+
+        csv_rows = dict()
+        for hit, accessions in hits:
             _row = self.prepare_rows(hit)
-            mgnify = hit.get("mgnify", [])
-            for res in mgnify.get("samples") or []:
-                accession = res[0]
-                logger.debug("Accession %s" % accession)
-                uuid = "{n} {a}".format(**{"n": hit["name"], "a": accession})
-                csv_rows[uuid] = dict()
-                csv_rows[uuid].update(_row)
-                req = self.make_request(accession)
-                _meta = self.get_sample_metadata(accession=accession, request=req)
-                csv_rows[uuid].update(_meta)
-            for res in mgnify.get("runs") or []:
-                accession = res[0]
-                logger.debug("Accession %s" % accession)
-                uuid = "{n} {a}".format(**{"n": hit["name"], "a": accession})
-                csv_rows[uuid] = dict()
-                csv_rows[uuid].update(_row)
-                req = self.make_request(accession)
-                _meta = self.get_sample_metadata(accession=accession, request=req)
-                csv_rows[uuid].update(_meta)
+            for accession in accessions:
+                key = (hit["name"], accession)
+                csv_rows[key] = dict()
+                csv_rows[key].update(_row)
+                csv_rows[key].update(metadata[accession])
         return csv_rows
 
-    def results_to_df(self, csv_rows, uuid):
+    def resolve_accessions(self, accessions):
         """
-        Convert search results to dataframe
+        Get the MGnify sample metadata of the accessions.
+        Accessions already in the metadata cache are not requested again.
         """
+        missing = sorted(a for a in accessions if a not in self.metadata_cache)
 
-        df = DataFrame(csv_rows).T
-        df.reset_index(inplace=True)
-        df.rename(columns={"index": "name"}, inplace=True)
-        # Split index to subject_id and accession
-        df[["subject_id", "accession"]] = df["name"].str.split(" ", n=1, expand=True)
-
-        # Put query_id, subject_id, and accession as first three columns
-        subject_id = df.subject_id
-        accession = df.accession
-        df.drop(["name", "subject_id", "accession"], axis=1, inplace=True)
-        df.insert(0, "query_id", self.query_id)
-        df.insert(1, "subject_id", subject_id)
-        df.insert(1, "accession", accession)
-
-        def _clean_column(col):
-            return (
-                col.replace(")", "")
-                .replace("(", "")
-                .replace("/", "_")
-                .replace(",", "_")
-            )
+        samples = [a for a in missing if get_accession_type(a) == "sample"]
+        if self.metadata_cache.bulk_samples and len(samples) > 1:
+            resolved = 0
+            for i in range(0, len(samples), BULK_REQUEST_SIZE):
+                batch = samples[i : i + BULK_REQUEST_SIZE]
+                for accession, req in self.make_bulk_request(batch).items():
+                    self.metadata_cache[accession] = self.get_sample_metadata(
+                        accession=accession, request=req
+                    )
+                    resolved += 1
+                if not resolved:
+                    # the list endpoint doesn't filter by accession
+                    logger.debug("Bulk sample requests disabled")
+                    self.metadata_cache.bulk_samples = False
+                    break
+            missing = [a for a in missing if a not in self.metadata_cache]
 
-        # Clean columns from (),\
-        df.rename(_clean_column, axis="columns", inplace=True)
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.enrichment_workers) as executor:
+                for accession, _meta in zip(
+                    missing,
+                    executor.map(queued(self.get_accession_metadata), missing),
+                ):
+                    self.metadata_cache[accession] = _meta
+        return {accession: self.metadata_cache[accession] for accession in accessions}
+
+    def get_accession_metadata(self, accession):
+        logger.debug("Accession %s" % accession)
+        req = self.make_request(accession)
+        return self.get_sample_metadata(accession=accession, request=req)
 
+    def results_to_df(self, csv_rows, uuid):
+        """
+        Convert search results to dataframe.
+        csv_rows is a dict of (subject_id, accession) -> row, as returned by
+        fetch_results. The columns are built directly from the rows.
+        """
+        data = {
+            "query_id": [self.query_id] * len(csv_rows),
+            "accession": [accession for _, accession in csv_rows],
+            "subject_id": [subject_id for subject_id, _ in csv_rows],
+        }
+        for i, row in enumerate(csv_rows.values()):
+            for key, value in row.items():
+                if key in RESERVED_COLUMNS:
+                    continue
+                column = data.get(key)
+                if column is None:
+                    column = data[key] = [None] * len(csv_rows)
+                column[i] = value
+
+        df = DataFrame(data, dtype=object)
+        # Clean columns from (),\
+        df.columns = [_clean_column(col) for col in df.columns]
         return df
+
+
+def _clean_column(col):
+    return col.replace(")", "").replace("(", "").replace("/", "_").replace(",", "_")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Long lived mg_toolkit process.
+
+`mg-toolkit serve` listens on localhost for command lines and runs them in
+the same process, so the imports, the pooled connections and the in memory
+caches of the sample, run and biome lookups are shared by all of them.
+`mg-toolkit --server URL <tool> ...` sends the command line to the server
+and prints its output as it is written.
+
+The server writes a random token to ~/.mg-toolkit/server-<port>.token,
+readable by its user only, and only runs the command lines sent with it.
+"""
+
+import hmac
+import io
+import json
+import logging
+import os
+import secrets
+import sys
+import threading
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+import mg_toolkit
+
+logger = logging.getLogger(__name__)
+
+HOST = "127.0.0.1"
+
+# the tools the server runs, the others write to arbitrary places or
+# would block the server
+TOOLS = ("bulk_download", "original_metadata", "sequence_search")
+
+
+def token_file(port):
+    """File with the token of the server listening on port"""
+    return os.path.join(
+        os.path.expanduser("~"), ".mg-toolkit", "server-{}.token".format(port)
+    )
+
+
+class ToolkitRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /health returns the server version.
+    POST /run takes {"argv": [...], "cwd": "..."} and streams json lines,
+    {"output": "..."} as the command writes to stdout, stderr or the logs,
+    then {"returncode": int}. It needs the application/json
+    content type and the "Authorization: Bearer <token>" header, which a
+    web page can't send without a preflight the server doesn't answer.
+    """
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s" % (self.address_string(), format % args))
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": "Not found"})
+            return
+        self._send_json(200, {"status": "ok", "version": mg_toolkit.__version__})
+
+    def do_POST(self):
+        if self.path != "/run":
+            self._send_json(404, {"error": "Not found"})
+            return
+        authorization = self.headers.get("Authorization", "")
+        if not hmac.compare_digest(
+            authorization.encode(), ("Bearer " + self.server.token).encode()
+        ):
+            self._send_json(401, {"error": "Invalid token"})
+            return
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.split(";")[0].strip() != "application/json":
+            self._send_json(415, {"error": "Expected application/json"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length))
+            argv = [str(arg) for arg in job["argv"]]
+            cwd = job.get("cwd") or os.getcwd()
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": 'Expected {"argv": [...], "cwd": ...}'})
+            return
+        # the length isn't known, the end of the response closes the connection
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        output = JobOutput(self.wfile)
+        returncode = self.server.run_job(argv, cwd, output)
+        output.send(returncode=returncode)
+
+
+class JobOutput(io.TextIOBase):
+    """Text stream sending what is written as json lines, a line at a time
+    (or a progress bar update). The output of a client that went away is
+    dropped.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self._buffer = ""
+        self._lock = threading.RLock()
+        self._lost = False
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self._lock:
+            self._buffer += text
+            end = max(self._buffer.rfind("\n"), self._buffer.rfind("\r")) + 1
+            if end:
+                output, self._buffer = self._buffer[:end], self._buffer[end:]
+                self._send(output=output)
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            if self._buffer:
+                output, self._buffer = self._buffer, ""
+                self._send(output=output)
+
+    def send(self, **message):
+        """Send the message after the output written so far."""
+        with self._lock:
+            self.flush()
+            self._send(**message)
+
+    def _send(self, **message):
+        if self._lost:
+            return
+        try:
+            self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+            self.wfile.flush()
+        except OSError:
+            self._lost = True
+
+
+class ToolkitServer(ThreadingHTTPServer):
+    """
+    Runs the jobs one at a time: the tools use the working directory of
+    the client, and the working directory and stdout belong to the process.
+    The tools still run their own requests concurrently.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, run, token=None):
+        super().__init__(address, ToolkitRequestHandler)
+        self.run = run
+        self.token = token or secrets.token_urlsafe(32)
+        self.job_lock = threading.Lock()
+
+    def write_token(self, filename):
+        """Write the token to a file only the user can read."""
+        os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+        if os.path.exists(filename):
+            os.remove(filename)
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.token)
+
+    def run_job(self, argv, cwd, output):
+        """Run the command line in cwd, its output is written to output.
+        Returns the exit code.
+        """
+        with self.job_lock:
+            log_handler = logging.StreamHandler(output)
+            log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+            root_logger = logging.getLogger()
+            root_logger.addHandler(log_handler)
+            previous_cwd = os.getcwd()
+            returncode = 0
+            try:
+                os.chdir(cwd)
+                with redirect_stdout(output), redirect_stderr(output):
+                    result = self.run(argv)
+                if isinstance(result, int):
+                    returncode = result
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                returncode = 1
+                output.write(traceback.format_exc())
+            finally:
+                os.chdir(previous_cwd)
+                root_logger.removeHandler(log_handler)
+            logger.info("Finished %s with %s" % (" ".join(argv), returncode))
+            return returncode
+
+
+def serve(args, run):
+    """Serve the tools until interrupted."""
+    from .constants import API_BASE, ENA_XML_VIEW_URL
+    from .transport import enable_response_cache
+
+    enable_response_cache(
+        [
+            API_BASE + "/samples",
+            API_BASE + "/runs",
+            API_BASE + "/biomes",
+            ENA_XML_VIEW_URL,
+        ],
+        max_entries=args.cache_size,
+        ttl=args.cache_ttl,
+    )
+    server = ToolkitServer((HOST, args.port), lambda argv: run(argv, tools=TOOLS))
+    port = server.server_address[1]
+    server.write_token(token_file(port))
+    print(
+        "mg-toolkit {} serving on http://{}:{}".format(
+            mg_toolkit.__version__, HOST, port
+        ),
+        flush=True,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.remove(token_file(port))
+        except OSError:
+            pass
+
+
+def forward(url, argv, token=None):
+    """Run the command line on the server, returns the exit code.
+    The token is read from $MG_TOOLKIT_SERVER_TOKEN_FILE, or the token file
+    of the port of the url.
+    """
+    if token is None:
+        filename = os.environ.get("MG_TOOLKIT_SERVER_TOKEN_FILE") or token_file(
+            urlsplit(url).port or 80
+        )
+        try:
+            with open(filename) as f:
+                token = f.read().strip()
+        except OSError as e:
+            sys.stderr.write("Failed to read the mg-toolkit server token: %s\n" % e)
+            return 1
+    data = json.dumps({"argv": argv, "cwd": os.getcwd()}).encode("utf-8")
+    request = Request(
+        url.rstrip("/") + "/run",
+        data=data,
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + token,
+        },
+    )
+    returncode = None
+    try:
+        with urlopen(request) as response:
+            for line in response:
+                message = json.loads(line)
+                if "output" in message:
+                    sys.stdout.write(message["output"])
+                    sys.stdout.flush()
+                else:
+                    returncode = message["returncode"]
+    except HTTPError as e:
+        sys.stderr.write(
+            "The mg-toolkit server {} refused the command: {}\n".format(url, e)
+        )
+        return 1
+    except URLError as e:
+        sys.stderr.write(
+            "Failed to reach the mg-toolkit server {}: {}\n".format(url, e)
+        )
+        return 1
+    if returncode is None:
+        sys.stderr.write("The mg-toolkit server {} closed the connection\n".format(url))
+        return 1
+    return returncode
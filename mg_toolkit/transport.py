@@ -0,0 +1,716 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HTTP transport shared by all the tools.
+
+Every request of the toolkit goes through the session returned by
+get_session, which keeps the connections of the process pooled and
+retries the failed requests.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RetryError, Timeout
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, stream_decode_response_unicode
+from urllib3.util import Retry
+
+from .constants import REQUESTS_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# connections kept open per host
+POOL_MAXSIZE = 64
+
+# seconds, the read timeout applies to each read of the socket
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 180
+
+# seconds an endpoint that failed is avoided
+FAILOVER_COOLDOWN = 60
+PROBE_TIMEOUT = 5
+
+# the ToolkitAdapter attributes set by the functions below
+SETTINGS = (
+    "response_cache",
+    "tracer",
+    "recording",
+    "replay",
+    "endpoints",
+    "hedger",
+    "timeout",
+)
+
+_session = None
+_session_lock = threading.Lock()
+# set in the threads probing the endpoints
+_probe_state = threading.local()
+# set in the threads running a task wrapped by queued
+_task_state = threading.local()
+
+
+class ResponseCache:
+    """
+    In memory LRU cache of the successful GET responses of the URLs starting
+    with one of the prefixes. The responses older than ttl seconds are
+    requested again.
+    """
+
+    def __init__(self, prefixes, max_entries=10000, ttl=None):
+        self.prefixes = tuple(prefixes)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cacheable(self, request):
+        return request.method == "GET" and request.url.startswith(self.prefixes)
+
+    def get(self, request):
+        with self._lock:
+            entry = self._entries.get(request.url)
+            if entry is None:
+                return None
+            status_code, headers, content, expires = entry
+            if expires is not None and time.monotonic() > expires:
+                del self._entries[request.url]
+                return None
+            self._entries.move_to_end(request.url)
+        return _build_response(request, status_code, headers, content)
+
+    def set(self, request, response):
+        if response.status_code != 200:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        entry = (
+            response.status_code,
+            dict(response.headers),
+            response.content,
+            expires,
+        )
+        with self._lock:
+            self._entries[request.url] = entry
+            self._entries.move_to_end(request.url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class Tracer:
+    """
+    Writes one json line per HTTP request: the method, url, status code,
+    bytes received, number of retries, queueing delay (the time the task
+    sending the request waited for a worker of its executor, see queued,
+    on the first request of the task), total latency, and the error if the
+    request failed. Streamed downloads report the
+    Content-Length and the latency up to the response headers.
+    """
+
+    def __init__(self, filename):
+        self._fd = open(filename, "a")
+        self._lock = threading.Lock()
+
+    def record(self, **entry):
+        line = json.dumps(entry)
+        with self._lock:
+            self._fd.write(line + "\n")
+            self._fd.flush()
+
+    def close(self):
+        self._fd.close()
+
+
+class Recording:
+    """
+    Directory of recorded HTTP exchanges, used to record the requests of a
+    run and to replay them without network.
+
+    Every exchange is stored in requests/<key>.json, the key is the sha256
+    of the method, url, range and body of the request. The response bodies
+    are gzipped in bodies/<sha256 of the body>.gz so the identical ones are
+    only stored once. Recording the same request again replaces the
+    previous response, e.g. polling a search keeps the final result. The
+    body of a streamed response is stored as it's read, once it's read to
+    the end.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.requests_dir = os.path.join(directory, "requests")
+        self.bodies_dir = os.path.join(directory, "bodies")
+        os.makedirs(self.requests_dir, exist_ok=True)
+        os.makedirs(self.bodies_dir, exist_ok=True)
+
+    @staticmethod
+    def key(request):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        digest = hashlib.sha256()
+        digest.update(request.method.encode("utf-8") + b" ")
+        digest.update(request.url.encode("utf-8") + b"\n")
+        # the same url resumed from another offset
+        if request.headers.get("Range"):
+            digest.update(b"Range: " + request.headers["Range"].encode("utf-8") + b"\n")
+        digest.update(body)
+        return digest.hexdigest()
+
+    def load(self, request):
+        """The recorded response of the request, or None."""
+        try:
+            with open(self._request_path(request)) as f:
+                exchange = json.load(f)
+        except FileNotFoundError:
+            return None
+        content = b""
+        if exchange["body"]:
+            with gzip.open(self._body_path(exchange["body"])) as f:
+                content = f.read()
+        return _build_response(
+            request,
+            exchange["status"],
+            exchange["headers"],
+            content,
+            reason=exchange["reason"],
+        )
+
+    def save(self, request, response, stream=False):
+        if stream:
+            # without the body until it's read
+            self._save_exchange(request, response, None)
+            self._tee(request, response)
+            return
+        content = response.content
+        body = None
+        if content:
+            body = hashlib.sha256(content).hexdigest()
+            body_path = self._body_path(body)
+            if not os.path.exists(body_path):
+                _write_atomic(body_path, gzip.compress(content, mtime=0))
+        self._save_exchange(request, response, body)
+
+    def _tee(self, request, response):
+        """Store the body of the streamed response while it's read."""
+        iter_content = response.iter_content
+
+        def _chunks(chunk_size):
+            digest = hashlib.sha256()
+            size = 0
+            fd, path_tmp = tempfile.mkstemp(suffix=".tmp", dir=self.bodies_dir)
+            complete = False
+            try:
+                with open(fd, "wb") as raw, gzip.GzipFile(
+                    fileobj=raw, mode="wb", mtime=0
+                ) as f:
+                    for chunk in iter_content(chunk_size):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                        yield chunk
+                complete = True
+            finally:
+                if complete and size:
+                    body = digest.hexdigest()
+                    os.replace(path_tmp, self._body_path(body))
+                    self._save_exchange(request, response, body)
+                else:
+                    os.remove(path_tmp)
+
+        def _iter_content(chunk_size=1, decode_unicode=False):
+            chunks = _chunks(chunk_size)
+            if decode_unicode:
+                return stream_decode_response_unicode(chunks, response)
+            return chunks
+
+        response.iter_content = _iter_content
+
+    def _save_exchange(self, request, response, body):
+        exchange = {
+            "method": request.method,
+            "url": request.url,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+            "body": body,
+        }
+        _write_atomic(
+            self._request_path(request),
+            json.dumps(exchange, indent=1, sort_keys=True).encode("utf-8"),
+        )
+
+    def _request_path(self, request):
+        return os.path.join(self.requests_dir, self.key(request) + ".json")
+
+    def _body_path(self, body):
+        return os.path.join(self.bodies_dir, body + ".gz")
+
+
+class Endpoint:
+    __slots__ = ("base", "latency", "down_until")
+
+    def __init__(self, base):
+        self.base = base.rstrip("/")
+        # moving average of the response time, in seconds
+        self.latency = None
+        self.down_until = 0
+
+
+class EndpointGroup:
+    """
+    Equivalent base URLs, e.g. the public API, a mirror or a caching proxy,
+    for the URLs starting with prefix.
+
+    The bases are probed on the first request, then the requests go to the
+    fastest base that is up. A base that fails with a connection error, a
+    timeout or a 5xx response is avoided for FAILOVER_COOLDOWN seconds and
+    the request is sent to the next one.
+    """
+
+    def __init__(self, prefix, bases, cooldown=FAILOVER_COOLDOWN):
+        self.prefix = prefix.rstrip("/")
+        self.endpoints = [Endpoint(base) for base in bases]
+        self.cooldown = cooldown
+        self._probed = len(self.endpoints) < 2
+        self._lock = threading.Lock()
+
+    def matches(self, url):
+        return url == self.prefix or url.startswith(self.prefix + "/")
+
+    def rewrite(self, url, endpoint):
+        return endpoint.base + url[len(self.prefix) :]
+
+    def candidates(self):
+        """The endpoints to try, the fastest up first."""
+        if not self._probed:
+            with self._lock:
+                if not self._probed:
+                    self.probe()
+                    self._probed = True
+        now = time.monotonic()
+        up = [e for e in self.endpoints if e.down_until <= now]
+        down = [e for e in self.endpoints if e.down_until > now]
+        up.sort(key=lambda e: float("inf") if e.latency is None else e.latency)
+        down.sort(key=lambda e: e.down_until)
+        return up + down
+
+    def probe(self):
+        """Time a request to each base, concurrently."""
+
+        def _probe(endpoint):
+            # sent as is, recorded, replayed and traced like the other requests
+            _probe_state.active = True
+            started = time.perf_counter()
+            try:
+                with get_session().get(
+                    endpoint.base, timeout=PROBE_TIMEOUT, stream=True
+                ) as response:
+                    ok = response.status_code < 500
+            except requests.RequestException:
+                ok = False
+            if ok:
+                self.succeeded(endpoint, time.perf_counter() - started)
+            else:
+                self.failed(endpoint)
+            logger.debug(
+                "Probed %s: %s"
+                % (endpoint.base, "%.3fs" % endpoint.latency if ok else "down")
+            )
+
+        threads = [
+            threading.Thread(target=_probe, args=(e,), daemon=True)
+            for e in self.endpoints
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def succeeded(self, endpoint, elapsed):
+        endpoint.down_until = 0
+        if endpoint.latency is None:
+            endpoint.latency = elapsed
+        else:
+            endpoint.latency = 0.8 * endpoint.latency + 0.2 * elapsed
+
+    def failed(self, endpoint):
+        endpoint.down_until = time.monotonic() + self.cooldown
+
+
+class Hedger:
+    """
+    Sends a duplicate of the requests that take longer than the quantile of
+    the latency of the previous requests, the first response wins and the
+    other one is discarded. Only meant for idempotent requests.
+    """
+
+    def __init__(self, quantile=0.95, min_samples=20, history=500):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.hedged = 0
+        self._latencies = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=2 * POOL_MAXSIZE, thread_name_prefix="hedge"
+        )
+
+    def delay(self):
+        """Seconds to wait before sending the duplicate, None until there
+        are enough samples.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * self.quantile), len(latencies) - 1)]
+
+    def send(self, send, request, **kwargs):
+        def _attempt():
+            response = send(request, **kwargs)
+            # the body is part of the latency
+            response.content
+            return response
+
+        started = time.perf_counter()
+        futures = [self._executor.submit(_attempt)]
+        done, _ = wait(futures, timeout=self.delay())
+        if not done:
+            logger.debug("Hedging %s" % request.url)
+            with self._lock:
+                self.hedged += 1
+            futures.append(self._executor.submit(_attempt))
+
+        pending = set(futures)
+        winner = None
+        while winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((f for f in done if f.exception() is None), None)
+            if winner is None and not pending:
+                # every attempt failed
+                futures[0].result()
+
+        for future in futures:
+            if future is not winner:
+                future.add_done_callback(_close_response)
+        with self._lock:
+            self._latencies.append(time.perf_counter() - started)
+        return winner.result()
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+class ToolkitAdapter(HTTPAdapter):
+    """HTTP adapter of the toolkit session."""
+
+    response_cache = None
+    tracer = None
+    recording = None
+    replay = False
+    endpoints = ()
+    hedger = None
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # endpoints with an alternative are tried once before failing over
+        self._single_try = HTTPAdapter(
+            max_retries=0, pool_connections=16, pool_maxsize=POOL_MAXSIZE
+        )
+
+    def send(self, request, stream=False, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        if self.tracer is None:
+            return self._send(request, stream=stream, **kwargs)
+
+        started = time.perf_counter()
+        submitted = getattr(_task_state, "submitted", None) or started
+        # the next requests of the task didn't wait
+        _task_state.submitted = None
+        entry = {
+            "time": time.time(),
+            "thread": threading.current_thread().name,
+            "method": request.method,
+            "url": request.url,
+        }
+        try:
+            response = self._send(request, stream=stream, **kwargs)
+            if stream:
+                size = response.headers.get("Content-Length")
+                size = int(size) if size and size.isdigit() else None
+            else:
+                size = len(response.content)
+            # responses served from the cache or a recording have no raw response
+            retries = getattr(getattr(response.raw, "retries", None), "history", ())
+            entry.update(
+                status=response.status_code,
+                bytes=size,
+                retries=len(retries),
+                cached=response.raw is None,
+            )
+            return response
+        except Exception as e:
+            entry.update(status=None, error=repr(e))
+            raise
+        finally:
+            entry.update(
+                queue_ms=round((started - submitted) * 1000, 3),
+                latency_ms=round((time.perf_counter() - started) * 1000, 3),
+            )
+            self.tracer.record(**entry)
+
+    def _send(self, request, stream=False, **kwargs):
+        cache = self.response_cache
+        if cache is not None and not stream and cache.cacheable(request):
+            response = cache.get(request)
+            if response is not None:
+                logger.debug("Cached response for %s" % request.url)
+                return response
+            response = self._send_network(request, stream=stream, **kwargs)
+            cache.set(request, response)
+            return response
+        return self._send_network(request, stream=stream, **kwargs)
+
+    def _send_network(self, request, **kwargs):
+        recording = self.recording
+        if recording is None:
+            return self._send_hedged(request, **kwargs)
+        if self.replay:
+            response = recording.load(request)
+            if response is None:
+                raise ConnectionError(
+                    "No recorded response for %s %s in %s"
+                    % (request.method, request.url, recording.directory),
+                    request=request,
+                )
+            return response
+        response = self._send_hedged(request, **kwargs)
+        recording.save(request, response, stream=kwargs.get("stream", False))
+        return response
+
+    def _send_hedged(self, request, **kwargs):
+        hedger = self.hedger
+        if hedger is None or kwargs.get("stream") or request.method != "GET":
+            return self._send_endpoint(request, **kwargs)
+        return hedger.send(self._send_endpoint, request, **kwargs)
+
+    def _send_endpoint(self, request, **kwargs):
+        if getattr(_probe_state, "active", False):
+            return self._single_try.send(request, **kwargs)
+        group = None
+        for endpoints in self.endpoints:
+            if endpoints.matches(request.url):
+                group = endpoints
+                break
+        if group is None:
+            return super().send(request, **kwargs)
+
+        candidates = group.candidates()
+        for i, endpoint in enumerate(candidates):
+            last = i == len(candidates) - 1
+            endpoint_request = request.copy()
+            endpoint_request.url = group.rewrite(request.url, endpoint)
+            started = time.perf_counter()
+            try:
+                if last:
+                    response = super().send(endpoint_request, **kwargs)
+                else:
+                    response = self._single_try.send(endpoint_request, **kwargs)
+            except (ConnectionError, Timeout, RetryError) as e:
+                group.failed(endpoint)
+                if last:
+                    raise
+                logger.warning("%s failed, failing over: %s" % (endpoint.base, e))
+                continue
+            if response.status_code >= 500:
+                group.failed(endpoint)
+                if not last:
+                    logger.warning(
+                        "%s failed, failing over: HTTP %s"
+                        % (endpoint.base, response.status_code)
+                    )
+                    response.close()
+                    continue
+            else:
+                group.succeeded(endpoint, time.perf_counter() - started)
+            return response
+
+
+def _build_response(request, status_code, headers, content, reason=None):
+    headers = CaseInsensitiveDict(headers)
+    # the content is stored decoded
+    headers.pop("Content-Encoding", None)
+    headers.pop("Transfer-Encoding", None)
+    headers["Content-Length"] = str(len(content))
+    response = Response()
+    response.status_code = status_code
+    response.reason = reason
+    response.headers = headers
+    response._content = content
+    response._content_consumed = True
+    response.url = request.url
+    response.request = request
+    response.encoding = get_encoding_from_headers(headers)
+    return response
+
+
+def _write_atomic(path, data):
+    path_tmp = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(path_tmp, "wb") as f:
+        f.write(data)
+    os.replace(path_tmp, path)
+
+
+def _build_session():
+    retries = Retry(
+        total=REQUESTS_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+    )
+    adapter = ToolkitAdapter(
+        max_retries=retries, pool_connections=16, pool_maxsize=POOL_MAXSIZE
+    )
+    session = Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def queued(fn):
+    """Wrap fn before submitting it to an executor, the trace of its first
+    request then has the time it waited for a worker.
+    """
+    submitted = time.perf_counter()
+
+    def _run(*args, **kwargs):
+        _task_state.submitted = submitted
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _task_state.submitted = None
+
+    return _run
+
+
+def get_session():
+    """The requests session shared by the tools of the process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _build_session()
+        return _session
+
+
+def enable_response_cache(prefixes, max_entries=10000, ttl=None):
+    """Keep the GET responses of the URLs starting with the prefixes in memory,
+    for ttl seconds.
+    """
+    ToolkitAdapter.response_cache = ResponseCache(
+        prefixes, max_entries=max_entries, ttl=ttl
+    )
+
+
+def enable_trace(filename):
+    """Trace every request of the process to the json lines file."""
+    ToolkitAdapter.tracer = Tracer(filename)
+    return ToolkitAdapter.tracer
+
+
+def disable_trace():
+    if ToolkitAdapter.tracer is not None:
+        ToolkitAdapter.tracer.close()
+        ToolkitAdapter.tracer = None
+
+
+def enable_record(directory):
+    """Store every request of the process and its response in the directory."""
+    ToolkitAdapter.recording = Recording(directory)
+    ToolkitAdapter.replay = False
+
+
+def enable_replay(directory):
+    """Answer the requests of the process from the recordings of the directory,
+    the requests that weren't recorded fail with a ConnectionError.
+    """
+    if not os.path.isdir(directory):
+        raise ValueError("%s is not a recording directory" % directory)
+    ToolkitAdapter.recording = Recording(directory)
+    ToolkitAdapter.replay = True
+
+
+def disable_recording():
+    ToolkitAdapter.recording = None
+    ToolkitAdapter.replay = False
+
+
+def configure_endpoints(groups):
+    """Send the requests of the URLs starting with each prefix to the
+    fastest of its equivalent bases.
+    groups is a dict of prefix -> list of base URLs.
+    """
+    ToolkitAdapter.endpoints = tuple(
+        EndpointGroup(prefix, bases) for prefix, bases in groups.items() if bases
+    )
+
+
+def configure_timeouts(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT):
+    """Default timeouts of the requests, in seconds."""
+    ToolkitAdapter.timeout = (connect, read)
+
+
+def enable_hedging(quantile=0.95):
+    """Duplicate the GET requests slower than the quantile of the latency."""
+    if ToolkitAdapter.hedger is None:
+        ToolkitAdapter.hedger = Hedger(quantile=quantile)
+    return ToolkitAdapter.hedger
+
+
+def disable_hedging():
+    if ToolkitAdapter.hedger is not None:
+        # the duplicates still running finish in the background
+        ToolkitAdapter.hedger._executor.shutdown(wait=False)
+        ToolkitAdapter.hedger = None
+
+
+def save_settings():
+    """The settings of the session, see restore_settings."""
+    return {name: getattr(ToolkitAdapter, name) for name in SETTINGS}
+
+
+def restore_settings(settings):
+    """Restore the settings saved by save_settings, the tracer and the
+    hedger enabled since are closed.
+    """
+    if ToolkitAdapter.tracer is not settings["tracer"]:
+        disable_trace()
+    if ToolkitAdapter.hedger is not settings["hedger"]:
+        disable_hedging()
+    for name, value in settings.items():
+        setattr(ToolkitAdapter, name, value)
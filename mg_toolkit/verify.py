@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import hashlib
+import logging
+import mmap
+import os
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from .bulk_download import BulkDownloader, group_folder_name
+
+logger = logging.getLogger(__name__)
+
+# bytes hashed at a time
+BLOCK_SIZE = 8 * 1024 * 1024
+
+REPORT_COLUMNS = [
+    "status",
+    "analysis_id",
+    "name",
+    "path",
+    "size",
+    "checksum",
+    "checksum_algorithm",
+    "detail",
+]
+
+PROBLEMS = ("missing", "truncated", "corrupt")
+
+
+def verify(args):
+    """Audit the files of a study downloaded by bulk_download."""
+    project_id = args.accession
+    output_path = args.output_path or os.getcwd()
+    metadata_file = os.path.join(
+        output_path, project_id, "{}_metadata.tsv".format(project_id)
+    )
+    if not os.path.exists(metadata_file):
+        logger.error("%s not found, run bulk_download first" % metadata_file)
+        return 1
+
+    with open(metadata_file) as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        rows = list(reader)
+    entries = [
+        entry
+        for entry in expected_files(rows, output_path, project_id)
+        if not args.result_group or args.result_group == entry["group"]
+    ]
+
+    report_file = args.report or os.path.join(
+        output_path, project_id, "{}_verify.tsv".format(project_id)
+    )
+    counts = Counter()
+    problems = []
+    with open(report_file, "w") as report_fd, ProcessPoolExecutor(
+        max_workers=args.workers
+    ) as executor:
+        writer = csv.DictWriter(report_fd, REPORT_COLUMNS, delimiter="\t")
+        writer.writeheader()
+        checks = executor.map(
+            check_file,
+            [entry["path"] for entry in entries],
+            [entry["checksum_algorithm"] for entry in entries],
+            [entry["checksum"] for entry in entries],
+            chunksize=4,
+        )
+        for entry, (status, size, checksum, algorithm, detail) in zip(entries, checks):
+            counts[status] += 1
+            if status in PROBLEMS:
+                problems.append(entry["row"])
+            writer.writerow(
+                {
+                    "status": status,
+                    "analysis_id": entry["row"]["analysis_id"],
+                    "name": entry["row"]["name"],
+                    "path": entry["path"],
+                    "size": size,
+                    "checksum": checksum,
+                    "checksum_algorithm": algorithm,
+                    "detail": detail,
+                }
+            )
+
+    if args.manifest:
+        with open(args.manifest, "w") as f:
+            writer = csv.DictWriter(f, reader.fieldnames, delimiter="\t")
+            writer.writeheader()
+            writer.writerows(problems)
+
+    print(
+        "{} files checked: {}".format(
+            len(entries),
+            ", ".join(
+                "{} {}".format(counts[status], status) for status in ("ok",) + PROBLEMS
+            ),
+        )
+    )
+    print("Report written to {}".format(report_file))
+    return 1 if problems else 0
+
+
+def expected_files(rows, output_path, project_id):
+    """The files bulk_download stores for the rows of the metadata file,
+    the files it doesn't download are left out.
+    """
+    seen = set()
+    for row in rows:
+        if BulkDownloader.not_applicable(
+            row["experiment_type"], row["description"], row["pipeline_version"]
+        ):
+            continue
+        group = group_folder_name(row["group_type"])
+        path = os.path.join(
+            output_path, project_id, row["pipeline_version"], group, row["name"]
+        )
+        if path in seen:
+            continue
+        seen.add(path)
+        yield {
+            "row": row,
+            "group": group,
+            "path": path,
+            "checksum": row.get("checksum") or None,
+            "checksum_algorithm": row.get("checksum_algorithm") or None,
+        }
+
+
+def check_file(path, algorithm=None, expected_checksum=None):
+    """Hash the file and check the gzip files decompress.
+    Returns (status, size, checksum, algorithm, detail), the status is one of
+    ok, missing, truncated or corrupt.
+    """
+    algorithm = (algorithm or "sha256").lower().replace("-", "")
+    if algorithm not in hashlib.algorithms_available:
+        algorithm, expected_checksum = "sha256", None
+    if not os.path.exists(path):
+        return "missing", None, None, None, ""
+    if os.path.exists(path + ".tmp"):
+        return "truncated", None, None, None, "interrupted download"
+
+    size = os.path.getsize(path)
+    digest = hashlib.new(algorithm)
+    gzip_check = _GzipCheck() if path.endswith(".gz") else None
+    if size:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            for offset in range(0, size, BLOCK_SIZE):
+                block = data[offset : offset + BLOCK_SIZE]
+                digest.update(block)
+                if gzip_check is not None and gzip_check.error is None:
+                    gzip_check.update(block)
+    checksum = digest.hexdigest()
+
+    if size == 0:
+        return "truncated", size, checksum, algorithm, "empty file"
+    if gzip_check is not None:
+        gzip_check.finish()
+        if gzip_check.error == "truncated":
+            return "truncated", size, checksum, algorithm, "gzip stream ends early"
+        if gzip_check.error:
+            return "corrupt", size, checksum, algorithm, gzip_check.error
+    if expected_checksum and checksum != expected_checksum.lower():
+        return (
+            "corrupt",
+            size,
+            checksum,
+            algorithm,
+            "expected {} {}".format(algorithm, expected_checksum),
+        )
+    return "ok", size, checksum, algorithm, ""
+
+
+class _GzipCheck:
+    """Decompresses the gzip members of a file to check their CRC."""
+
+    def __init__(self):
+        self.error = None
+        self._new_member()
+
+    def _new_member(self):
+        self._decompressor = zlib.decompressobj(wbits=31)
+        self._started = False
+
+    def update(self, data):
+        try:
+            while data:
+                if not self._started:
+                    # zeros padding the end of the file
+                    data = data.lstrip(b"\x00")
+                    if not data:
+                        return
+                    self._started = True
+                self._decompressor.decompress(data, BLOCK_SIZE)
+                data = self._decompressor.unconsumed_tail
+                if self._decompressor.eof:
+                    # concatenated members
+                    data = self._decompressor.unused_data
+                    self._new_member()
+        except zlib.error as e:
+            self.error = "invalid gzip data: {}".format(e)
+
+    def finish(self):
+        if self.error is None and self._started:
+            self.error = "truncated"
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# rows converted to parquet at once
+PARQUET_BATCH_SIZE = 100000
+
+
+def _cell(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return value
+
+
+class ResultWriter:
+    """
+    Write the sequence search results to a csv file as they are produced.
+
+    Every call to write appends the rows of a DataFrame and flushes them,
+    so the file can be used while the search is running. The columns are
+    the union of the columns of all the rows, in order of appearance. The
+    header is the one of the first rows until the file is closed, the
+    columns added since are listed in <file>.columns and the file is
+    rewritten once with the full header on close.
+    """
+
+    def __init__(self, filename, keep_query_ids=None):
+        self.filename = filename
+        self.columns = []
+        self._header = []
+        self._fd = None
+        self._writer = None
+        if keep_query_ids is not None and os.path.exists(filename):
+            self._resume(keep_query_ids)
+
+    @property
+    def columns_file(self):
+        return self.filename + ".columns"
+
+    def _resume(self, keep_query_ids):
+        """Continue an existing file, only the rows of keep_query_ids are kept."""
+        with open(self.filename, newline="") as f:
+            if not next(csv.reader(f), []):
+                # nothing written yet
+                return
+        filename_tmp = self.filename + ".tmp"
+        with open(self.filename, newline="") as f_in, open(
+            filename_tmp, "w", newline=""
+        ) as f_out:
+            reader = csv.reader(f_in)
+            writer = csv.writer(f_out, lineterminator="\n")
+            self.columns = next(reader)
+            if os.path.exists(self.columns_file):
+                # interrupted before the header was rewritten
+                with open(self.columns_file) as f:
+                    self.columns = json.load(f)
+            writer.writerow(self.columns)
+            query_id = self.columns.index("query_id")
+            padding = [""] * len(self.columns)
+            writer.writerows(
+                (row + padding)[: len(self.columns)]
+                for row in reader
+                if row[query_id] in keep_query_ids
+            )
+        os.replace(filename_tmp, self.filename)
+        self._header = list(self.columns)
+        if os.path.exists(self.columns_file):
+            os.remove(self.columns_file)
+        self._open("a")
+
+    def _open(self, mode):
+        self._fd = open(self.filename, mode, newline="")
+        self._writer = csv.writer(self._fd, lineterminator="\n")
+
+    def write(self, df):
+        columns = set(self.columns)
+        new_columns = [c for c in df.columns if c not in columns]
+        self.columns += new_columns
+        if self._fd is None:
+            self._open("w")
+            self._writer.writerow(self.columns)
+            self._header = list(self.columns)
+        elif new_columns:
+            logger.debug("New result columns: %s" % ", ".join(new_columns))
+            _write_json(self.columns_file, self.columns)
+
+        positions = [
+            df.columns.get_loc(c) if c in df.columns else None for c in self.columns
+        ]
+        for row in df.itertuples(index=False, name=None):
+            self._writer.writerow(
+                ["" if p is None else _cell(row[p]) for p in positions]
+            )
+        self._fd.flush()
+
+    def _rewrite_header(self):
+        """Rewrite the file with the columns added since it was created."""
+        filename_tmp = self.filename + ".tmp"
+        padding = [""] * len(self.columns)
+        with open(self.filename, newline="") as f_in, open(
+            filename_tmp, "w", newline=""
+        ) as f_out:
+            reader = csv.reader(f_in)
+            writer = csv.writer(f_out, lineterminator="\n")
+            next(reader)
+            writer.writerow(self.columns)
+            for row in reader:
+                writer.writerow((row + padding)[: len(self.columns)])
+        os.replace(filename_tmp, self.filename)
+        self._header = list(self.columns)
+        os.remove(self.columns_file)
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+            if self.columns != self._header:
+                self._rewrite_header()
+
+
+class Checkpoint:
+    """
+    Journal of a sequence search run, one json line per finished query.
+
+    Entries hold the query_id, the status ("submitted", "done", "no_results"
+    or "failed"), the job uuid and the error of failed queries. The last
+    entry of a query wins, so failed queries can be retried by a later run.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.output = None
+        self.queries = dict()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # truncated by a crash
+                        continue
+                    if "output" in entry:
+                        self.output = entry["output"]
+                    else:
+                        self.queries[entry["query_id"]] = entry
+        self._lock = threading.Lock()
+        self._fd = open(filename, "a")
+
+    def _write(self, entry):
+        with self._lock:
+            self._fd.write(json.dumps(entry) + "\n")
+            self._fd.flush()
+
+    def set_output(self, output):
+        if output != self.output:
+            self.output = output
+            self._write({"output": output})
+
+    def record(self, query_id, status, uuid=None, error=None):
+        entry = {"query_id": query_id, "status": status}
+        if uuid is not None:
+            entry["uuid"] = uuid
+        if error is not None:
+            entry["error"] = error
+        self.queries[query_id] = entry
+        self._write(entry)
+
+    def completed(self):
+        """Query ids that don't have to be searched again."""
+        return {
+            query_id
+            for query_id, entry in self.queries.items()
+            if entry["status"] in ("done", "no_results")
+        }
+
+    def submitted(self):
+        """Query id -> job uuid of the jobs waiting to be fetched."""
+        return {
+            query_id: entry["uuid"]
+            for query_id, entry in self.queries.items()
+            if entry["status"] == "submitted"
+        }
+
+    def failed(self):
+        return {
+            query_id
+            for query_id, entry in self.queries.items()
+            if entry["status"] == "failed"
+        }
+
+    def close(self):
+        self._fd.close()
+
+
+def _write_json(filename, data):
+    with open(filename + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(filename + ".tmp", filename)
+
+
+def csv_to_parquet(csv_file, parquet_file):
+    """Convert the results csv to parquet in batches, all columns as strings."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pandas import read_csv
+
+    writer = None
+    try:
+        for chunk in read_csv(
+            csv_file, dtype=str, keep_default_na=False, chunksize=PARQUET_BATCH_SIZE
+        ):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_file, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def parquet_to_csv(parquet_file, csv_file):
+    """Convert a parquet file written by csv_to_parquet back to csv."""
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(parquet_file)
+    with open(csv_file, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(parquet.schema_arrow.names)
+        for batch in parquet.iter_batches(batch_size=PARQUET_BATCH_SIZE):
+            columns = [column.to_pylist() for column in batch.columns]
+            writer.writerows(zip(*columns))
@@ -47,6 +47,7 @@ setup(
     version="0.10.4",
     python_requires=">=3.8",
     install_requires=install_requirements,
+    extras_require={"parquet": ["pyarrow"], "fast-json": ["msgspec", "orjson"]},
     setup_requires=["pytest-runner"],
     tests_require=test_requirements,
     include_package_data=True,
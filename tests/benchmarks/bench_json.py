@@ -0,0 +1,160 @@
+#!/bin/env python3
+
+"""
+JSON decoding of the API responses.
+
+Decodes the JSON bodies of a --record directory, or synthetic analyses and
+HMMER pages if no directory is given, with each decoder available and
+prints the best and median time per pass over all the payloads.
+
+    python tests/benchmarks/bench_json.py [--recording DIR] [-n 20]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import statistics
+import time
+
+from mg_toolkit import decoding
+from mg_toolkit.decoding import (
+    AnalysesPage,
+    DownloadsPage,
+    SampleResponse,
+    SamplesPage,
+    SearchResponse,
+)
+
+
+def schema_for(url):
+    if "sequence-search" in url:
+        return SearchResponse
+    if "/downloads" in url:
+        return DownloadsPage
+    if "/analyses" in url:
+        return AnalysesPage
+    if "/runs/" in url or "/samples/" in url:
+        return SampleResponse
+    if "/samples" in url:
+        return SamplesPage
+    return None
+
+
+def load_recording(directory):
+    payloads = []
+    requests_dir = os.path.join(directory, "requests")
+    for name in sorted(os.listdir(requests_dir)):
+        with open(os.path.join(requests_dir, name)) as f:
+            exchange = json.load(f)
+        content_type = exchange["headers"].get("Content-Type", "")
+        if not exchange["body"] or "json" not in content_type:
+            continue
+        body_path = os.path.join(directory, "bodies", exchange["body"] + ".gz")
+        with gzip.open(body_path) as f:
+            payloads.append((schema_for(exchange["url"]), f.read()))
+    return payloads
+
+
+def synthetic_payloads():
+    analyses = {
+        "data": [
+            {
+                "id": "MGYA%08d" % i,
+                "type": "analysis-jobs",
+                "attributes": {
+                    "accession": "MGYA%08d" % i,
+                    "experiment-type": "metagenomic",
+                    "pipeline-version": "5.0",
+                    "analysis-summary": [
+                        {"key": "Summary key %s" % k, "value": str(k * 1000)}
+                        for k in range(40)
+                    ],
+                },
+                "relationships": {
+                    name: {"data": {"id": "%s%s" % (name, i), "type": name}}
+                    for name in ("study", "sample", "run", "assembly")
+                },
+            }
+            for i in range(100)
+        ],
+        "links": {"next": "https://example.org/analyses?page=2"},
+        "meta": {"pagination": {"count": 10000, "page": 1, "pages": 100}},
+    }
+    search = {
+        "status": "DONE",
+        "results": {
+            "uuid": "0000",
+            "hits": [
+                {
+                    "name": "MGYP%012d" % i,
+                    "desc": "hypothetical protein",
+                    "evalue": "1.2e-50",
+                    "pvalue": -120.5,
+                    "score": "180.3",
+                    "nreported": 1,
+                    "mgnify": {"samples": [["ERS%s" % i, 1]], "runs": []},
+                    "domains": [
+                        {
+                            "alisqacc": "MGYP%012d" % i,
+                            "aliaseq": "MSTHPIRVFSEIGKLKKVMLHRPGKELENLQPDYLERLL" * 5,
+                            "alimodel": "MSTHPIRVFSEIGKLKKVMLHRPGKELENLQPDYLERLL" * 5,
+                            "alippline": "+" * 195,
+                            "ievalue": "1e-50",
+                            "bitscore": 180.3,
+                        }
+                        for _ in range(3)
+                    ],
+                }
+                for i in range(1000)
+            ],
+        },
+    }
+    return [
+        (AnalysesPage, json.dumps(analyses).encode()),
+        (SearchResponse, json.dumps(search).encode()),
+    ]
+
+
+def decoders():
+    """The full decoders available, and the toolkit decoding with schemas."""
+    cases = {"json.loads": lambda content, schema: json.loads(content)}
+    if decoding.orjson is not None:
+        cases["orjson.loads"] = lambda content, schema: decoding.orjson.loads(content)
+    if decoding.msgspec is not None:
+        cases["msgspec.json.decode"] = (
+            lambda content, schema: decoding.msgspec.json.decode(content)
+        )
+    cases["decoding.decode"] = decoding.decode
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--recording", help="directory written by --record")
+    parser.add_argument("-n", "--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.recording:
+        payloads = load_recording(args.recording)
+    else:
+        payloads = synthetic_payloads()
+    size = sum(len(content) for _, content in payloads)
+    print("{} payloads, {:.1f} MB".format(len(payloads), size / 1e6))
+
+    for name, decode in decoders().items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for schema, content in payloads:
+                decode(content, schema)
+            timings.append(time.perf_counter() - start)
+        print(
+            "{:<20} best {:8.2f} ms   median {:8.2f} ms".format(
+                name, min(timings) * 1000, statistics.median(timings) * 1000
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
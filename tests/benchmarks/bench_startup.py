@@ -0,0 +1,57 @@
+#!/bin/env python3
+
+"""
+Start-up time of the command line.
+
+Runs `mg-toolkit --version` and imports each tool in a new interpreter
+several times and prints the best and median wall time of each.
+
+    python tests/benchmarks/bench_startup.py [-n 20]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+CASES = {
+    "mg-toolkit --version": [sys.executable, "-m", "mg_toolkit", "--version"],
+    "import bulk_download": [
+        sys.executable,
+        "-c",
+        "from mg_toolkit import bulk_download",
+    ],
+    "import original_metadata": [
+        sys.executable,
+        "-c",
+        "from mg_toolkit import original_metadata",
+    ],
+    "import sequence_search": [
+        sys.executable,
+        "-c",
+        "from mg_toolkit import sequence_search",
+    ],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for name, command in CASES.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+        print(
+            "{:<28} best {:7.1f} ms   median {:7.1f} ms".format(
+                name, min(timings) * 1000, statistics.median(timings) * 1000
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/bin/env python3
+
+import json
+import unittest
+from unittest import mock
+
+from mg_toolkit.api import (
+    Analysis,
+    iter_analyses,
+    iter_downloads,
+    iter_sample_metadata,
+    iter_search_hits,
+)
+from mg_toolkit.exceptions import FailToGetException
+
+
+def _response(data, next_url=None, status_code=200):
+    response = mock.Mock(ok=status_code == 200, status_code=status_code)
+    response.content = json.dumps({"data": data, "links": {"next": next_url}}).encode()
+    return response
+
+
+def _analysis(accession):
+    return {
+        "id": accession,
+        "attributes": {"experiment-type": "amplicon", "pipeline-version": "4.1"},
+        "relationships": {
+            "study": {"data": {"id": "MGYS00002478"}},
+            "sample": {"data": {"id": "ERS1"}},
+            "run": {"data": {"id": "ERR1"}},
+        },
+    }
+
+
+class ApiTests(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.Mock()
+        patcher = mock.patch("mg_toolkit.api.get_session", return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_iter_analyses_pages(self):
+        """Test the pages are requested as the iterator is consumed"""
+        self.session.get.side_effect = [
+            _response([_analysis("MGYA1"), _analysis("MGYA2")], "http://next"),
+            _response([_analysis("MGYA3")]),
+        ]
+        analyses = iter_analyses("MGYS00002478", pipeline="4.1")
+
+        first = next(analyses)
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(
+            self.session.get.call_args[1]["params"],
+            {"study_accession": "MGYS00002478", "pipeline_version": "4.1"},
+        )
+        self.assertEqual(
+            first[:6], ("MGYA1", "MGYS00002478", "ERS1", "ERR1", "amplicon", "4.1")
+        )
+
+        self.assertEqual([a.accession for a in analyses], ["MGYA2", "MGYA3"])
+        self.assertEqual(self.session.get.call_args[0], ("http://next",))
+        self.assertIsNone(self.session.get.call_args[1]["params"])
+
+    def test_iter_analyses_error(self):
+        """Test a failed page raises"""
+        self.session.get.return_value = _response([], status_code=500)
+        with self.assertRaises(FailToGetException):
+            list(iter_analyses("MGYS00002478"))
+
+    def test_iter_downloads(self):
+        """Test the download entries of an analysis"""
+        self.session.get.return_value = _response(
+            [
+                {
+                    "attributes": {
+                        "alias": "ERR1_MERGED_FASTQ_SSU.fasta.mseq.gz",
+                        "group-type": "Taxonomic analysis SSU rRNA",
+                        "description": {"label": "Reads encoding SSU rRNA"},
+                        "file-format": {"name": "FASTA"},
+                        "file-checksum": {"checksum": "", "checksum-algorithm": ""},
+                    },
+                    "links": {"self": "https://example.org/file"},
+                    "relationships": {"pipeline": {"data": {"id": "4.1"}}},
+                }
+            ]
+        )
+        analysis = Analysis("MGYA1", None, None, None, "amplicon", "4.1", {})
+
+        (download,) = iter_downloads(analysis)
+
+        self.assertIn("/analyses/MGYA1/downloads", self.session.get.call_args[0][0])
+        self.assertEqual(download.analysis, "MGYA1")
+        self.assertEqual(download.group_type, "Taxonomic analysis SSU rRNA")
+        self.assertEqual(download.description, "Reads encoding SSU rRNA")
+        self.assertEqual(download.file_format, "FASTA")
+        self.assertEqual(download.url, "https://example.org/file")
+        self.assertEqual(download.pipeline_version, "4.1")
+        self.assertIsNone(download.checksum)
+
+    def test_iter_sample_metadata(self):
+        """Test the metadata records of the runs"""
+        with mock.patch(
+            "mg_toolkit.metadata.OriginalMetadata.iter_metadata",
+            return_value=iter(
+                [("ERR1", {"depth": "5m", "Sample": "ERS1", "Read depth": "10"})]
+            ),
+        ):
+            (record,) = iter_sample_metadata("ERP001736")
+
+        self.assertEqual(record.run, "ERR1")
+        self.assertEqual(record.sample, "ERS1")
+        self.assertEqual(record.read_depth, "10")
+        self.assertEqual(record.metadata, {"depth": "5m"})
+
+    def test_iter_search_hits(self):
+        """Test a hit is yielded per subject and accession"""
+        results = {
+            ("MGYP1", "ERS1"): {"evalue": "1e-10", "biome": "Soil"},
+            ("MGYP1", "ERR2"): {"evalue": "1e-10"},
+        }
+        with mock.patch(
+            "mg_toolkit.search.SequenceSearch.analyse_sequence",
+            return_value={"results": {"uuid": "u", "hits": []}},
+        ), mock.patch(
+            "mg_toolkit.search.SequenceSearch.fetch_results", return_value=results
+        ):
+            hits = list(iter_search_hits("MSTHPIRV", query_id="q1"))
+
+        self.assertEqual(
+            [hit[:3] for hit in hits],
+            [("q1", "MGYP1", "ERS1"), ("q1", "MGYP1", "ERR2")],
+        )
+        self.assertEqual(hits[0].fields["biome"], "Soil")
@@ -0,0 +1,388 @@
+#!/bin/env python3
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stderr
+from queue import PriorityQueue
+from unittest import mock
+
+from mg_toolkit.__main__ import run
+from mg_toolkit.bulk_download import (
+    METADATA_COLUMNS,
+    BulkDownloader,
+    EventStream,
+    MetadataWriter,
+    ThroughputMonitor,
+)
+from mg_toolkit.exceptions import DownloadStalled
+
+ANALYSES = {
+    "meta": {"pagination": {"count": 1}},
+    "links": {"next": None},
+    "data": [
+        {
+            "id": "MGYA1",
+            "attributes": {"experiment-type": "amplicon", "pipeline-version": "4.1"},
+        }
+    ],
+}
+
+
+def _download(alias, group_type, label):
+    return {
+        "attributes": {
+            "alias": alias,
+            "group-type": group_type,
+            "description": {"label": label},
+        },
+        "links": {"self": "https://example.org/" + alias},
+        "relationships": {"pipeline": {"data": {"id": "4.1"}}},
+    }
+
+
+DOWNLOADS = {
+    "links": {"next": None},
+    "data": [
+        _download("MGYA1_ssu.tsv", "Taxonomic analysis SSU rRNA", "OTUs, counts"),
+        _download("MGYA1_cds.faa", "Sequence data", "Predicted CDS with annotation"),
+        _download("MGYA1_stats.tsv", "Statistics", "Statistics"),
+        _download("MGYA1_missing.tsv", "Statistics", "Missing file"),
+    ],
+}
+
+
+def _response(url, **kwargs):
+    response = mock.MagicMock(ok=True, status_code=200)
+    response.__enter__.return_value = response
+    if url.endswith("/analyses"):
+        response.content = json.dumps(ANALYSES).encode()
+    elif url.endswith("/downloads"):
+        response.content = json.dumps(DOWNLOADS).encode()
+    elif url.endswith("missing.tsv"):
+        from requests import HTTPError
+
+        response.raise_for_status.side_effect = HTTPError("404 Not Found")
+    else:
+        response.iter_content.return_value = [url.encode()]
+    return response
+
+
+class EventsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_ndjson_events(self):
+        """Test the download progress is written as json lines"""
+        stdout = io.StringIO()
+        downloader = BulkDownloader("MGYS1", self.tmp, None, None, events="ndjson")
+        downloader.events = EventStream(stdout)
+        downloader.http = mock.Mock(get=mock.Mock(side_effect=_response))
+
+        downloader.run()
+
+        events = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(
+            [(e["event"], e.get("alias")) for e in events],
+            [
+                ("analysis", None),
+                ("queued", "MGYA1_ssu.tsv"),
+                ("completed", "MGYA1_ssu.tsv"),
+                ("skipped", "MGYA1_cds.faa"),
+                ("queued", "MGYA1_stats.tsv"),
+                ("completed", "MGYA1_stats.tsv"),
+                ("queued", "MGYA1_missing.tsv"),
+                ("failed", "MGYA1_missing.tsv"),
+                ("finished", None),
+            ],
+        )
+        completed = events[2]
+        content = b"https://example.org/MGYA1_ssu.tsv"
+        self.assertEqual(completed["analysis"], "MGYA1")
+        self.assertEqual(completed["size"], len(content))
+        self.assertEqual(completed["checksum"], hashlib.sha256(content).hexdigest())
+        with open(completed["path"], "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(events[3]["reason"], "not_applicable")
+        self.assertFalse(os.path.exists(events[7]["path"]))
+
+
+class GatedQueue(PriorityQueue):
+    """Queue of the downloads held until the files are all queued"""
+
+    def __init__(self, files):
+        super().__init__()
+        self.files = files
+
+    def get(self, *args, **kwargs):
+        with self.not_empty:
+            self.not_empty.wait_for(lambda: self._qsize() >= self.files)
+        self.files = 0
+        return super().get(*args, **kwargs)
+
+
+class PriorityTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _finished(self, **kwargs):
+        stdout = io.StringIO()
+        downloader = BulkDownloader(
+            "MGYS1", self.tmp, None, None, events="ndjson", **kwargs
+        )
+        downloader.events = EventStream(stdout)
+        downloader.http = mock.Mock(
+            get=mock.Mock(side_effect=_response),
+            head=mock.Mock(
+                side_effect=lambda url, **kwargs: mock.Mock(
+                    headers={"Content-Length": str(100 - len(url))}
+                )
+            ),
+        )
+        # the downloads start once the three files are listed
+        downloader.queue = GatedQueue(3)
+        downloader.run()
+        events = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        return [e["alias"] for e in events if e["event"] in ("completed", "failed")]
+
+    def test_group_priority(self):
+        """Test the groups are downloaded in the group order"""
+        self.assertEqual(
+            self._finished(priority="group"),
+            ["MGYA1_stats.tsv", "MGYA1_missing.tsv", "MGYA1_ssu.tsv"],
+        )
+        shutil.rmtree(os.path.join(self.tmp, "MGYS1"))
+        self.assertEqual(
+            self._finished(group_order=["taxonomic_analysis_ssu_rrna"]),
+            ["MGYA1_ssu.tsv", "MGYA1_stats.tsv", "MGYA1_missing.tsv"],
+        )
+
+    def test_size_priority(self):
+        """Test the smallest files are downloaded first"""
+        self.assertEqual(
+            self._finished(priority="size"),
+            ["MGYA1_missing.tsv", "MGYA1_stats.tsv", "MGYA1_ssu.tsv"],
+        )
+
+    def test_size_group_order(self):
+        """Test the group order can't be used with the size priority"""
+        with self.assertRaises(ValueError):
+            BulkDownloader(
+                "MGYS1", self.tmp, None, None, priority="size", group_order=["x"]
+            )
+        with redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                run(
+                    [
+                        "bulk_download",
+                        "-a",
+                        "MGYS1",
+                        "--priority",
+                        "size",
+                        "--group-order",
+                        "x",
+                    ]
+                )
+        self.assertIn("--group-order can't be used", stderr.getvalue())
+
+    def test_download_while_listing(self):
+        """Test the queued files are downloaded while the study is listed"""
+        analyses = dict(
+            ANALYSES,
+            meta={"pagination": {"count": 2}},
+            data=ANALYSES["data"] + [dict(ANALYSES["data"][0], id="MGYA2")],
+        )
+        fetched = threading.Event()
+
+        def get(url, **kwargs):
+            if url.endswith("/analyses"):
+                response = mock.MagicMock(ok=True, status_code=200)
+                response.content = json.dumps(analyses).encode()
+                return response
+            if "MGYA2" in url:
+                # listed once a file of MGYA1 is downloaded
+                self.assertTrue(fetched.wait(5))
+            return _response(url, **kwargs)
+
+        downloader = BulkDownloader("MGYS1", self.tmp, None, None, priority="group")
+        downloader.http = mock.Mock(get=mock.Mock(side_effect=get))
+        fetch = downloader._fetch
+        downloader._fetch = lambda event: (fetch(event), fetched.set())
+
+        downloader.run()
+
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(self.tmp, "MGYS1", "4.1", "statistics", "MGYA1_stats.tsv")
+            )
+        )
+
+
+class MetadataTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_writer(self):
+        """Test the rows are written sorted and merged with a previous run"""
+        filename = os.path.join(self.tmp, "MGYS1", "MGYS1_metadata.tsv")
+        with MetadataWriter(filename, batch_size=2) as writer:
+            writer.add([["MGYA3", "c.tsv"], ["MGYA1", "b.tsv"]])
+            writer.add([["MGYA2", "a.tsv"]])
+        with open(filename, newline="") as f:
+            first_run = f.read()
+
+        with MetadataWriter(filename, batch_size=2) as writer:
+            writer.add([["MGYA2", "a.tsv"], ["MGYA1", "a.tsv", None]])
+
+        with open(filename) as f:
+            rows = [line.split("\t") for line in f.read().splitlines()]
+        self.assertEqual(first_run.count("\r\n"), 4)
+        self.assertEqual(rows[0], METADATA_COLUMNS)
+        self.assertEqual(
+            rows[1:],
+            [
+                ["MGYA1", "a.tsv", ""],
+                ["MGYA1", "b.tsv"],
+                ["MGYA2", "a.tsv"],
+                ["MGYA3", "c.tsv"],
+            ],
+        )
+        self.assertEqual(os.listdir(os.path.dirname(filename)), ["MGYS1_metadata.tsv"])
+
+    def test_batches(self):
+        """Test the file is replaced with the merged rows of each batch"""
+        filename = os.path.join(self.tmp, "MGYS1", "MGYS1_metadata.tsv")
+        with open(os.path.join(self.tmp, "previous.tsv"), "w") as f:
+            f.write("MGYA4\tb.tsv\nMGYA0\ta.tsv\n")
+        os.makedirs(os.path.dirname(filename))
+        os.replace(os.path.join(self.tmp, "previous.tsv"), filename)
+
+        writer = MetadataWriter(filename, batch_size=2)
+        writer.add([["MGYA3", "c.tsv"]])
+        writer.add([["MGYA1", "b.tsv"]])
+        writer.add([["MGYA2", "a.tsv"]])
+        # killed before close
+        with open(filename) as f:
+            rows = [line.split("\t") for line in f.read().splitlines()]
+        self.assertEqual(
+            rows,
+            [
+                METADATA_COLUMNS,
+                ["MGYA0", "a.tsv"],
+                ["MGYA1", "b.tsv"],
+                ["MGYA3", "c.tsv"],
+                ["MGYA4", "b.tsv"],
+            ],
+        )
+
+        writer.close()
+        with open(filename) as f:
+            self.assertEqual(len(f.read().splitlines()), 6)
+        self.assertEqual(os.listdir(os.path.dirname(filename)), ["MGYS1_metadata.tsv"])
+
+    def test_download_pages(self):
+        """Test the next pages of downloads are followed"""
+        pages = {
+            "https://example.org/downloads?page=%s"
+            % page: {
+                "links": {
+                    "next": (
+                        "https://example.org/downloads?page=%s" % (page + 1)
+                        if page < 3
+                        else None
+                    )
+                },
+                "data": [
+                    _download("MGYA1_%s.tsv" % page, "Statistics", "Statistics"),
+                ],
+            }
+            for page in (1, 2, 3)
+        }
+
+        def get(url, **kwargs):
+            response = mock.MagicMock(ok=True, status_code=200)
+            response.content = json.dumps(pages[url]).encode()
+            return response
+
+        downloader = BulkDownloader("MGYS1", self.tmp, None, None)
+        downloader.http = mock.Mock(get=mock.Mock(side_effect=get))
+        downloader.download_file = mock.Mock()
+
+        with downloader.metadata, ThreadPoolExecutor(max_workers=1) as prefetch:
+            downloader._prefetch = prefetch
+            downloader._process_download_page(
+                ANALYSES["data"][0], get("https://example.org/downloads?page=1")
+            )
+
+        self.assertEqual(
+            [c[1]["file_name"] for c in downloader.download_file.call_args_list],
+            ["MGYA1_1.tsv", "MGYA1_2.tsv", "MGYA1_3.tsv"],
+        )
+        with open(os.path.join(self.tmp, "MGYS1", "MGYS1_metadata.tsv")) as f:
+            self.assertEqual(len(f.read().splitlines()), 4)
+
+
+class StallTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_monitor(self):
+        """Test a throughput under the floor for the window raises"""
+        with mock.patch("time.monotonic") as monotonic:
+            monotonic.return_value = 0
+            monitor = ThroughputMonitor(floor=100, seconds=10)
+            monotonic.return_value = 5
+            monitor.update(10)
+            monotonic.return_value = 10
+            monitor.update(2000)
+            monotonic.return_value = 20
+            with self.assertRaises(DownloadStalled):
+                monitor.update(500)
+
+    def test_resume(self):
+        """Test a stalled download is retried from where it stopped"""
+
+        def stalled_chunks():
+            yield b"first "
+            raise DownloadStalled("0 bytes/s")
+
+        first = mock.MagicMock(status_code=200)
+        first.__enter__.return_value = first
+        first.iter_content.return_value = stalled_chunks()
+        second = mock.MagicMock(status_code=206)
+        second.__enter__.return_value = second
+        second.iter_content.return_value = [b"second"]
+
+        downloader = BulkDownloader("MGYS1", self.tmp, None, None)
+        downloader.http = mock.Mock(get=mock.Mock(side_effect=[first, second]))
+        output_file = os.path.join(self.tmp, "file.tsv")
+
+        size, checksum = downloader.download_resource_by_url(
+            "https://example.org/file.tsv", output_file
+        )
+
+        with open(output_file, "rb") as f:
+            self.assertEqual(f.read(), b"first second")
+        self.assertEqual(size, 12)
+        self.assertEqual(checksum, hashlib.sha256(b"first second").hexdigest())
+        self.assertEqual(
+            downloader.http.get.call_args[1]["headers"], {"Range": "bytes=6-"}
+        )
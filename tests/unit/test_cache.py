@@ -0,0 +1,87 @@
+#!/bin/env python3
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mg_toolkit.cache import SearchCache
+
+
+class SearchCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_key(self):
+        """Test the key uses the normalised sequence and all the parameters"""
+        data = {"seqdb": "full", "seq": "MSTH\nPIRV*", "incE": 0.01}
+        key = SearchCache.key(data)
+
+        self.assertEqual(
+            key, SearchCache.key({"incE": 0.01, "seq": "msthpirv", "seqdb": "full"})
+        )
+        self.assertNotEqual(key, SearchCache.key(dict(data, incE=0.02)))
+        self.assertNotEqual(key, SearchCache.key(dict(data, seqdb="all")))
+
+    def test_get_set(self):
+        """Test a stored response is returned until it expires"""
+        cache = SearchCache(self.tmp, ttl=60)
+        response = {"results": {"uuid": "1234", "hits": []}}
+        cache.set("abcd", response)
+
+        self.assertEqual(cache.get("abcd"), response)
+        self.assertIsNone(cache.get("efgh"))
+
+        old = time.time() - 120
+        os.utime(cache._path("abcd"), (old, old))
+        self.assertIsNone(cache.get("abcd"))
+
+    def test_replace(self):
+        """Test replacing an expired entry doesn't count it twice"""
+        cache = SearchCache(self.tmp)
+        cache.set("abcd", {"results": {"hits": ["x" * 1000]}})
+        cache.set("abcd", {"results": {"hits": ["y" * 1000]}})
+
+        self.assertEqual(cache._size, os.path.getsize(cache._path("abcd")))
+
+    def test_lock(self):
+        """Test only the searches of the same key wait for each other"""
+        cache = SearchCache(self.tmp)
+        acquired = threading.Event()
+
+        def _other(key):
+            with cache.lock(key):
+                acquired.set()
+
+        with cache.lock("abcd"):
+            threading.Thread(target=_other, args=("efgh",)).start()
+            self.assertTrue(acquired.wait(5))
+            acquired.clear()
+            thread = threading.Thread(target=_other, args=("abcd",))
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+        thread.join()
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(cache._key_locks, {})
+
+    def test_eviction(self):
+        """Test the least recently used entries are evicted"""
+        cache = SearchCache(self.tmp)
+        response = {"results": {"hits": ["x" * 1000]}}
+        for i, key in enumerate(["aa01", "bb02", "cc03"]):
+            cache.set(key, response)
+            past = time.time() - 100 + i
+            os.utime(cache._path(key), (past, past))
+
+        cache.max_size = cache._size - 1
+        cache.get("aa01")
+        cache.set("dd04", response)
+
+        self.assertIsNotNone(cache.get("aa01"))
+        self.assertIsNone(cache.get("bb02"))
+        self.assertIsNotNone(cache.get("dd04"))
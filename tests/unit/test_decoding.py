@@ -0,0 +1,66 @@
+#!/bin/env python3
+
+import json
+import unittest
+from unittest import mock
+
+from mg_toolkit import decoding
+from mg_toolkit.decoding import AnalysesPage, SearchResponse, decode
+
+ANALYSES_PAGE = {
+    "data": [
+        {
+            "id": "MGYA1",
+            "type": "analysis-jobs",
+            "attributes": {
+                "experiment-type": "amplicon",
+                "pipeline-version": "4.1",
+                "analysis-summary": [{"key": "Reads", "value": "100"}],
+            },
+        }
+    ],
+    "links": {"next": None},
+    "meta": {"pagination": {"count": 1}},
+}
+
+
+class DecodeTests(unittest.TestCase):
+    def test_decode(self):
+        """Test the keys read by the tools are decoded"""
+        page = decode(json.dumps(ANALYSES_PAGE).encode(), AnalysesPage)
+
+        self.assertEqual(page["meta"], {"pagination": {"count": 1}})
+        self.assertIsNone(page["links"]["next"])
+        self.assertEqual(page["data"][0]["id"], "MGYA1")
+        self.assertEqual(page["data"][0]["attributes"]["experiment-type"], "amplicon")
+
+    @unittest.skipIf(decoding.msgspec is None, "msgspec is not installed")
+    def test_decode_partial(self):
+        """Test the keys missing from the schema are skipped"""
+        page = decode(json.dumps(ANALYSES_PAGE).encode(), AnalysesPage)
+
+        self.assertNotIn("type", page["data"][0])
+        self.assertNotIn("analysis-summary", page["data"][0]["attributes"])
+
+    def test_decode_mismatch(self):
+        """Test a document not matching the schema is decoded in full"""
+        document = {"status": "DONE", "results": {"hits": "none"}}
+        self.assertEqual(
+            decode(json.dumps(document).encode(), SearchResponse), document
+        )
+
+    def test_decode_invalid(self):
+        """Test invalid documents raise a JSONDecodeError"""
+        for schema in (None, SearchResponse):
+            with self.assertRaises(json.JSONDecodeError):
+                decode(b"<html>Service unavailable</html>", schema)
+
+    def test_stdlib(self):
+        """Test the standard library is used without msgspec and orjson"""
+        with mock.patch.object(decoding, "msgspec", None), mock.patch.object(
+            decoding, "orjson", None
+        ):
+            page = decode(json.dumps(ANALYSES_PAGE).encode(), AnalysesPage)
+            with self.assertRaises(json.JSONDecodeError):
+                decode(b"", AnalysesPage)
+        self.assertEqual(page, ANALYSES_PAGE)
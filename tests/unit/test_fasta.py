@@ -0,0 +1,107 @@
+#!/bin/env python3
+
+import gzip
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from mg_toolkit.fasta import FastaIndex, iter_fasta, iter_indexed_fasta
+
+
+class FastaReaderTests(unittest.TestCase):
+    expected = [
+        ("fasta_one example", "MSTHPIRVFSEIGKLKKVMLHRPGKELENLQPDYLERLLFDD"),
+        ("fasta_two example", "EEYLEEANIRGRETKKAIRELLHGIKDNQELVEKT"),
+        (
+            "fasta_three example",
+            "AVSLNHMYADTRNRETLYGKYIFKYHPVYGGNVELVYNREEDTRIEGGDELVLSKDVLAVGISQRTDAA",
+        ),
+    ]
+
+    def setUp(self):
+        self.test_fasta = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "fixtures", "test.fasta"
+        )
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_iter_fasta(self):
+        """Test the records are yielded lazily"""
+        records = iter_fasta(self.test_fasta)
+        self.assertIsInstance(records, types.GeneratorType)
+        self.assertEqual(list(records), self.expected)
+
+    def test_iter_fasta_gzip(self):
+        """Test gzip compressed files are read transparently"""
+        gz_fasta = os.path.join(self.tmp, "test.fasta.gz")
+        with open(self.test_fasta, "rb") as f_in, gzip.open(gz_fasta, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+        self.assertEqual(list(iter_fasta(gz_fasta)), self.expected)
+
+    def test_iter_fasta_leading_data(self):
+        """Test the lines before the first header are skipped"""
+        fasta = os.path.join(self.tmp, "leading.fasta")
+        with open(fasta, "w") as f:
+            f.write("\nMSTH\n>seq\nEEYL\nEANI\n")
+
+        with self.assertLogs("mg_toolkit.fasta", level="WARNING"):
+            self.assertEqual(list(iter_fasta(fasta)), [("seq", "EEYLEANI")])
+
+
+class FastaIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.tmp, "queries.fasta")
+        self.records = [
+            ("seq_{} example".format(i), "MSTHPIRVFS" * i + "EEYL"[: i % 4])
+            for i in range(1, 10)
+        ]
+        with open(self.fasta, "w") as f:
+            for name, sequence in self.records:
+                f.write(">{}\n".format(name))
+                for start in range(0, len(sequence), 7):
+                    f.write(sequence[start : start + 7] + "\n")
+            # uneven line lengths and blank lines
+            f.write(">uneven\nMST\nHPIRVF\n\nSEIG\n")
+        self.records.append(("uneven", "MSTHPIRVFSEIG"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_index(self):
+        """Test all the records are read back from the index"""
+        self.assertEqual(list(iter_indexed_fasta(self.fasta)), self.records)
+        self.assertTrue(os.path.exists(self.fasta + ".mgidx"))
+
+        index = FastaIndex.load(self.fasta + ".mgidx")
+        self.assertEqual(index.entries, FastaIndex.build(self.fasta).entries)
+
+    def test_shards(self):
+        """Test the shards split the records without overlap"""
+        shards = [list(iter_indexed_fasta(self.fasta, shard=(i, 3))) for i in (1, 2, 3)]
+        self.assertEqual([len(shard) for shard in shards], [3, 3, 4])
+        self.assertEqual(sum(shards, []), self.records)
+
+    def test_ids(self):
+        """Test the records are selected by query_id or first word"""
+        records = list(iter_indexed_fasta(self.fasta, ids={"seq_2", "uneven"}))
+        self.assertEqual(records, [self.records[1], self.records[-1]])
+
+    def test_empty_header(self):
+        """Test a record without header is indexed and selected like iter_fasta"""
+        with open(self.fasta, "a") as f:
+            f.write(">\nMSTH\n")
+        records = list(iter_indexed_fasta(self.fasta, ids={"", "seq_1"}))
+        self.assertEqual(records, [self.records[0], ("", "MSTH")])
+        self.assertEqual(list(iter_fasta(self.fasta))[-1], ("", "MSTH"))
+
+    def test_samtools_index(self):
+        """Test a samtools index of the file isn't used"""
+        with open(self.fasta + ".fai", "w") as f:
+            f.write("seq_1\t14\t7\t7\t8\n")
+        self.assertEqual(list(iter_indexed_fasta(self.fasta)), self.records)
@@ -0,0 +1,222 @@
+#!/bin/env python3
+
+import argparse
+import csv
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from mg_toolkit.merge import SparseCounts, merge, read_counts, table_parser
+
+METADATA_COLUMNS = [
+    "analysis_id",
+    "name",
+    "group_type",
+    "description",
+    "download_url",
+    "pipeline_version",
+    "experiment_type",
+]
+
+OTU_TABLE = (
+    "# Constructed from biom file\n"
+    "#OTU ID\tERR1\ttaxonomy\n"
+    "10\t5.0\tsk__Bacteria;k__;p__Firmicutes\n"
+    "11\t2.0\tsk__Bacteria;k__;p__Proteobacteria\n"
+    "12\t1.0\tsk__Bacteria;k__;p__Firmicutes\n"
+)
+
+KRONA = (
+    "11\tsk__Bacteria\tk__\tp__Firmicutes\n"
+    "3\tsk__Bacteria\tk__\tp__Proteobacteria\n"
+    "3\tsk__Bacteria\tk__\tp__Firmicutes\n"
+    "2\tsk__Archaea\n"
+)
+
+I5_MATCHES = (
+    "ERR1.1\t0a1b\t312\tPfam\tPF00051\tKringle domain\t20\t96\t1.2E-20"
+    "\tT\t01-01-2020\tIPR000001\tKringle\n"
+)
+
+GO_SLIM = (
+    "GO:0003824,catalytic activity,molecular_function,120\n"
+    "GO:0008152,metabolic process,biological_process,80\n"
+)
+
+
+class MergeTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.project_dir = os.path.join(self.tmp, "MGYS1")
+        os.makedirs(self.project_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, relative_path, text):
+        path = os.path.join(self.project_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt") as f:
+            f.write(text)
+        return path
+
+    def test_read_counts(self):
+        """Test the counts of each kind of table"""
+        counts, descriptions = read_counts(self._write("otu.tsv", OTU_TABLE), "otu")
+        self.assertEqual(
+            counts,
+            {
+                "sk__Bacteria;k__;p__Firmicutes": 6.0,
+                "sk__Bacteria;k__;p__Proteobacteria": 2.0,
+            },
+        )
+
+        counts, descriptions = read_counts(self._write("go.csv.gz", GO_SLIM), "go")
+        self.assertEqual(counts, {"GO:0003824": 120.0, "GO:0008152": 80.0})
+        self.assertEqual(
+            descriptions["GO:0003824"], "catalytic activity; molecular_function"
+        )
+
+        counts, _ = read_counts(self._write("krona.txt", KRONA), "krona")
+        self.assertEqual(
+            counts,
+            {
+                "sk__Bacteria;k__;p__Firmicutes": 14.0,
+                "sk__Bacteria;k__;p__Proteobacteria": 3.0,
+                "sk__Archaea": 2.0,
+            },
+        )
+
+        counts, descriptions = read_counts(
+            self._write("ipr.tsv", "IPR000001\tKringle\t12\n5\tIPR000003\tRXR\n"),
+            "interpro",
+        )
+        self.assertEqual(counts, {"IPR000001": 12.0, "IPR000003": 5.0})
+        self.assertEqual(descriptions["IPR000003"], "RXR")
+
+    def test_read_matches(self):
+        """Test an InterProScan matches file isn't read as a summary"""
+        path = self._write("I5.tsv.gz", I5_MATCHES)
+        self.assertIsNone(table_parser("InterPro matches", "ERR1_I5.tsv.gz"))
+        with self.assertLogs("mg_toolkit.merge", "WARNING"):
+            self.assertIsNone(read_counts(path.replace(".gz", ""), "interpro"))
+
+    def test_read_corrupt(self):
+        """Test an unreadable table is skipped"""
+        path = self._write("otu.tsv.gz", OTU_TABLE)
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(data[: len(data) // 2])
+        with self.assertLogs("mg_toolkit.merge", "WARNING"):
+            self.assertIsNone(read_counts(path, "otu"))
+
+    def test_table_parser(self):
+        """Test the tables are matched by description and extension"""
+        self.assertEqual(
+            table_parser(
+                "OTUs, counts and taxonomic assignments for SSU rRNA",
+                "ERR1_SSU_OTU.tsv",
+            ),
+            "otu",
+        )
+        self.assertEqual(table_parser("GO slim annotation", "ERR1_GO_slim.csv"), "go")
+        self.assertEqual(table_parser("Krona text", "ERR1_SSU.fasta.mseq.txt"), "krona")
+        self.assertIsNone(table_parser("Krona plot", "krona.html"))
+        self.assertIsNone(table_parser("Reads encoding SSU rRNA", "ERR1_SSU.fasta.gz"))
+
+    def test_sparse_counts(self):
+        """Test the counts of an analysis in several tables are summed"""
+        matrix = SparseCounts()
+        matrix.add("MGYA1", {"a": 1.0, "b": 2.0}, {})
+        matrix.add("MGYA2", {"b": 3.0}, {})
+        matrix.add("MGYA1", {"a": 4.0}, {})
+
+        rows, columns, values = matrix.coordinates()
+        self.assertEqual(
+            list(zip(rows, columns, values)),
+            [(0, 0, 5.0), (1, 0, 2.0), (1, 1, 3.0)],
+        )
+
+    def test_merge(self):
+        """Test a matrix is written per kind of table"""
+        ssu = "OTUs, counts and taxonomic assignments for SSU rRNA"
+        rows = [
+            ["MGYA1", "ERR1_SSU.tsv", "Taxonomic analysis SSU rRNA", ssu],
+            ["MGYA2", "ERR2_SSU.tsv", "Taxonomic analysis SSU rRNA", ssu],
+            ["MGYA1", "ERR1_GO_slim.csv", "Functional analysis", "GO slim annotation"],
+            ["MGYA1", "ERR1_I5.tsv.gz", "Functional analysis", "InterPro matches"],
+            ["MGYA1", "ERR1_summary.tsv", "Statistics", "Summary"],
+            ["MGYA3", "ERR3_SSU.tsv", "Taxonomic analysis SSU rRNA", ssu],
+        ]
+        with open(os.path.join(self.project_dir, "MGYS1_metadata.tsv"), "w") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(METADATA_COLUMNS)
+            for row in rows:
+                writer.writerow(row + ["", "4.1", "amplicon"])
+        self._write("4.1/taxonomic_analysis_ssu_rrna/ERR1_SSU.tsv", OTU_TABLE)
+        self._write(
+            "4.1/taxonomic_analysis_ssu_rrna/ERR2_SSU.tsv",
+            "#OTU ID\tERR2\ttaxonomy\n20\t7\tsk__Archaea\n",
+        )
+        self._write("4.1/functional_analysis/ERR1_GO_slim.csv", GO_SLIM)
+        self._write("4.1/functional_analysis/ERR1_I5.tsv.gz", I5_MATCHES)
+        self._write("4.1/statistics/ERR1_summary.tsv", "reads\t100\n")
+
+        args = argparse.Namespace(
+            accession="MGYS1",
+            output_path=self.tmp,
+            result_group=None,
+            workers=2,
+            merged_path=None,
+            format="mtx",
+        )
+        with redirect_stdout(io.StringIO()), self.assertLogs(
+            "mg_toolkit.merge", "WARNING"
+        ) as logs:
+            self.assertEqual(merge(args), 0)
+        self.assertIn(
+            "WARNING:mg_toolkit.merge:Not merging the 1 files of InterPro matches",
+            logs.output,
+        )
+
+        merged_dir = os.path.join(self.project_dir, "merged")
+        prefix = os.path.join(
+            merged_dir,
+            "taxonomic_analysis_ssu_rrna_"
+            "otus_counts_and_taxonomic_assignments_for_ssu_rrna",
+        )
+        with open(prefix + ".mtx") as f:
+            self.assertEqual(
+                f.read().splitlines(),
+                [
+                    "%%MatrixMarket matrix coordinate real general",
+                    "3 2 3",
+                    "1 1 6",
+                    "2 1 2",
+                    "3 2 7",
+                ],
+            )
+        with open(prefix + ".analyses.tsv") as f:
+            self.assertEqual(f.read(), "analysis_id\nMGYA1\nMGYA2\n")
+        with open(prefix + ".features.tsv") as f:
+            self.assertEqual(
+                [line.split("\t")[0] for line in f.read().splitlines()],
+                [
+                    "feature",
+                    "sk__Bacteria;k__;p__Firmicutes",
+                    "sk__Bacteria;k__;p__Proteobacteria",
+                    "sk__Archaea",
+                ],
+            )
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(merged_dir, "functional_analysis_go_slim_annotation.mtx")
+            )
+        )
+        self.assertEqual(len(os.listdir(merged_dir)), 6)
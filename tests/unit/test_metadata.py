@@ -0,0 +1,125 @@
+#!/bin/env python3
+
+import argparse
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from mg_toolkit.metadata import MetadataTable, OriginalMetadata, original_metadata
+
+
+class MetadataTableTests(unittest.TestCase):
+    records = {
+        "ERR0002": {"depth": "10", "Sample": "ERS2", "biome": "ocean"},
+        "ERR0001": {"Sample": "ERS1", "temperature": "-1.5"},
+    }
+
+    def test_to_frame(self):
+        """Test the table columns are sorted and the missing cells are empty"""
+        table = MetadataTable()
+        for run, record in self.records.items():
+            table.append(run, record)
+
+        df = table.to_frame()
+
+        self.assertEqual(list(df.index), ["ERR0002", "ERR0001"])
+        self.assertEqual(df.index.name, "Run")
+        self.assertEqual(list(df.columns), ["Sample", "biome", "depth", "temperature"])
+        self.assertIsNone(df.loc["ERR0001", "depth"])
+        self.assertEqual(df.loc["ERR0002", "depth"], "10")
+
+    def test_to_frame_typed(self):
+        """Test the numeric columns get a numeric dtype"""
+        table = MetadataTable()
+        for run, record in self.records.items():
+            table.append(run, record)
+
+        df = table.to_frame(typed=True)
+
+        self.assertTrue(pd.api.types.is_numeric_dtype(df["depth"]))
+        self.assertTrue(pd.api.types.is_numeric_dtype(df["temperature"]))
+        self.assertEqual(df["Sample"].dtype, object)
+
+    def test_save_to_csv(self):
+        """Test the csv matches the transposed dict of dicts output"""
+        om = OriginalMetadata("ERP000001")
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "ERP000001.csv")
+            om.save_to_csv(self.records, filename)
+
+            expected = pd.DataFrame(self.records).T
+            expected.index.name = "Run"
+            expected = expected.reindex(sorted(expected.columns), axis=1)
+
+            with open(filename) as f:
+                self.assertEqual(f.read(), expected.to_csv())
+
+
+class UpdateTests(unittest.TestCase):
+    def _runs(self, **last_updated):
+        return {
+            run: {
+                "sample_accession": "ERS" + run[3:],
+                "read_depth": "10",
+                "last_updated": date,
+            }
+            for run, date in last_updated.items()
+        }
+
+    def _build(self, runs):
+        om = OriginalMetadata("ERP000001")
+        om.fetch_runs = mock.Mock(return_value=runs)
+        om.get_metadata = mock.Mock(
+            side_effect=lambda sample: {"sample_name": "name " + sample}
+        )
+        return om
+
+    def test_update(self):
+        """Test only the new and updated runs are fetched"""
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "ERP000001.csv")
+
+            om = self._build(self._runs(ERR1="2020-01-01", ERR2="2020-01-01"))
+            om.update(filename)
+            self.assertEqual(om.get_metadata.call_count, 2)
+
+            om = self._build(
+                self._runs(ERR1="2020-01-01", ERR2="2021-06-01", ERR3="2021-06-01")
+            )
+            om.update(filename)
+            om.get_metadata.assert_has_calls(
+                [mock.call("ERS2"), mock.call("ERS3")], any_order=True
+            )
+            self.assertEqual(om.get_metadata.call_count, 2)
+
+            df = pd.read_csv(filename, index_col="Run")
+            self.assertEqual(list(df.index), ["ERR1", "ERR2", "ERR3"])
+            self.assertEqual(df.loc["ERR3", "sample_name"], "name ERS3")
+
+    def test_update_without_state(self):
+        """Test the runs of an output without state are kept"""
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "ERP000001.csv")
+            OriginalMetadata("ERP000001").save_to_csv(
+                {"ERR1": {"Sample": "ERS1", "sample_name": "old"}}, filename
+            )
+
+            om = self._build(self._runs(ERR1="2020-01-01", ERR2="2020-01-01"))
+            om.update(filename)
+
+            om.get_metadata.assert_called_once_with("ERS2")
+            df = pd.read_csv(filename, index_col="Run")
+            self.assertEqual(df.loc["ERR1", "sample_name"], "old")
+            self.assertTrue(os.path.exists(filename + ".state.json"))
+
+    def test_missing_pyarrow(self):
+        """Test the parquet output without pyarrow fails with exit code 1"""
+        args = argparse.Namespace(accession=["ERP000001"], format="parquet")
+        with mock.patch.dict(sys.modules, {"pyarrow": None}), self.assertLogs(
+            "mg_toolkit.metadata", "ERROR"
+        ):
+            self.assertEqual(original_metadata(args), 1)
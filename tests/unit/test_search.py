@@ -1,9 +1,32 @@
 #!/bin/env python3
 
+import argparse
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
 
-from mg_toolkit.search import parse_fasta_file
+import pandas as pd
+
+from mg_toolkit.search import (
+    MetadataCache,
+    SequenceSearch,
+    get_accession_type,
+    parse_fasta_file,
+    sequence_search,
+)
+from mg_toolkit.writers import Checkpoint
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    pyarrow = None
 
 
 class FastaParseTests(unittest.TestCase):
@@ -23,3 +46,406 @@ class FastaParseTests(unittest.TestCase):
         fn_result = parse_fasta_file(test_fasta)
 
         self.assertDictEqual(fn_result, expected)
+
+
+class SequenceSearchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.tmp, "queries.fasta")
+        with open(self.fasta, "w") as f:
+            for i in range(6):
+                f.write(">query_{i}\nMSTHPIRVFSEIGK{i}\n".format(i=i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @staticmethod
+    def _analyse_sequence(search):
+        return {
+            "results": {
+                "uuid": "uuid-" + search.query_id,
+                "hits": [
+                    {
+                        "name": "MGYP0" + search.sequence[-1],
+                        "desc": "hit of " + search.query_id,
+                        "mgnify": {"samples": [["ERS000" + search.sequence[-1]]]},
+                    }
+                ],
+            }
+        }
+
+    @staticmethod
+    def _make_request(search, accession):
+        return {
+            "data": {
+                "attributes": {
+                    "sample-metadata": [
+                        {"key": "geographic location", "value": "ocean", "unit": None}
+                    ]
+                },
+                "relationships": {
+                    "biome": {"data": {"id": "root:Environmental:Aquatic:Marine"}}
+                },
+            }
+        }
+
+    def _run(self, **kwargs):
+        output = os.path.join(self.tmp, "out.csv")
+        args = argparse.Namespace(
+            sequence=[self.fasta], output=output, database="full", **kwargs
+        )
+        with mock.patch.object(
+            SequenceSearch, "analyse_sequence", self._analyse_sequence
+        ), mock.patch.object(SequenceSearch, "make_request", self._make_request):
+            sequence_search(args)
+        return pd.read_csv(output)
+
+    def test_sequence_search_workers(self):
+        """Test concurrent searches keep the rows tagged with their query"""
+        df = self._run(workers=4)
+
+        self.assertEqual(len(df), 6)
+        self.assertEqual(list(df["query_id"]), ["query_{}".format(i) for i in range(6)])
+        for _, row in df.iterrows():
+            self.assertEqual(row["desc"], "hit of " + row["query_id"])
+            self.assertEqual(row["accession"], "ERS000" + row["query_id"][-1])
+            self.assertEqual(row["biome"], "Marine")
+
+    def test_sequence_search_order(self):
+        """Test the rows are in the order of the queries whatever finishes first"""
+
+        def _analyse_sequence(search):
+            # the first queries finish last
+            time.sleep(0.05 * (6 - int(search.query_id[-1])))
+            return SequenceSearchTests._analyse_sequence(search)
+
+        with mock.patch.object(self, "_analyse_sequence", _analyse_sequence):
+            df = self._run(workers=3)
+
+        self.assertEqual(list(df["query_id"]), ["query_{}".format(i) for i in range(6)])
+
+    def test_fetch_results_deduplicates(self):
+        """Test each accession is requested once and fanned out to the hits"""
+        results = {
+            "hits": [
+                {
+                    "name": "MGYP01",
+                    "mgnify": {"samples": [["ERS01"], ["ERS02"]], "runs": None},
+                },
+                {"name": "MGYP02", "mgnify": {"runs": [["ERS01"]]}},
+            ]
+        }
+        cache = MetadataCache()
+        seq = SequenceSearch("MSTH", "query", metadata_cache=cache)
+        with mock.patch.object(
+            SequenceSearch, "make_bulk_request", return_value={}
+        ), mock.patch.object(
+            SequenceSearch, "make_request", autospec=True
+        ) as make_request:
+            make_request.side_effect = self._make_request
+            csv_rows = seq.fetch_results(results)
+            SequenceSearch("EEYL", "other", metadata_cache=cache).fetch_results(results)
+
+        self.assertEqual(make_request.call_count, 2)
+        self.assertEqual(
+            list(csv_rows),
+            [("MGYP01", "ERS01"), ("MGYP01", "ERS02"), ("MGYP02", "ERS01")],
+        )
+        self.assertEqual(csv_rows[("MGYP02", "ERS01")]["biome"], "Marine")
+
+    def test_bulk_request(self):
+        """Test samples are resolved in bulk and runs one by one"""
+        results = {
+            "hits": [
+                {
+                    "name": "MGYP01",
+                    "mgnify": {
+                        "samples": [["ERS01"], ["ERS02"]],
+                        "runs": [["ERR03"]],
+                    },
+                },
+            ]
+        }
+        request = self._make_request(None, None)
+        seq = SequenceSearch("MSTH", "query")
+        with mock.patch.object(
+            SequenceSearch,
+            "make_bulk_request",
+            return_value={"ERS01": request, "ERS02": request},
+        ) as make_bulk_request, mock.patch.object(
+            SequenceSearch, "make_request", return_value=request
+        ) as make_request:
+            csv_rows = seq.fetch_results(results)
+
+        make_bulk_request.assert_called_once_with(["ERS01", "ERS02"])
+        make_request.assert_called_once_with("ERR03")
+        self.assertEqual(len(csv_rows), 3)
+        self.assertEqual(csv_rows[("MGYP01", "ERS02")]["biome"], "Marine")
+
+    def test_search_timeout(self):
+        """Test the read timeout of the APIs doesn't apply to the searches"""
+        session = mock.Mock(post=mock.Mock(return_value=None))
+        seq = SequenceSearch("MSTHPIRV", "query", session=session)
+        seq.post_search(seq.search_data())
+        self.assertEqual(session.post.call_args[1]["timeout"][1], None)
+
+        seq = SequenceSearch("MSTHPIRV", "query", session=session, search_timeout=600)
+        seq.post_search(seq.search_data())
+        self.assertEqual(session.post.call_args[1]["timeout"][1], 600)
+
+    def test_get_accession_type(self):
+        """Test the endpoint routing by accession prefix"""
+        self.assertEqual(get_accession_type("ERS1234"), "sample")
+        self.assertEqual(get_accession_type("SAMEA1234"), "sample")
+        self.assertEqual(get_accession_type("SRR1234"), "run")
+        self.assertIsNone(get_accession_type("MGYS0001"))
+
+    def test_sequence_search_duplicates(self):
+        """Test duplicated sequences are searched once, rows for each query"""
+        with open(self.fasta, "w") as f:
+            f.write(">query_a\nMSTHPIRV1\n>query_b\nmsthpirv1\n>query_c\nEEYL2\n")
+
+        def _hits(uuid, name, accession):
+            hits = [{"name": name, "mgnify": {"samples": [[accession]]}}]
+            return {"results": {"uuid": uuid, "hits": hits}}
+
+        responses = {
+            "MSTHPIRV1": _hits("a", "MGYP1", "ERS01"),
+            "EEYL2": _hits("c", "MGYP2", "ERS02"),
+        }
+        post_search = mock.Mock(side_effect=lambda data: responses[data["seq"]])
+        responses["msthpirv1"] = responses["MSTHPIRV1"]
+
+        output = os.path.join(self.tmp, "out.csv")
+        args = argparse.Namespace(
+            sequence=[self.fasta], output=output, database="full", workers=2
+        )
+        with mock.patch.object(
+            SequenceSearch, "post_search", post_search
+        ), mock.patch.object(SequenceSearch, "make_request", self._make_request):
+            sequence_search(args)
+
+        self.assertEqual(post_search.call_count, 2)
+        df = pd.read_csv(output)
+        self.assertEqual(
+            list(zip(df["query_id"], df["subject_id"], df["accession"])),
+            [
+                ("query_a", "MGYP1", "ERS01"),
+                ("query_b", "MGYP1", "ERS01"),
+                ("query_c", "MGYP2", "ERS02"),
+            ],
+        )
+
+    def test_sequence_search_resume(self):
+        """Test a run resumed from the checkpoint only retries failed queries"""
+        output = os.path.join(self.tmp, "out.csv")
+        checkpoint = os.path.join(self.tmp, "out.journal")
+        failing = {"query_2"}
+
+        def _analyse_sequence(search):
+            if search.query_id in failing:
+                return False
+            return self._analyse_sequence(search)
+
+        def _run():
+            args = argparse.Namespace(
+                sequence=[self.fasta],
+                output=None,
+                database="full",
+                workers=2,
+                checkpoint=checkpoint,
+            )
+            with mock.patch.object(
+                SequenceSearch, "analyse_sequence", autospec=True
+            ) as analyse_sequence, mock.patch.object(
+                SequenceSearch, "make_request", self._make_request
+            ):
+                analyse_sequence.side_effect = _analyse_sequence
+                args.output = output if not os.path.exists(checkpoint) else None
+                sequence_search(args)
+            return [c.args[0].query_id for c in analyse_sequence.call_args_list]
+
+        self.assertEqual(len(_run()), 6)
+        self.assertEqual(len(pd.read_csv(output)), 5)
+
+        failing.clear()
+        self.assertEqual(_run(), ["query_2"])
+        df = pd.read_csv(output)
+        self.assertEqual(
+            sorted(df["query_id"]), ["query_{}".format(i) for i in range(6)]
+        )
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_sequence_search_resume_parquet(self):
+        """Test running a finished parquet search again keeps its results"""
+        output = os.path.join(self.tmp, "out.parquet")
+        checkpoint = os.path.join(self.tmp, "out.journal")
+
+        def _run():
+            args = argparse.Namespace(
+                sequence=[self.fasta],
+                output=output,
+                database="full",
+                format="parquet",
+                checkpoint=checkpoint,
+            )
+            with mock.patch.object(
+                SequenceSearch, "analyse_sequence", self._analyse_sequence
+            ), mock.patch.object(SequenceSearch, "make_request", self._make_request):
+                sequence_search(args)
+            return list(pd.read_parquet(output)["query_id"])
+
+        queries = ["query_{}".format(i) for i in range(6)]
+        self.assertEqual(_run(), queries)
+        # nothing new to search
+        self.assertEqual(_run(), queries)
+
+        with open(self.fasta, "a") as f:
+            f.write(">query_6\nMSTHPIRVFSEIGK6\n")
+        self.assertEqual(_run(), queries + ["query_6"])
+
+        # the partial csv can be rebuilt from the parquet file
+        os.remove(output + ".partial.csv")
+        with open(self.fasta, "a") as f:
+            f.write(">query_7\nMSTHPIRVFSEIGK7\n")
+        self.assertEqual(_run(), queries + ["query_6", "query_7"])
+
+    def test_results_to_df(self):
+        """Test the columns match the transposed dict of dicts conversion"""
+        csv_rows = {
+            ("MGYP01", "ERS01"): {"kg": "x", "score": 25.5, "nreported": 1},
+            ("MGYP01", "ERR02"): {"kg": "y", "depth (m)": "10 m", "nreported": 3},
+            ("MGYP02", "ERS01"): {"kg": "z", "lat/lon": "1,2", "score": 1e-250},
+        }
+        df = SequenceSearch("MSTH", "query").results_to_df(csv_rows, "uuid")
+
+        expected = pd.DataFrame(
+            {" ".join(key): row for key, row in csv_rows.items()}
+        ).T.reset_index()
+        expected[["subject_id", "accession"]] = expected["index"].str.split(
+            " ", n=1, expand=True
+        )
+        expected = expected.drop(["index", "subject_id", "accession"], axis=1)
+        expected.insert(0, "query_id", "query")
+        expected.insert(1, "subject_id", [s for s, _ in csv_rows])
+        expected.insert(1, "accession", [a for _, a in csv_rows])
+        expected.columns = ["query_id", "accession", "subject_id", "kg", "score"] + [
+            "nreported",
+            "depth m",
+            "lat_lon",
+        ]
+
+        self.assertEqual(df.to_csv(index=False), expected.to_csv(index=False))
+
+
+class MockHmmerHandler(BaseHTTPRequestHandler):
+    """phmmer endpoints, jobs are running on the first results request"""
+
+    jobs = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        data = parse_qs(self.rfile.read(length).decode("utf-8"))
+        uuid = "job-{}".format(len(self.jobs))
+        self.jobs[uuid] = {"seq": data["seq"][0], "checks": 0}
+        self.send_response(303)
+        self.send_header("Location", "/results/{}/score".format(uuid))
+        self.end_headers()
+
+    def do_GET(self):
+        uuid = self.path.split("/")[2]
+        job = self.jobs[uuid]
+        job["checks"] += 1
+        if job["checks"] == 1:
+            self.send_response(202)
+            self.end_headers()
+            return
+        body = json.dumps(
+            {
+                "results": {
+                    "uuid": uuid,
+                    "hits": [
+                        {
+                            "name": "MGYP0" + job["seq"][-1],
+                            "mgnify": {"samples": [["ERS0001"]]},
+                        }
+                    ],
+                }
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SequenceSearchJobsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.tmp, "queries.fasta")
+        with open(self.fasta, "w") as f:
+            for i in range(3):
+                f.write(">query_{i}\nMSTHPIRVFSEIGK{i}\n".format(i=i))
+        MockHmmerHandler.jobs = {}
+        self.server = HTTPServer(("127.0.0.1", 0), MockHmmerHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.patches = [
+            mock.patch("mg_toolkit.search.MG_SEQ_URL", base + "/search/phmmer"),
+            mock.patch(
+                "mg_toolkit.search.MG_SEQ_RESULTS_URL", base + "/results/{uuid}/score"
+            ),
+            mock.patch.object(
+                SequenceSearch,
+                "make_request",
+                SequenceSearchTests._make_request,
+            ),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_jobs_without_checkpoint(self):
+        """Test the jobs can't be submitted without a checkpoint"""
+        args = argparse.Namespace(
+            sequence=[self.fasta], output=None, submit_only=True, checkpoint=None
+        )
+        with self.assertRaises(ValueError):
+            sequence_search(args)
+        self.assertEqual(MockHmmerHandler.jobs, {})
+
+    def test_submit_then_fetch(self):
+        """Test the jobs are submitted first and their results fetched later"""
+        output = os.path.join(self.tmp, "out.csv")
+        checkpoint = os.path.join(self.tmp, "out.journal")
+        args = dict(
+            output=output,
+            database="full",
+            workers=2,
+            checkpoint=checkpoint,
+            poll_interval=0.01,
+        )
+        sequence_search(
+            argparse.Namespace(sequence=[self.fasta], submit_only=True, **args)
+        )
+        self.assertEqual(len(MockHmmerHandler.jobs), 3)
+        self.assertFalse(os.path.exists(output))
+
+        sequence_search(argparse.Namespace(sequence=None, fetch_only=True, **args))
+
+        df = pd.read_csv(output)
+        self.assertEqual(sorted(df["query_id"]), ["query_0", "query_1", "query_2"])
+        for _, row in df.iterrows():
+            self.assertEqual(row["subject_id"], "MGYP0" + row["query_id"][-1])
+        # nothing left to fetch
+        self.assertEqual(Checkpoint(checkpoint).submitted(), {})
@@ -0,0 +1,119 @@
+#!/bin/env python3
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from mg_toolkit.__main__ import run
+from mg_toolkit.server import TOOLS, ToolkitServer, forward
+
+released = threading.Event()
+
+
+def fake_run(argv):
+    print("cwd", os.getcwd())
+    print("argv", " ".join(argv))
+    if argv[0] == "fail":
+        raise SystemExit(2)
+    if argv[0] == "wait":
+        released.wait(5)
+        print("released")
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = os.path.realpath(tempfile.mkdtemp())
+        self.server = ToolkitServer(("127.0.0.1", 0), fake_run)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _forward(self, argv):
+        cwd = os.getcwd()
+        output = io.StringIO()
+        try:
+            os.chdir(self.tmp)
+            with redirect_stdout(output):
+                returncode = forward(self.url, argv, token=self.server.token)
+        finally:
+            os.chdir(cwd)
+        return returncode, output.getvalue()
+
+    def test_forward(self):
+        """Test the command runs in the server from the client directory"""
+        cwd = os.getcwd()
+        returncode, output = self._forward(["bulk_download", "-a", "MGYS0001"])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(
+            output, "cwd {}\nargv bulk_download -a MGYS0001\n".format(self.tmp)
+        )
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_forward_exit_code(self):
+        """Test the exit code of the command is returned"""
+        returncode, output = self._forward(["fail"])
+        self.assertEqual(returncode, 2)
+
+    def test_stream(self):
+        """Test the output is sent while the command runs"""
+        released.clear()
+        request = Request(
+            self.url + "/run",
+            data=json.dumps({"argv": ["wait"], "cwd": self.tmp}).encode(),
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": "Bearer " + self.server.token,
+            },
+        )
+        with urlopen(request) as response:
+            self.assertEqual(
+                json.loads(response.readline()), {"output": "cwd {}\n".format(self.tmp)}
+            )
+            released.set()
+            messages = [json.loads(line) for line in response]
+        self.assertEqual(messages[-1], {"returncode": 0})
+        self.assertIn({"output": "released\n"}, messages)
+
+    def _post(self, headers):
+        request = Request(
+            self.url + "/run",
+            data=json.dumps({"argv": ["bulk_download"]}).encode(),
+            headers=headers,
+        )
+        with self.assertRaises(HTTPError) as cm:
+            urlopen(request)
+        return cm.exception.code
+
+    def test_token(self):
+        """Test the commands without the token or as text/plain are refused"""
+        token = "Bearer " + self.server.token
+        self.assertEqual(self._post({"Content-Type": "application/json"}), 401)
+        self.assertEqual(
+            self._post(
+                {"Content-Type": "application/json", "Authorization": "Bearer x"}
+            ),
+            401,
+        )
+        self.assertEqual(
+            self._post({"Content-Type": "text/plain", "Authorization": token}), 415
+        )
+
+    def test_tools(self):
+        """Test the server only runs the download and search tools"""
+        with redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit) as cm:
+                run(["serve", "--port", "0"], tools=TOOLS)
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn("serve can't be run here", stderr.getvalue())
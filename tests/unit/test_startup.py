@@ -0,0 +1,59 @@
+#!/bin/env python3
+
+import subprocess
+import sys
+import unittest
+
+
+def _imported_modules(code, modules):
+    """Run the code in a new interpreter and return which modules it imported"""
+    check = (
+        "import sys\n{code}\n"
+        "print(','.join(m for m in {modules!r} if m in sys.modules))"
+    ).format(code=code, modules=modules)
+    output = subprocess.check_output([sys.executable, "-c", check], text=True)
+    return [m for m in output.splitlines()[-1].split(",") if m]
+
+
+class StartupTests(unittest.TestCase):
+    heavy = ("pandas", "requests", "tqdm", "xml.etree.ElementTree")
+
+    def test_cli_import(self):
+        """Test loading the command line doesn't import the tools dependencies"""
+        self.assertEqual(
+            _imported_modules("import mg_toolkit.__main__", self.heavy), []
+        )
+
+    def test_version(self):
+        """Test --version doesn't import the tools"""
+        code = (
+            "import mg_toolkit.__main__\n"
+            "sys.argv = ['mg-toolkit', '--version']\n"
+            "try:\n"
+            "    mg_toolkit.__main__.main()\n"
+            "except SystemExit:\n"
+            "    pass"
+        )
+        self.assertEqual(
+            _imported_modules(code, self.heavy + ("mg_toolkit.search",)), []
+        )
+
+    def test_bulk_download_import(self):
+        """Test bulk_download doesn't import pandas"""
+        self.assertEqual(
+            _imported_modules("from mg_toolkit import bulk_download", ("pandas",)),
+            [],
+        )
+
+    def test_tool_attributes(self):
+        """Test the tools stay functions once their modules are imported"""
+        code = (
+            "import mg_toolkit\n"
+            "first = mg_toolkit.bulk_download\n"
+            "second = mg_toolkit.bulk_download\n"
+            "assert first is second and callable(second), second\n"
+            "from mg_toolkit.merge import read_counts\n"
+            "assert callable(mg_toolkit.merge), mg_toolkit.merge\n"
+            "assert callable(mg_toolkit.verify), mg_toolkit.verify\n"
+        )
+        subprocess.check_call([sys.executable, "-c", code])
@@ -0,0 +1,447 @@
+#!/bin/env python3
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stderr
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from requests.exceptions import ConnectionError, Timeout
+
+from mg_toolkit.__main__ import run
+from mg_toolkit.profiling import SamplingProfiler
+from mg_toolkit.transport import (
+    ResponseCache,
+    ToolkitAdapter,
+    configure_endpoints,
+    configure_timeouts,
+    disable_hedging,
+    disable_recording,
+    disable_trace,
+    enable_hedging,
+    enable_record,
+    enable_replay,
+    enable_trace,
+    get_session,
+    queued,
+)
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b"x" * 100
+        self.send_response(200 if self.path == "/ok" else 404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TraceTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def tearDown(self):
+        disable_trace()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_trace(self):
+        """Test a json line is written per request"""
+        trace_file = os.path.join(self.tmp, "trace.jsonl")
+        enable_trace(trace_file)
+        get_session().get(self.url + "/ok")
+        get_session().get(self.url + "/missing")
+        disable_trace()
+
+        with open(trace_file) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(
+            [(e["url"], e["status"], e["bytes"]) for e in entries],
+            [(self.url + "/ok", 200, 100), (self.url + "/missing", 404, 100)],
+        )
+        for entry in entries:
+            self.assertEqual(entry["method"], "GET")
+            self.assertEqual(entry["retries"], 0)
+            self.assertGreaterEqual(entry["queue_ms"], 0)
+            self.assertGreater(entry["latency_ms"], 0)
+
+    def test_queue_delay(self):
+        """Test the wait for a worker is traced on the first request of a task"""
+        trace_file = os.path.join(self.tmp, "trace.jsonl")
+        enable_trace(trace_file)
+
+        def _task(path):
+            get_session().get(self.url + path)
+            get_session().get(self.url + path)
+            time.sleep(0.3)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(queued(_task), "/first")
+            executor.submit(queued(_task), "/second")
+        disable_trace()
+
+        with open(trace_file) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(
+            [e["url"] for e in entries],
+            [self.url + "/first"] * 2 + [self.url + "/second"] * 2,
+        )
+        self.assertLess(entries[0]["queue_ms"], 300)
+        self.assertGreaterEqual(entries[2]["queue_ms"], 300)
+        self.assertEqual(entries[3]["queue_ms"], 0)
+
+    def test_trace_error(self):
+        """Test failed requests are traced with the error"""
+        trace_file = os.path.join(self.tmp, "trace.jsonl")
+        enable_trace(trace_file)
+        with self.assertRaises(Exception):
+            get_session().get("http://127.0.0.1:1/", timeout=1)
+        disable_trace()
+
+        with open(trace_file) as f:
+            (entry,) = [json.loads(line) for line in f]
+        self.assertIsNone(entry["status"])
+        self.assertIn("error", entry)
+
+
+class RecordingTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def tearDown(self):
+        disable_recording()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _requests(self):
+        session = get_session()
+        return [
+            session.get(self.url + "/ok"),
+            session.get(self.url + "/missing"),
+            session.post(self.url + "/search", data={"seq": "ACGT"}),
+            session.post(self.url + "/search", data={"seq": "TTTT"}),
+        ]
+
+    def test_record_replay(self):
+        """Test the recorded responses are replayed without the server"""
+        enable_record(self.tmp)
+        recorded = self._requests()
+        self.server.shutdown()
+
+        enable_replay(self.tmp)
+        replayed = self._requests()
+
+        self.assertEqual(
+            [(r.status_code, r.text) for r in replayed],
+            [(r.status_code, r.text) for r in recorded],
+        )
+        self.assertEqual(replayed[2].text, "seq=ACGT")
+        self.assertEqual(replayed[3].text, "seq=TTTT")
+        self.assertEqual(replayed[2].encoding, "utf-8")
+        # the two GET responses have the same body
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp, "requests"))), 4)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp, "bodies"))), 3)
+
+    def test_record_stream(self):
+        """Test a streamed body is recorded as it's read"""
+        enable_record(self.tmp)
+        with get_session().get(self.url + "/ok", stream=True) as response:
+            self.assertEqual(os.listdir(os.path.join(self.tmp, "bodies")), [])
+            content = b"".join(response.iter_content(10))
+        self.server.shutdown()
+
+        enable_replay(self.tmp)
+        replayed = get_session().get(self.url + "/ok", stream=True)
+        self.assertEqual(b"".join(replayed.iter_content(10)), content)
+        self.assertEqual(
+            os.listdir(os.path.join(self.tmp, "bodies")),
+            [hashlib.sha256(content).hexdigest() + ".gz"],
+        )
+        # a resumed download isn't the same request
+        with self.assertRaises(ConnectionError):
+            get_session().get(self.url + "/ok", headers={"Range": "bytes=10-"})
+
+    def test_replay_missing(self):
+        """Test a request that wasn't recorded fails"""
+        enable_replay(self.tmp)
+        with self.assertRaises(ConnectionError):
+            get_session().get(self.url + "/ok")
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def test_ttl(self):
+        """Test the cached responses expire after the ttl"""
+        cache = ResponseCache(["https://example.org/samples"], ttl=60)
+        request = mock.Mock(method="GET", url="https://example.org/samples/1")
+        response = mock.Mock(status_code=200, headers={}, content=b"{}")
+        with mock.patch("time.monotonic", return_value=0):
+            cache.set(request, response)
+        with mock.patch("time.monotonic", return_value=59):
+            self.assertEqual(cache.get(request).content, b"{}")
+        with mock.patch("time.monotonic", return_value=61):
+            self.assertIsNone(cache.get(request))
+
+
+class EndpointHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        time.sleep(self.server.delay)
+        body = self.path.encode()
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FailoverTests(unittest.TestCase):
+    prefix = "http://mgnify.invalid/api"
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        configure_endpoints({})
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def _server(self, status=200, delay=0):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), EndpointHandler)
+        server.status, server.delay, server.hits = status, delay, []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return server, "http://127.0.0.1:{}/mirror".format(server.server_port)
+
+    def test_fastest(self):
+        """Test the requests go to the fastest endpoint"""
+        slow, slow_base = self._server(delay=0.3)
+        fast, fast_base = self._server()
+        configure_endpoints({self.prefix: [slow_base, fast_base]})
+
+        response = get_session().get(self.prefix + "/samples?page=2")
+
+        self.assertEqual(response.text, "/mirror/samples?page=2")
+        self.assertEqual(fast.hits, ["/mirror", "/mirror/samples?page=2"])
+        self.assertEqual(slow.hits, ["/mirror"])
+
+    def test_failover(self):
+        """Test the request is sent to the next endpoint when one fails"""
+        failing, failing_base = self._server()
+        backup, backup_base = self._server(delay=0.1)
+        configure_endpoints({self.prefix: [failing_base, backup_base]})
+        get_session().get(self.prefix + "/runs")
+        self.assertEqual(failing.hits, ["/mirror", "/mirror/runs"])
+
+        failing.status = 503
+        response = get_session().get(self.prefix + "/samples")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(backup.hits, ["/mirror", "/mirror/samples"])
+
+        # the failed endpoint is avoided
+        get_session().get(self.prefix + "/biomes")
+        self.assertEqual(failing.hits, ["/mirror", "/mirror/runs", "/mirror/samples"])
+        self.assertEqual(backup.hits[-1], "/mirror/biomes")
+
+    def test_probe_replay(self):
+        """Test the probes are recorded and replayed like the other requests"""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.addCleanup(disable_recording)
+        first, first_base = self._server()
+        second, second_base = self._server(delay=0.1)
+        enable_record(tmp)
+        configure_endpoints({self.prefix: [first_base, second_base]})
+        recorded = get_session().get(self.prefix + "/runs").text
+
+        enable_replay(tmp)
+        configure_endpoints({self.prefix: [first_base, second_base]})
+        self.assertEqual(get_session().get(self.prefix + "/runs").text, recorded)
+        self.assertEqual(first.hits, ["/mirror", "/mirror/runs"])
+        self.assertEqual(second.hits, ["/mirror"])
+
+    def test_other_urls(self):
+        """Test the URLs of other prefixes are not rewritten"""
+        server, base = self._server()
+        configure_endpoints({self.prefix: [base]})
+        url = "http://127.0.0.1:{}/other".format(server.server_port)
+        self.assertEqual(get_session().get(url).text, "/other")
+
+
+class RunSettingsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_reset(self):
+        """Test the transport options of a command don't outlive it"""
+        with redirect_stderr(io.StringIO()):
+            run(
+                [
+                    "--api-base",
+                    "http://mirror.invalid/api",
+                    "--hedge",
+                    "verify",
+                    "-a",
+                    "MGYS1",
+                    "-o",
+                    self.tmp,
+                ]
+            )
+        self.assertEqual(ToolkitAdapter.endpoints, ())
+        self.assertIsNone(ToolkitAdapter.hedger)
+
+    def test_restore(self):
+        """Test a command keeps the transport options set before it, e.g. by
+        the server
+        """
+        tracer = enable_trace(os.path.join(self.tmp, "trace.jsonl"))
+        configure_endpoints({"http://mgnify.invalid/api": ["http://mirror.invalid"]})
+        endpoints = ToolkitAdapter.endpoints
+        try:
+            with redirect_stderr(io.StringIO()):
+                run(
+                    [
+                        "--trace",
+                        os.path.join(self.tmp, "job.jsonl"),
+                        "verify",
+                        "-a",
+                        "MGYS1",
+                        "-o",
+                        self.tmp,
+                    ]
+                )
+            self.assertIs(ToolkitAdapter.tracer, tracer)
+            self.assertIs(ToolkitAdapter.endpoints, endpoints)
+            self.assertFalse(tracer._fd.closed)
+        finally:
+            disable_trace()
+            configure_endpoints({})
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.hits += 1
+        if self.server.hits == 1:
+            time.sleep(1)
+        self._reply()
+
+    def do_POST(self):
+        time.sleep(1)
+        self._reply()
+
+    def _reply(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class TailLatencyTests(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+        self.server.hits = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_port)
+
+    def tearDown(self):
+        configure_timeouts()
+        disable_hedging()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_default_timeout(self):
+        """Test the requests without timeout get the default one"""
+        configure_timeouts(connect=1, read=0.2)
+        with self.assertRaises(Timeout):
+            get_session().post(self.url, data="x")
+
+    def test_hedging(self):
+        """Test a duplicate of a slow request is sent and answers first"""
+        hedger = enable_hedging()
+        hedger._latencies.extend([0.05] * hedger.min_samples)
+
+        started = time.perf_counter()
+        response = get_session().get(self.url)
+
+        self.assertEqual(response.text, "ok")
+        self.assertLess(time.perf_counter() - started, 0.9)
+        self.assertEqual(hedger.hedged, 1)
+        self.assertEqual(self.server.hits, 2)
+
+        disable_hedging()
+        with self.assertRaises(RuntimeError):
+            hedger._executor.submit(time.sleep, 0)
+
+
+class ProfilerTests(unittest.TestCase):
+    def test_sampling(self):
+        """Test the stacks of the worker threads are sampled"""
+
+        def busy_wait():
+            end = time.perf_counter() + 0.2
+            while time.perf_counter() < end:
+                pass
+
+        with SamplingProfiler(interval=0.001) as profiler:
+            worker = threading.Thread(target=busy_wait, name="worker")
+            worker.start()
+            worker.join()
+
+        self.assertGreater(profiler.threads["worker"], 0)
+        summary = profiler.summary()
+        self.assertIn("(busy_wait)", summary)
+
+    def test_profile_option(self):
+        """Test --profile writes the stacks sampled during the tool run"""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        profile_file = os.path.join(tmp, "profile.txt")
+
+        def busy_verify(args):
+            end = time.perf_counter() + 0.2
+            while time.perf_counter() < end:
+                pass
+            return 0
+
+        with mock.patch("mg_toolkit.verify", busy_verify):
+            run(["--profile", profile_file, "verify", "-a", "MGYS1", "-o", tmp])
+
+        with open(profile_file) as f:
+            summary = f.read()
+        self.assertIn("samples per thread", summary)
+        self.assertIn("(busy_verify)", summary)
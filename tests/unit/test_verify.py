@@ -0,0 +1,134 @@
+#!/bin/env python3
+
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+from mg_toolkit.verify import check_file, verify
+
+METADATA_COLUMNS = [
+    "analysis_id",
+    "name",
+    "group_type",
+    "description",
+    "download_url",
+    "pipeline_version",
+    "experiment_type",
+]
+
+
+class VerifyTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.project_dir = os.path.join(self.tmp, "MGYS1")
+        os.makedirs(self.project_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, relative_path, data):
+        path = os.path.join(self.project_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def _row(self, name, group_type, description="Counts", experiment="assembly"):
+        return [
+            "MGYA1",
+            name,
+            group_type,
+            description,
+            "https://example.org/" + name,
+            "5.0",
+            experiment,
+        ]
+
+    def test_command(self):
+        """Test the command runs once the module was imported by merge"""
+        import mg_toolkit.merge  # noqa: F401
+        from mg_toolkit.__main__ import run
+
+        for _ in range(2):
+            with redirect_stderr(io.StringIO()):
+                self.assertEqual(run(["verify", "-a", "MGYS2", "-o", self.tmp]), 1)
+
+    def test_check_file(self):
+        """Test the status of missing, empty, truncated and corrupt files"""
+        data = gzip.compress(b"ACGT\n" * 10000) + gzip.compress(b"TTTT\n")
+        good = self._write("good.fa.gz", data)
+        truncated = self._write("truncated.fa.gz", data[: len(data) // 2])
+        corrupt = self._write(
+            "corrupt.fa.gz",
+            data[:20] + bytes(b ^ 0xFF for b in data[20:40]) + data[40:],
+        )
+        empty = self._write("empty.tsv", b"")
+
+        status, size, checksum, algorithm, _ = check_file(good)
+        self.assertEqual(
+            (status, size, checksum, algorithm),
+            ("ok", len(data), hashlib.sha256(data).hexdigest(), "sha256"),
+        )
+        self.assertEqual(check_file(truncated)[0], "truncated")
+        self.assertEqual(check_file(corrupt)[0], "corrupt")
+        self.assertEqual(check_file(empty)[0], "truncated")
+        self.assertEqual(check_file(good + ".missing")[0], "missing")
+
+    def test_check_file_checksum(self):
+        """Test the checksum of the metadata is checked"""
+        path = self._write("stats.tsv", b"reads\t100\n")
+        md5 = hashlib.md5(b"reads\t100\n").hexdigest()
+
+        self.assertEqual(check_file(path, "MD5", md5)[:2], ("ok", 10))
+        self.assertEqual(check_file(path, "MD5", "0" * 32)[0], "corrupt")
+
+    def test_verify(self):
+        """Test the report and the manifest of a study"""
+        with open(os.path.join(self.project_dir, "MGYS1_metadata.tsv"), "w") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(METADATA_COLUMNS)
+            writer.writerow(self._row("stats.tsv", "Statistics"))
+            writer.writerow(self._row("go.tsv", "Functional analysis"))
+            # amplicon analyses don't have CDS files
+            writer.writerow(
+                self._row(
+                    "cds.faa",
+                    "Sequence data",
+                    "Predicted CDS with annotation",
+                    "amplicon",
+                )
+            )
+        self._write("5.0/statistics/stats.tsv", b"reads\t100\n")
+
+        manifest = os.path.join(self.tmp, "manifest.tsv")
+        args = argparse.Namespace(
+            accession="MGYS1",
+            output_path=self.tmp,
+            result_group=None,
+            workers=2,
+            report=None,
+            manifest=manifest,
+        )
+        with redirect_stdout(io.StringIO()) as output:
+            returncode = verify(args)
+
+        self.assertEqual(returncode, 1)
+        self.assertIn("2 files checked: 1 ok, 1 missing", output.getvalue())
+        with open(os.path.join(self.project_dir, "MGYS1_verify.tsv")) as f:
+            report = list(csv.DictReader(f, delimiter="\t"))
+        self.assertEqual(
+            [(r["status"], r["name"]) for r in report],
+            [("ok", "stats.tsv"), ("missing", "go.tsv")],
+        )
+        with open(manifest) as f:
+            rows = list(csv.reader(f, delimiter="\t"))
+        self.assertEqual(
+            rows, [METADATA_COLUMNS, self._row("go.tsv", "Functional analysis")]
+        )
@@ -0,0 +1,95 @@
+#!/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from mg_toolkit.writers import ResultWriter, csv_to_parquet
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    pyarrow = None
+
+
+class ResultWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.frames = [
+            pd.DataFrame(
+                {"query_id": ["q1", "q1"], "evalue": [1e-250, 0.5], "nreported": [1, 2]}
+            ).astype(object),
+            pd.DataFrame(
+                {"query_id": ["q2"], "biome": ["Marine"], "evalue": [None]}
+            ).astype(object),
+            pd.DataFrame({"query_id": ["q3"], "depth": ["10 m"]}).astype(object),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_write(self):
+        """Test the streamed csv matches the concatenated DataFrame"""
+        filename = os.path.join(self.tmp, "results.csv")
+        writer = ResultWriter(filename)
+        for df in self.frames:
+            writer.write(df)
+        # the new columns are listed next to the file until it's closed
+        with open(filename + ".columns") as f:
+            self.assertEqual(json.load(f), writer.columns)
+        writer.close()
+
+        with open(filename) as f:
+            self.assertEqual(f.read(), pd.concat(self.frames).to_csv(index=False))
+        self.assertFalse(os.path.exists(filename + ".columns"))
+
+    def test_resume_new_columns(self):
+        """Test an interrupted file keeps the columns added after its header"""
+        filename = os.path.join(self.tmp, "results.csv")
+        writer = ResultWriter(filename)
+        for df in self.frames:
+            writer.write(df)
+        # killed before close
+        writer._fd.close()
+
+        writer = ResultWriter(filename, keep_query_ids={"q1", "q3"})
+        writer.close()
+
+        expected = pd.concat(self.frames)
+        with open(filename) as f:
+            self.assertEqual(
+                f.read(), expected[expected["query_id"] != "q2"].to_csv(index=False)
+            )
+
+    def test_resume_empty(self):
+        """Test resuming a file without header starts it again"""
+        filename = os.path.join(self.tmp, "results.csv")
+        open(filename, "w").close()
+
+        writer = ResultWriter(filename, keep_query_ids=set())
+        writer.write(self.frames[0])
+        writer.close()
+
+        self.assertEqual(os.listdir(self.tmp), ["results.csv"])
+        with open(filename) as f:
+            self.assertEqual(f.read(), self.frames[0].to_csv(index=False))
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_csv_to_parquet(self):
+        """Test the csv to parquet conversion"""
+        filename = os.path.join(self.tmp, "results.csv")
+        writer = ResultWriter(filename)
+        for df in self.frames:
+            writer.write(df)
+        writer.close()
+
+        parquet_file = os.path.join(self.tmp, "results.parquet")
+        csv_to_parquet(filename, parquet_file)
+
+        df = pd.read_parquet(parquet_file)
+        self.assertEqual(list(df.columns), writer.columns)
+        self.assertEqual(list(df["query_id"]), ["q1", "q1", "q2", "q3"])